@@ -1,13 +1,16 @@
+import argparse
 import boto3
+import concurrent.futures
 import logging
-from time import sleep
 import sys
 import datetime
 import os
+import time
+import uuid
 
 logger = logging.getLogger(__name__)
 loglevel = 'INFO'
-logging.basicConfig(level=loglevel)
+logging.basicConfig(level=loglevel, format='%(asctime)s %(threadName)s %(message)s')
 logger.setLevel(loglevel)
 
 
@@ -22,20 +25,44 @@ public_db_subnet = os.environ.get('public_db_subnet_group')
 
 exception_tag = 'Exception'
 
-lambda_function_name = 'huit_public_instance_compliance'
+# tag key the deployed function reads the compliance mode of an instance from, see pComplianceModeOverrideTag
+compliance_override_tag = os.environ.get('ComplianceModeOverrideTag', 'HUITComplianceModeOverride')
 
+# seconds a test waits for the compliance function before failing
+ec2_timeout = int(os.environ.get('SmokeTestEC2Timeout', 600))
+rds_timeout = int(os.environ.get('SmokeTestRDSTimeout', 1800))
+
+# seconds an instance that should be left alone is watched after it is up
+settle_seconds = int(os.environ.get('SmokeTestSettleSeconds', 90))
+
+# polling starts fast and backs off, instances are checked every few seconds at first
+const_poll_first_delay = 2
+const_poll_max_delay = 30
+
+# states an instance can settle in
+const_stable_states = ('running', 'stopping', 'stopped', 'available')
+
+# compliance tag written by the function
+const_compliance_tag = 'HUIT Compliance'
+
+
+
+def get_client(service_name, session):
+
+    # Get a client for the child account, each test uses its own session since sessions are not thread safe
+    #
+    # Input: service name, boto3 session
+    # Output: client
 
-def get_client(service_name):
-    
     # get credentials for cross-account role
-    sts_connection = boto3.client('sts')
+    sts_connection = session.client('sts')
 
     RoleArn= f"arn:aws:iam::{remote_account}:role/{remote_role}"
     acct = sts_connection.assume_role(RoleArn= RoleArn, RoleSessionName= "SmokeTests")
     credentials=acct['Credentials']
 
     # get the client and resource
-    client = boto3.client(
+    client = session.client(
         service_name,
         aws_access_key_id= credentials['AccessKeyId'],
         aws_secret_access_key= credentials['SecretAccessKey'],
@@ -45,166 +72,263 @@ def get_client(service_name):
     return client
 
 
-def set_compliance_mode(compliance_mode):
 
-    lmda = boto3.client('lambda')
-    lmda_response = lmda.get_function_configuration(FunctionName=lambda_function_name)
-    lmda_vars = lmda_response['Environment']['Variables']
-    lmda_vars['ComplianceMode'] = str(compliance_mode).lower()
-    lmda.update_function_configuration(FunctionName=lambda_function_name, Environment={'Variables': lmda_vars})
-    return
+def get_instance_tags(test, identifier):
 
+    # Build the tags of a test instance
+    #
+    # Input: test, instance name
+    # Output: list of tags
 
+    instance_tags = []
+    instance_tags.append({'Key': 'Name', 'Value': identifier})
+    if test['Exception']:
+        instance_tags.append({'Key': exception_tag, 'Value': 'True'})
+    # the compliance mode travels with the instance, tests with different modes can run at the same time
+    instance_tags.append({'Key': compliance_override_tag, 'Value': str(test['Compliance']).lower()})
+    return instance_tags
 
-def run_test(test):
 
-    try:
 
-        name = test['Name']
-        desc = test['Description']
-        instance_type = test['Type']
-        subnet_type = test['Subnet']
-        compliance = test['Compliance']
-        desired_tag = test['Tag']
-        exception = test['Exception']
-        delay = test['Delay']
+def get_expected_states(test):
 
-        logger.info(f"Starting {name}: {desc}")
+    # States a test instance should end in
+    #
+    # Input: test
+    # Output: tuple of states
 
-        instance_client = get_client(instance_type)
+    if test['Exception'] or test['Subnet'] == 'Private' or not test['Compliance']:
+        return ('running', 'available')
+    return ('stopped', 'stopping')
 
-        if instance_type == 'ec2':
-            ssm = get_client('ssm')
-            ssm_response = ssm.get_parameter(Name='/aws/service/ami-amazon-linux-latest/amzn2-ami-hvm-x86_64-gp2')
-            image_id = ssm_response['Parameter']['Value']
-        else:
-            image_id = 'mysql'
 
-        # create tags
-        instance_tags = []
-        identifier = f"SmokeTest-{name}-{datetime.datetime.now().strftime('%H%M%S')}"
-        instance_tags.append({'Key': 'Name', 'Value': identifier})
-        if exception:
-            instance_tags.append({'Key': exception_tag, 'Value': 'True'})
 
-        # assign subnet / subnet group
-        if instance_type == 'ec2':
-            if subnet_type == 'Public':
-                subnet_id = public_subnet_id
-            else:
-                subnet_id = private_subnet_id
-        else:
-            if subnet_type == 'Public':
-                subnet_id = public_db_subnet
-            else:
-                subnet_id = private_db_subnet
+def check_outcome(test, state, tags):
 
+    # Compare the state and compliance tag of an instance with what the test expects
+    #
+    # Input: test, instance state, dict of tags
+    # Output: (passed, reason)
 
-        # set compliance mode
-        logger.info(f"...set compliance mode to {compliance}")
-        set_compliance_mode(compliance)
+    desired_tag = test['Tag']
+    tag = tags.get(const_compliance_tag)
+    if state not in get_expected_states(test):
+        return False, f"instance is in {state} state"
+    if desired_tag is None and tag is not None:
+        return False, f"found compliance tag {tag}"
+    if desired_tag is not None and tag is None:
+        return False, "no compliance tag found"
+    if desired_tag is not None and not tag.startswith(desired_tag):
+        return False, f"found incorrect compliance tag {tag}"
+    return True, f"instance is in {state} state with {'tag ' + tag if tag else 'no compliance tag'}"
 
-        # fire-up instance
-        logger.info(f"...start up {instance_type} instance")
-        if instance_type == 'ec2':
-            instance_response = instance_client.run_instances(ImageId=image_id, InstanceType='t3.micro',MinCount=1,MaxCount=1,SubnetId=subnet_id,
-                TagSpecifications=[{'ResourceType': 'instance', 'Tags': instance_tags}])
-            instance_id = instance_response['Instances'][0]['InstanceId']
-        else:
-            public = (subnet_type == 'Public')
-            instance_response = instance_client.create_db_instance(DBInstanceIdentifier=identifier, DBInstanceClass='db.t3.micro', Engine=image_id,
-                MasterUsername='admin', MasterUserPassword='admin123123',AllocatedStorage=20,BackupRetentionPeriod=0,MultiAZ=False,
-                AutoMinorVersionUpgrade=False,PubliclyAccessible=public,DBSubnetGroupName=subnet_id,Tags=instance_tags,MonitoringInterval=0)
-            instance_id = instance_response['DBInstance']['DBInstanceIdentifier']
 
-        # check for instance state and compliance tag
-        logger.info("...Checking instance state and compliance tag")
-        valid_states = ('running', 'stopping', 'stopped', 'available' )
 
-        state = 'unknown'
-        while state.lower() not in valid_states:
-            logger.info(f"...waiting for {delay} seconds to reach stable state, instance still in ({state}) state")
-            sleep(delay)
-            if instance_type == 'ec2':
-                instance_response = instance_client.describe_instances(InstanceIds=[instance_id])
-                state = instance_response['Reservations'][0]['Instances'][0]['State']['Name']
-            else:
-                instance_response = instance_client.describe_db_instances(DBInstanceIdentifier=instance_id)
-                state = instance_response['DBInstances'][0]['DBInstanceStatus']
+def wait_for_outcome(test, describe, timeout):
 
-        logger.info(f"...instance is in {state} state; waiting another {delay} seconds to allow compliance function to take action")
-        sleep(delay)
+    # Poll an instance with backoff until it reaches the expected outcome
+    #
+    # An expected compliance tag ends the wait as soon as it appears. Instances
+    # that should be left alone are watched for settle_seconds after they are up.
+    #
+    # Input: test, function returning (state, dict of tags), seconds before giving up
+    # Output: (passed, reason)
 
-        if instance_type == 'ec2':
-            tags = instance_response['Reservations'][0]['Instances'][0]['Tags']
-        else:
-            arn = instance_response['DBInstances'][0]['DBInstanceArn']
-            tags = instance_client.list_tags_for_resource(ResourceName=arn)['TagList']
+    started = time.time()
+    stable_since = None
+    delay = const_poll_first_delay
+    while True:
+        state, tags = describe()
+        now = time.time()
+        if state in const_stable_states and stable_since is None:
+            stable_since = now
+        passed, reason = check_outcome(test, state, tags)
+        if passed and (test['Tag'] is not None or now - stable_since >= settle_seconds):
+            return True, reason
+        if test['Tag'] is None and const_compliance_tag in tags:
+            # a tag never goes away, no need to wait any longer
+            return False, reason
+        if now - started > timeout:
+            return False, f"{reason} after {timeout} seconds"
+        logger.info(f"...{test['Name']}: {reason}, checking again in {delay} seconds")
+        time.sleep(delay)
+        delay = min(delay * 2, const_poll_max_delay)
 
-        if exception or subnet_type == 'Private' or not compliance:
-            desired_state = ('running', 'available')
-        else:
-            desired_state = ('stopped', 'stopping')
 
-        success = False
-        logger.info("...checking instance state")
 
+def run_test(test):
 
-        if state.lower() not in desired_state:
-            logger.info(f"...instance is in {state} state...FAIL")
-        else:
-            logger.info(f"...instance is in {state} state...PASS")
-            logger.info("...checking tag")
-            tag_found = False
-            wrong_tag = False
-            if len(tags) > 0:
-                for tag in tags:
-                    if tag['Key'] == 'HUIT Compliance':
-                        if desired_tag == None:
-                            tag_found = True
-                            logger.info("...found compliance tag...FAIL")
-                            break
-                        elif tag['Value'].startswith(desired_tag):
-                            tag_found = True
-                            logger.info("...found correct compliance tag...PASS")
-                            break
-                        else:
-                            logger.info("...found incorrect compliance tag...FAIL")
-                            wrong_tag = True
-                            break
-            if len(tags) == 0 or (not tag_found and not wrong_tag):
-                logger.info(f"...no tag found...{'PASS' if desired_tag is None else 'FAIL'}")
-
-            if ((tag_found and desired_tag is not None) or (not tag_found and desired_tag is None)):
-                success = True
+    # Launch an instance, wait for the deployed compliance function and check what it did
+    #
+    # Input: test
+    # Output: (name, passed, reason)
 
-        # terminate instance
-        logger.info("...terminating instance")
+    name = test['Name']
+    instance_type = test['Type']
+    instance_id = None
+    instance_client = None
+    logger.info(f"Starting {name}: {test['Description']}")
+
+    try:
+        session = boto3.session.Session()
+        instance_client = get_client(instance_type, session)
+        identifier = f"SmokeTest-{name}-{datetime.datetime.now().strftime('%H%M%S')}"
+        instance_tags = get_instance_tags(test, identifier)
+        public = (test['Subnet'] == 'Public')
+
+        # fire-up instance
         if instance_type == 'ec2':
-            instance_client.terminate_instances(InstanceIds=[instance_id])        
+            ssm = get_client('ssm', session)
+            image_id = ssm.get_parameter(Name='/aws/service/ami-amazon-linux-latest/amzn2-ami-hvm-x86_64-gp2')['Parameter']['Value']
+            instance_response = instance_client.run_instances(ImageId=image_id, InstanceType='t3.micro',MinCount=1,MaxCount=1,
+                SubnetId=public_subnet_id if public else private_subnet_id,
+                TagSpecifications=[{'ResourceType': 'instance', 'Tags': instance_tags}])
+            instance_id = instance_response['Instances'][0]['InstanceId']
+
+            def describe():
+                instance = instance_client.describe_instances(InstanceIds=[instance_id])['Reservations'][0]['Instances'][0]
+                return instance['State']['Name'], {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])}
+            timeout = ec2_timeout
+
         else:
-            instance_client.delete_db_instance(DBInstanceIdentifier=instance_id,SkipFinalSnapshot=True)
+            instance_response = instance_client.create_db_instance(DBInstanceIdentifier=identifier, DBInstanceClass='db.t3.micro', Engine='mysql',
+                MasterUsername='admin', MasterUserPassword='admin123123',AllocatedStorage=20,BackupRetentionPeriod=0,MultiAZ=False,
+                AutoMinorVersionUpgrade=False,PubliclyAccessible=public,DBSubnetGroupName=public_db_subnet if public else private_db_subnet,
+                Tags=instance_tags,MonitoringInterval=0)
+            instance_id = instance_response['DBInstance']['DBInstanceIdentifier']
+            arn = instance_response['DBInstance']['DBInstanceArn']
 
-        # put Lambda back into audit mode
-        logger.info("...put lambda back in audit mode")
-        set_compliance_mode(False)
+            def describe():
+                db_instance = instance_client.describe_db_instances(DBInstanceIdentifier=instance_id)['DBInstances'][0]
+                tags = instance_client.list_tags_for_resource(ResourceName=arn)['TagList']
+                return db_instance['DBInstanceStatus'], {tag['Key']: tag['Value'] for tag in tags}
+            timeout = rds_timeout
 
-        logger.info(f"{name} {'PASSED' if success else 'FAILED'}")
-        return success
+        logger.info(f"...{name}: started {instance_type} instance {instance_id}")
+        passed, reason = wait_for_outcome(test, describe, timeout)
 
     except Exception as e:
-        logger.info(f"Unexpected error in test: {e}")
-        sys.exit(1)
-
+        passed, reason = False, f"unexpected error: {e}"
 
+    finally:
+        # terminate instance
+        if instance_id is not None:
+            logger.info(f"...{name}: terminating instance {instance_id}")
+            try:
+                if instance_type == 'ec2':
+                    instance_client.terminate_instances(InstanceIds=[instance_id])
+                else:
+                    instance_client.delete_db_instance(DBInstanceIdentifier=instance_id,SkipFinalSnapshot=True)
+            except Exception as e:
+                logger.warning(f"...{name}: unable to delete instance {instance_id}: {e}")
+
+    logger.info(f"{name} {'PASSED' if passed else 'FAILED'}: {reason}")
+    return name, passed, reason
+
+
+
+def run_local_test(test, backend, handler):
+
+    # Run a test against the in-memory AWS backend, invoking the handler with the event AWS would send
+    #
+    # Input: test, FakeAws backend holding the test instance, Lambda handler
+    # Output: (name, passed, reason)
+
+    name = test['Name']
+    instance_id = test['LocalId']
+    event = {'version': '0', 'id': str(uuid.uuid4()), 'account': '123456789012', 'region': 'us-east-1',
+             'time': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')}
+    if test['Type'] == 'ec2':
+        event.update({'source': 'aws.ec2', 'detail-type': 'EC2 Instance State-change Notification',
+                      'resources': [f"arn:aws:ec2:us-east-1:123456789012:instance/{instance_id}"],
+                      'detail': {'instance-id': instance_id, 'state': 'running'}})
+        state, stopped_state, tag_key = 'running', 'stopped', instance_id
+    else:
+        arn = f"arn:aws:rds:us-east-1:123456789012:db:{instance_id}"
+        event.update({'source': 'aws.rds', 'detail-type': 'RDS DB Instance Event', 'resources': [arn],
+                      'detail': {'SourceType': 'DB_INSTANCE', 'SourceArn': arn, 'Message': 'DB instance created',
+                                 'SourceIdentifier': instance_id, 'EventID': 'RDS-EVENT-0005'}})
+        state, stopped_state, tag_key = 'available', 'stopped', arn
 
-def run_smoke_tests(tests):
+    try:
+        handler(event, None)
+        if instance_id in backend.stopped:
+            state = stopped_state
+        passed, reason = check_outcome(test, state, backend.tags.get(tag_key, {}))
+    except Exception as e:
+        passed, reason = False, f"unexpected error: {e}"
+
+    logger.info(f"{name} {'PASSED' if passed else 'FAILED'}: {reason}")
+    return name, passed, reason
+
+
+
+def build_local_fixture(tests):
+
+    # Build one VPC with a public and a private subnet holding an instance per test
+    #
+    # Input: tests, each gets a LocalId
+    # Output: fixture for the FakeAws backend
+
+    def route_table(routetableid, subnetid, gateway):
+        return {'RouteTableId': routetableid, 'VpcId': 'vpc-0smoke',
+                'Routes': [{'DestinationCidrBlock': '10.0.0.0/16', 'GatewayId': 'local'}, dict({'DestinationCidrBlock': '0.0.0.0/0'}, **gateway)],
+                'Associations': [{'Main': False, 'RouteTableId': routetableid, 'SubnetId': subnetid, 'AssociationState': {'State': 'associated'}}]}
+
+    fixture = {
+        'Vpcs': [{'VpcId': 'vpc-0smoke', 'Tags': [{'Key': 'Name', 'Value': 'smoke-vpc'}]}],
+        'Subnets': [{'SubnetId': 'subnet-0public', 'VpcId': 'vpc-0smoke'}, {'SubnetId': 'subnet-0private', 'VpcId': 'vpc-0smoke'}],
+        'RouteTables': [route_table('rtb-0public', 'subnet-0public', {'GatewayId': 'igw-0smoke'}),
+                        route_table('rtb-0private', 'subnet-0private', {'NatGatewayId': 'nat-0smoke'})],
+        'Instances': [],
+        'DBInstances': [],
+    }
+    for n, test in enumerate(tests):
+        subnetid = 'subnet-0public' if test['Subnet'] == 'Public' else 'subnet-0private'
+        tags = get_instance_tags(test, f"SmokeTest-{test['Name']}")
+        if test['Type'] == 'ec2':
+            test['LocalId'] = f"i-0smoke{n:09d}"
+            fixture['Instances'].append({'InstanceId': test['LocalId'], 'InstanceType': 't3.micro', 'State': {'Code': 16, 'Name': 'running'},
+                                         'SubnetId': subnetid, 'VpcId': 'vpc-0smoke', 'Tags': tags})
+        else:
+            test['LocalId'] = f"smoketest-{test['Name'].lower()}"
+            fixture['DBInstances'].append({'DBInstanceIdentifier': test['LocalId'], 'DBInstanceStatus': 'available', 'Engine': 'mysql',
+                                           'DBInstanceArn': f"arn:aws:rds:us-east-1:123456789012:db:{test['LocalId']}",
+                                           'DBSubnetGroup': {'DBSubnetGroupName': f"smoke-{test['Subnet'].lower()}", 'VpcId': 'vpc-0smoke',
+                                                             'Subnets': [{'SubnetIdentifier': subnetid, 'SubnetStatus': 'Active'}]},
+                                           'TagList': tags})
+    return fixture
+
+
+
+def run_smoke_tests(tests, parallel, local=False):
+
+    # Run the tests concurrently
+    #
+    # Input: tests, number of tests run at the same time, flag to use the in-memory AWS backend
+    # Output: True if all tests passed
+
+    if local:
+        # the handler modules read their configuration at import
+        sys.path[:0] = [os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda', 'benchmark'),
+                        os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda')]
+        import fake_aws
+        fake_aws.configure_environment({'ComplianceMode': 'false', 'ExceptionTag': exception_tag,
+                                        'ComplianceModeOverrideTag': compliance_override_tag, 'LogLevel': 'WARNING'})
+        backend = fake_aws.FakeAws(build_local_fixture(tests))
+        fake_aws.install(backend)
+        from huit_public_compliance import lambda_handler
+        run = lambda test: run_local_test(test, backend, lambda_handler)
+    else:
+        run = run_test
 
-    result = True
-    for test in tests:
-        result = result and run_test(test)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+        results = list(executor.map(run, tests))
 
-    return result
+    logger.info("Summary:")
+    for name, passed, reason in results:
+        logger.info(f"    {name:10} {'PASSED' if passed else 'FAILED'}  {reason}")
+    return all(passed for name, passed, reason in results)
 
 
 
@@ -212,93 +336,27 @@ def create_tests():
 
     tests = []
 
-    # test = {}
-    # test['Name'] = 'EC2Test1'
-    # test['Description'] = 'Audit Mode, Public Subnet'
-    # test['Type'] = 'ec2'
-    # test['Subnet'] = 'Public'
-    # test['Compliance'] = False
-    # test['Tag'] = 'Out of Compliance'
-    # test['Exception'] = False
-    # test['Delay'] = 30
-    # tests.append(test)
-
-    # test = {}
-    # test['Name'] = 'EC2Test2'
-    # test['Description'] = 'Compliance Mode, Public Subnet'
-    # test['Type'] = 'ec2'
-    # test['Subnet'] = 'Public'
-    # test['Compliance'] = True
-    # test['Tag'] = 'Stopped on'
-    # test['Exception'] = False
-    # test['Delay'] = 30
-    # tests.append(test)
-
-    # test = {}
-    # test['Name'] = 'EC2Test3'
-    # test['Description'] = 'Compliance Mode, Public Subnet, Exception'
-    # test['Type'] = 'ec2'
-    # test['Subnet'] = 'Public'
-    # test['Compliance'] = True
-    # test['Tag'] = 'Out of Compliance'
-    # test['Exception'] = True
-    # test['Delay'] = 30
-    # tests.append(test)
-
-    # test = {}
-    # test['Name'] = 'EC2Test4'
-    # test['Description'] = 'Compliance Mode, Private Subnet'
-    # test['Type'] = 'ec2'
-    # test['Subnet'] = 'Private'
-    # test['Compliance'] = True
-    # test['Tag'] = None
-    # test['Exception'] = False
-    # test['Delay'] = 30
-    # tests.append(test)
-
-    # test = {}
-    # test['Name'] = 'RDSTest1'
-    # test['Description'] = 'Audit Mode, Public Subnet'
-    # test['Type'] = 'rds'
-    # test['Subnet'] = 'Public'
-    # test['Compliance'] = False
-    # test['Tag'] = 'Out of Compliance'
-    # test['Exception'] = False
-    # test['Delay'] = 30
-    # tests.append(test)
-
-    # test = {}
-    # test['Name'] = 'RDSTest2'
-    # test['Description'] = 'Compliance Mode, Public Subnet'
-    # test['Type'] = 'rds'
-    # test['Subnet'] = 'Public'
-    # test['Compliance'] = True
-    # test['Tag'] = 'Stopped on'
-    # test['Exception'] = False
-    # test['Delay'] = 30
-    # tests.append(test)
-
-    # test = {}
-    # test['Name'] = 'RDSTest3'
-    # test['Description'] = 'Compliance Mode, Public Subnet, Exception'
-    # test['Type'] = 'rds'
-    # test['Subnet'] = 'Public'
-    # test['Compliance'] = True
-    # test['Tag'] = 'Out of Compliance'
-    # test['Exception'] = True
-    # test['Delay'] = 30
-    # tests.append(test)
-
-    test = {}
-    test['Name'] = 'RDSTest4'
-    test['Description'] = 'Compliance Mode, Private Subnet'
-    test['Type'] = 'rds'
-    test['Subnet'] = 'Private'
-    test['Compliance'] = True
-    test['Tag'] = None
-    test['Exception'] = False
-    test['Delay'] = 30
-    tests.append(test)
+    # name, description, type, subnet, compliance, tag, exception
+    matrix = [
+        ('EC2Test1', 'Audit Mode, Public Subnet', 'ec2', 'Public', False, 'Out of Compliance', False),
+        ('EC2Test2', 'Compliance Mode, Public Subnet', 'ec2', 'Public', True, 'Stopped on', False),
+        ('EC2Test3', 'Compliance Mode, Public Subnet, Exception', 'ec2', 'Public', True, 'Out of Compliance', True),
+        ('EC2Test4', 'Compliance Mode, Private Subnet', 'ec2', 'Private', True, None, False),
+        ('RDSTest1', 'Audit Mode, Public Subnet', 'rds', 'Public', False, 'Out of Compliance', False),
+        ('RDSTest2', 'Compliance Mode, Public Subnet', 'rds', 'Public', True, 'Stopped on', False),
+        ('RDSTest3', 'Compliance Mode, Public Subnet, Exception', 'rds', 'Public', True, 'Out of Compliance', True),
+        ('RDSTest4', 'Compliance Mode, Private Subnet', 'rds', 'Private', True, None, False),
+    ]
+    for name, desc, instance_type, subnet_type, compliance, desired_tag, exception in matrix:
+        test = {}
+        test['Name'] = name
+        test['Description'] = desc
+        test['Type'] = instance_type
+        test['Subnet'] = subnet_type
+        test['Compliance'] = compliance
+        test['Tag'] = desired_tag
+        test['Exception'] = exception
+        tests.append(test)
 
     return tests
 
@@ -306,10 +364,16 @@ def create_tests():
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description='Run the smoke tests of the public instance compliance function')
+    parser.add_argument('--parallel', type=int, default=8, help='tests run at the same time')
+    parser.add_argument('--only', action='append', help='run only this test, can be repeated')
+    parser.add_argument('--local', action='store_true', help='run against the in-memory AWS backend instead of the child account')
+    args = parser.parse_args()
+
     logger.info("Building test data")
-    tests = create_tests()
-    logger.info(f"Starting smoke tests. Total of {len(tests)} will be run.")
-    results = run_smoke_tests(tests)
+    tests = [test for test in create_tests() if not args.only or test['Name'] in args.only]
+    logger.info(f"Starting smoke tests. Total of {len(tests)} will be run, {args.parallel} at a time.")
+    results = run_smoke_tests(tests, args.parallel, args.local)
     if results:
         logger.info("All smoke tests PASSED!")
     else:
@@ -0,0 +1,74 @@
+import glob
+import logging
+import os
+import subprocess
+import sys
+import zipfile
+
+# Build the Lambda deployment package from the modules in the lambda folder.
+# Only the function's own modules are packaged, boto3 and its dependencies come
+# from the Lambda runtime. The build fails when the package is over its size
+# budget, or when importing the handler takes longer than the startup budget.
+
+source_dir = os.environ.get('LambdaSourceDir', 'lambda')
+package_file = os.environ.get('LambdaPackage', os.path.join(source_dir, 'huit_public_compliance.zip'))
+size_budget = int(os.environ.get('PackageSizeBudget', 65536))
+import_budget_ms = float(os.environ.get('ImportTimeBudgetMs', 0))
+
+# fixed timestamp so that unchanged sources build an identical package
+const_zip_date_time = (2021, 1, 1, 0, 0, 0)
+
+# Initialize logger
+logger = logging.getLogger( __name__ )
+loglevel = 'INFO'
+logging.basicConfig(level=loglevel)
+logger.setLevel(loglevel)
+
+
+def measure_import_ms():
+
+    # Import the handler module in a fresh interpreter
+    #
+    # Input: None
+    # Output: import time in milliseconds
+
+    env = dict(os.environ)
+    env.setdefault('RoleName', 'huit-public-compliance-role')
+    env.setdefault('AWS_REGION', 'us-east-1')
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    env['PrewarmClients'] = 'false'
+    code = f"import sys, time; sys.path.insert(0, {package_file!r}); t = time.perf_counter(); import huit_public_compliance; print((time.perf_counter() - t) * 1000)"
+    completed = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+    return float(completed.stdout.strip().splitlines()[-1])
+
+
+try:
+    modules = sorted(glob.glob(os.path.join(source_dir, 'huit_public_compliance*.py')))
+    if not modules:
+        raise Exception(f"No modules found in {source_dir}")
+
+    logger.info(f"Packaging {len(modules)} modules into {package_file}")
+    with zipfile.ZipFile(package_file, 'w', zipfile.ZIP_DEFLATED) as package:
+        for module in modules:
+            info = zipfile.ZipInfo(os.path.basename(module), date_time=const_zip_date_time)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            with open(module, 'rb') as f:
+                package.writestr(info, f.read())
+
+    size = os.path.getsize(package_file)
+    logger.info(f"Package size is {size} bytes, budget is {size_budget} bytes")
+    if size > size_budget:
+        raise Exception(f"Package is {size - size_budget} bytes over its size budget")
+
+    if import_budget_ms:
+        import_ms = measure_import_ms()
+        logger.info(f"Handler import took {import_ms:.0f} ms, budget is {import_budget_ms:.0f} ms")
+        if import_ms > import_budget_ms:
+            raise Exception("Handler import is over its startup budget")
+
+    exit(0)
+
+except Exception as e:
+    logger.info(f"Encountered error: {e}, exiting")
+    exit(1)
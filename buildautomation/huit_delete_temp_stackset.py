@@ -5,6 +5,7 @@ import os
 
 stackset_name = os.environ.get('StackSetName')
 child_account = os.environ.get('ChildAccountNumber')
+regions = [region.strip() for region in os.environ.get('Regions', 'us-east-1').split(',')]
 
 # Initialize logger
 logger = logging.getLogger( __name__ )
@@ -16,7 +17,7 @@ try:
     logger.info(f"Removing temporary stackset {stackset_name} from account {child_account}")
     cfn = boto3.client('cloudformation')
     logger.info(f"Deleting stack instance")
-    cfn_response = cfn.delete_stack_instances(StackSetName=stackset_name,Accounts=[child_account],Regions=['us-east-1'],RetainStacks=False)
+    cfn_response = cfn.delete_stack_instances(StackSetName=stackset_name,Accounts=[child_account],Regions=regions,RetainStacks=False)
     operation_id=cfn_response["OperationId"]
 
     logger.info("Waiting for stack set instance to be deleted")
@@ -24,6 +25,7 @@ try:
     checks = 0
     while not done and checks < 20:
         time.sleep(30)
+        checks += 1
         cfn_response = cfn.describe_stack_set_operation(StackSetName=stackset_name,OperationId=operation_id)
         status = cfn_response['StackSetOperation']['Status']
         logger.info(f"...status is {status}")
@@ -0,0 +1,264 @@
+import argparse
+import boto3
+import concurrent.futures
+import json
+import logging
+import os
+import sys
+import time
+import uuid
+
+from botocore.exceptions import ClientError
+
+# Roll a stack set out to many accounts and regions
+#
+# Stack set operations cover every account and region of a request and are run
+# by CloudFormation with the concurrency and failure tolerance given in the
+# operation preferences, so an organization-wide rollout is one operation per
+# stack set.  Several stack sets are rolled out at the same time, operations
+# are polled with exponential backoff, and the result of every stack instance
+# is summarized per account.
+
+# Initialize logger
+logger = logging.getLogger( __name__ )
+loglevel = 'INFO'
+logging.basicConfig(level=loglevel)
+logger.setLevel(loglevel)
+
+# operation polling starts fast and backs off
+const_poll_first_delay = 5
+const_poll_max_delay = 60
+
+# terminal stack set operation states
+const_done_states = ['SUCCEEDED', 'FAILED', 'STOPPED']
+
+# actions and the stack set API starting them
+const_actions = ['create', 'update', 'delete']
+
+
+
+def parse_list(value):
+
+    # Split a comma separated list
+    #
+    # Input: string or None
+    # Output: list of stripped values
+
+    return [item.strip() for item in (value or '').split(',') if item.strip()]
+
+
+
+def get_organization_accounts():
+
+    # List the active accounts of the organization
+    #
+    # Input: None
+    # Output: list of account ids
+
+    organizations = boto3.client('organizations')
+    accounts = []
+    for page in organizations.get_paginator('list_accounts').paginate():
+        accounts.extend(account['Id'] for account in page['Accounts'] if account['Status'] == 'ACTIVE')
+    return accounts
+
+
+
+def get_operation_preferences(args):
+
+    # Build the operation preferences of a rollout
+    #
+    # Input: parsed arguments
+    # Output: OperationPreferences dict
+
+    preferences = {'RegionConcurrencyType': 'PARALLEL' if args.parallel_regions else 'SEQUENTIAL'}
+    if args.max_concurrent_count is not None:
+        preferences['MaxConcurrentCount'] = args.max_concurrent_count
+    else:
+        preferences['MaxConcurrentPercentage'] = args.max_concurrent_percentage
+    if args.failure_tolerance_count is not None:
+        preferences['FailureToleranceCount'] = args.failure_tolerance_count
+    else:
+        preferences['FailureTolerancePercentage'] = args.failure_tolerance_percentage
+    return preferences
+
+
+
+def start_operation(cfn, action, stackset_name, accounts, regions, preferences, retain_stacks=False, timeout=900):
+
+    # Start a stack set operation, waiting for a running operation of the same stack set to finish first
+    #
+    # Input: CloudFormation client, action, stack set name, accounts, regions, operation preferences, flag to keep the stacks on delete, seconds to wait
+    # Output: operation id
+
+    # the same operation id makes a retried request idempotent
+    kwargs = {'StackSetName': stackset_name, 'Accounts': accounts, 'Regions': regions,
+              'OperationPreferences': preferences, 'OperationId': str(uuid.uuid4())}
+    if action == 'create':
+        call = cfn.create_stack_instances
+    elif action == 'update':
+        call = cfn.update_stack_set
+        kwargs['UsePreviousTemplate'] = True
+        kwargs['Capabilities'] = ['CAPABILITY_IAM', 'CAPABILITY_NAMED_IAM']
+        kwargs['Parameters'] = [{'ParameterKey': parameter['ParameterKey'], 'UsePreviousValue': True}
+                                for parameter in cfn.describe_stack_set(StackSetName=stackset_name)['StackSet'].get('Parameters', [])]
+    else:
+        call = cfn.delete_stack_instances
+        kwargs['RetainStacks'] = retain_stacks
+
+    started = time.time()
+    delay = const_poll_first_delay
+    while True:
+        try:
+            operation_id = call(**kwargs)['OperationId']
+            logger.info(f"Started {action} of stack set {stackset_name} for {len(accounts)} accounts in {len(regions)} regions, operation {operation_id}")
+            return operation_id
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'OperationInProgressException' or time.time() - started > timeout:
+                raise
+            logger.info(f"Another operation is running on stack set {stackset_name}, retrying in {delay} seconds")
+            time.sleep(delay)
+            delay = min(delay * 2, const_poll_max_delay)
+
+
+
+def wait_for_operations(cfn, operations, timeout):
+
+    # Poll stack set operations with backoff until they all finish
+    #
+    # Input: CloudFormation client, dict of stack set name -> operation id, seconds before giving up
+    # Output: dict of stack set name -> final status, TIMED_OUT for operations still running
+
+    statuses = {}
+    pending = dict(operations)
+    started = time.time()
+    delay = const_poll_first_delay
+    while pending:
+        for stackset_name, operation_id in list(pending.items()):
+            operation = cfn.describe_stack_set_operation(StackSetName=stackset_name, OperationId=operation_id)['StackSetOperation']
+            if operation['Status'] in const_done_states:
+                statuses[stackset_name] = operation['Status']
+                del pending[stackset_name]
+                logger.info(f"...{stackset_name} operation {operation_id} {operation['Status']}")
+        if not pending:
+            break
+        if time.time() - started > timeout:
+            for stackset_name in pending:
+                statuses[stackset_name] = 'TIMED_OUT'
+            logger.info(f"...timed out after {timeout} seconds waiting for {', '.join(pending)}")
+            break
+        logger.info(f"...{len(pending)} operations running, checking again in {delay} seconds")
+        time.sleep(delay)
+        delay = min(delay * 2, const_poll_max_delay)
+    return statuses
+
+
+
+def get_operation_results(cfn, stackset_name, operation_id):
+
+    # Get the result of every stack instance of an operation
+    #
+    # Input: CloudFormation client, stack set name, operation id
+    # Output: list of {'StackSet', 'Account', 'Region', 'Status', 'Reason'}
+
+    results = []
+    paginator = cfn.get_paginator('list_stack_set_operation_results')
+    for page in paginator.paginate(StackSetName=stackset_name, OperationId=operation_id):
+        for summary in page['Summaries']:
+            results.append({'StackSet': stackset_name, 'Account': summary['Account'], 'Region': summary['Region'],
+                            'Status': summary['Status'], 'Reason': summary.get('StatusReason', '')})
+    return results
+
+
+
+def summarize(results):
+
+    # Group instance results per account
+    #
+    # Input: list of instance results
+    # Output: dict of account -> {'Succeeded': [regions], 'Failed': {region: reason}}
+
+    summary = {}
+    for result in results:
+        account = summary.setdefault(result['Account'], {'Succeeded': [], 'Failed': {}})
+        region = f"{result['StackSet']}/{result['Region']}"
+        if result['Status'] == 'SUCCEEDED':
+            account['Succeeded'].append(region)
+        else:
+            account['Failed'][region] = f"{result['Status']}: {result['Reason']}".rstrip(': ')
+    return summary
+
+
+
+def rollout(stackset_names, action, accounts, regions, preferences, retain_stacks=False, timeout=3600):
+
+    # Start one operation per stack set, all at the same time, and wait for them
+    #
+    # Input: stack set names, action, accounts, regions, operation preferences, flag to keep stacks on delete, seconds to wait
+    # Output: (dict of stack set name -> operation status, list of instance results)
+
+    cfn = boto3.client('cloudformation')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(stackset_names)) as executor:
+        futures = {stackset_name: executor.submit(start_operation, boto3.session.Session().client('cloudformation'), action,
+                                                  stackset_name, accounts, regions, preferences, retain_stacks)
+                   for stackset_name in stackset_names}
+    operations = {stackset_name: future.result() for stackset_name, future in futures.items()}
+
+    statuses = wait_for_operations(cfn, operations, timeout)
+    results = []
+    for stackset_name, operation_id in operations.items():
+        results.extend(get_operation_results(cfn, stackset_name, operation_id))
+    return statuses, results
+
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Create, update or delete stack instances of stack sets across many accounts and regions')
+    parser.add_argument('action', choices=const_actions, help='create or delete stack instances, or update the stack set instances')
+    parser.add_argument('--stackset', action='append', help='stack set name, can be repeated (default StackSetName environment variable)')
+    parser.add_argument('--accounts', default=os.environ.get('ChildAccountNumber'), help='comma separated account ids (default ChildAccountNumber environment variable)')
+    parser.add_argument('--organization', action='store_true', help='use every active account of the organization')
+    parser.add_argument('--regions', default=os.environ.get('Regions', 'us-east-1'), help='comma separated regions (default Regions environment variable)')
+    parser.add_argument('--max-concurrent-percentage', type=int, default=100, help='percentage of accounts deployed at the same time per region')
+    parser.add_argument('--max-concurrent-count', type=int, help='number of accounts deployed at the same time per region, instead of a percentage')
+    parser.add_argument('--failure-tolerance-percentage', type=int, default=10, help='percentage of accounts that may fail per region before the operation stops')
+    parser.add_argument('--failure-tolerance-count', type=int, help='number of accounts that may fail per region, instead of a percentage')
+    parser.add_argument('--sequential-regions', dest='parallel_regions', action='store_false', help='deploy one region after the other')
+    parser.add_argument('--retain-stacks', action='store_true', help='keep the stacks when deleting stack instances')
+    parser.add_argument('--timeout', type=int, default=3600, help='seconds to wait for the operations')
+    parser.add_argument('--json', action='store_true', help='print the summary as JSON')
+    args = parser.parse_args()
+
+    stackset_names = args.stackset or parse_list(os.environ.get('StackSetName'))
+    accounts = get_organization_accounts() if args.organization else parse_list(args.accounts)
+    regions = parse_list(args.regions)
+    if not stackset_names or not accounts or not regions:
+        parser.error('stack set names, accounts and regions are required')
+
+    preferences = get_operation_preferences(args)
+    logger.info(f"Rolling out {', '.join(stackset_names)} to {len(accounts)} accounts in {', '.join(regions)} with {json.dumps(preferences)}")
+    statuses, results = rollout(stackset_names, args.action, accounts, regions, preferences, args.retain_stacks, args.timeout)
+    summary = summarize(results)
+
+    failed = [account for account, result in summary.items() if result['Failed']]
+    missing = [account for account in accounts if account not in summary]
+    if args.json:
+        print(json.dumps({'Operations': statuses, 'Accounts': summary, 'NotStarted': missing}, indent=2))
+    else:
+        for stackset_name, status in statuses.items():
+            logger.info(f"{stackset_name}: {status}")
+        for account, result in sorted(summary.items()):
+            logger.info(f"{account}: {len(result['Succeeded'])} succeeded, {len(result['Failed'])} failed")
+            for region, reason in sorted(result['Failed'].items()):
+                logger.info(f"    {region} {reason}")
+        if missing:
+            logger.info(f"Not started (operation stopped or timed out first): {', '.join(missing)}")
+        logger.info(f"{len(summary) - len(failed)} of {len(accounts)} accounts succeeded")
+
+    if failed or missing or any(status != 'SUCCEEDED' for status in statuses.values()):
+        sys.exit(1)
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Cold start benchmark for the compliance Lambda function
+#
+# Every run starts a fresh interpreter, imports the handler module and optionally
+# invokes it twice with a recorded event, so the report splits a cold start in
+# import time, init time, first invocation and warm invocation. With --offline
+# the event is a replay scenario from events/ and AWS is served by fake_aws.py.
+#
+# usage: python cold_start.py [--runs N] [--event event.json] [--offline] [--importtime]
+
+lambda_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules that should not be loaded before they are used
+const_lazy_modules = ['huit_public_compliance_batch', 'huit_public_compliance_sweep']
+
+# environment the handler module needs to import, real values from the caller win
+const_default_env = {
+    'RoleName': 'huit-public-compliance-role',
+    'DynamoTable': 'huit-public-compliance',
+    'AWS_REGION': 'us-east-1',
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'LogLevel': 'WARNING',
+}
+
+
+class Context:
+
+    # Minimal stand-in for the Lambda context object
+
+    invoked_function_arn = 'arn:aws:lambda:us-east-1:123456789012:function:huit-public-compliance'
+
+    def get_remaining_time_in_millis(self):
+        return 900000
+
+
+
+def run_child(event_file, offline):
+
+    # Measure one cold start inside this interpreter
+    #
+    # Input: path of an event to invoke the handler with or None, flag to use the offline backend
+    # Output: dict of timings in milliseconds
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    started = time.perf_counter()
+    sys.path.insert(0, lambda_dir)
+    import huit_public_compliance
+    result = {
+        'ImportMs': (time.perf_counter() - started) * 1000,
+        'InitMs': huit_public_compliance.init_seconds * 1000,
+        'EagerModules': [name for name in const_lazy_modules if name in sys.modules],
+    }
+
+    if event_file:
+        with open(event_file) as f:
+            event = json.load(f)
+        backend = None
+        if offline:
+            # installed after the import so it is not part of the measured import time
+            import fake_aws
+            backend = fake_aws.FakeAws(event['Fixture'])
+            fake_aws.install(backend)
+            event = event['Event']
+        for label in ['FirstInvokeMs', 'WarmInvokeMs']:
+            # the warm invocation gets its own event id, so it is not skipped as a duplicate
+            event = dict(event, id=f"{event.get('id')}-{label}")
+            if backend is not None:
+                backend.reset_state()
+            started = time.perf_counter()
+            huit_public_compliance.lambda_handler(event, Context())
+            result[label] = (time.perf_counter() - started) * 1000
+
+    return result
+
+
+
+def start_child(args):
+
+    # Run one measurement in a fresh interpreter
+    #
+    # Input: parsed arguments
+    # Output: dict of timings in milliseconds
+
+    env = dict(const_default_env)
+    if args.offline:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import fake_aws
+        env.update(fake_aws.const_environment)
+        env['LogLevel'] = const_default_env['LogLevel']
+    env.update(os.environ)
+    command = [sys.executable]
+    if args.importtime:
+        command.append('-Ximporttime')
+    command += [os.path.abspath(__file__), '--child']
+    if args.event:
+        command += ['--event', args.event]
+    if args.offline:
+        command.append('--offline')
+    completed = subprocess.run(command, env=env, capture_output=True, text=True, check=True)
+    if args.importtime:
+        print_import_times(completed.stderr)
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+
+def print_import_times(stderr, top=15):
+
+    # Print the imports with the largest cumulative time
+    #
+    # Input: stderr of an interpreter started with -X importtime, number of lines
+    # Output: None
+
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative_us), name.rstrip()))
+    for cumulative_us, name in sorted(rows, reverse=True)[:top]:
+        print(f"{cumulative_us / 1000:10.1f} ms  {name}")
+
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Measure cold start of the public compliance Lambda function')
+    parser.add_argument('--runs', type=int, default=5, help='number of fresh interpreters to start')
+    parser.add_argument('--event', help='event file to invoke the handler with after the import')
+    parser.add_argument('--offline', action='store_true', help='the event is a replay scenario, served without AWS')
+    parser.add_argument('--importtime', action='store_true', help='print the slowest imports of the first run')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_child(args.event, args.offline)))
+        return
+
+    results = []
+    for n in range(args.runs):
+        results.append(start_child(args))
+        args.importtime = False
+
+    print(f"{'':16}{'min':>10}{'median':>10}{'max':>10}")
+    for label in ['ImportMs', 'InitMs', 'FirstInvokeMs', 'WarmInvokeMs']:
+        values = [result[label] for result in results if label in result]
+        if values:
+            print(f"{label:16}{min(values):10.1f}{statistics.median(values):10.1f}{max(values):10.1f}")
+    eager = sorted(set(name for result in results for name in result['EagerModules']))
+    if eager:
+        print(f"Loaded at import although only needed later: {', '.join(eager)}")
+
+
+
+if __name__ == '__main__':
+    main()
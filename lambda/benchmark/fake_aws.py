@@ -0,0 +1,348 @@
+import collections
+import datetime
+import io
+import os
+import random
+import threading
+import time
+
+import botocore.client
+from botocore.exceptions import ClientError
+
+# In-memory stand-in for the AWS APIs used by the compliance Lambda function.
+#
+# install() replaces botocore's request method, so every boto3 client and
+# resource talks to a FakeAws backend instead of the network. The backend
+# serves EC2 and RDS describe calls from a scenario fixture, keeps the state
+# table in memory, accepts writes, counts calls per service and operation,
+# and can add a simulated latency to each call.
+
+# environment the handler modules read at import, overrides from the caller are applied on top
+const_environment = {
+    'RoleName': 'HUITPublicResourceCompliance',
+    'AWS_REGION': 'us-east-1',
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'AWS_ACCESS_KEY_ID': 'testing',
+    'AWS_SECRET_ACCESS_KEY': 'testing',
+    'AWS_EC2_METADATA_DISABLED': 'true',
+    'DynamoTable': 'huit_public_compliance',
+    'StateTable': 'huit_public_compliance-state',
+    'Topic': 'arn:aws:sns:us-east-1:123456789012:huit-public-compliance',
+    'StepFunctionArn': 'arn:aws:states:us-east-1:123456789012:stateMachine:huit-public-compliance',
+    'ExceptionTag': 'Exception',
+    'ComplianceMode': 'true',
+    'SendToSNS': 'true',
+    'SendToSlack': 'false',
+    'LogLevel': 'WARNING',
+    # replays measure the handler, not the client-side rate limit
+    'ApiRateLimit': '0',
+}
+
+
+_backend = None
+_local = threading.local()
+_original_make_api_call = botocore.client.BaseClient._make_api_call
+
+
+
+def configure_environment(overrides=None):
+
+    # Set the environment the handler modules expect, before they are imported
+    #
+    # Input: optional dict of environment overrides
+    # Output: None
+
+    for key, value in const_environment.items():
+        os.environ.setdefault(key, value)
+    for key, value in (overrides or {}).items():
+        os.environ[key] = value
+
+
+
+class FakeHttpResponse:
+
+    # Minimal HTTP response handed to botocore's after-call hooks
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+        self.content = b''
+
+
+
+def _api_call(client, operation_name, api_params):
+
+    # Replacement for BaseClient._make_api_call, keeps the parameters for _make_request
+    #
+    # Input: botocore client, operation name, API parameters
+    # Output: response of the installed backend
+
+    _local.api_params = api_params
+    return _original_make_api_call(client, operation_name, api_params)
+
+
+
+def _make_request(client, operation_model, request_dict, request_context):
+
+    # Replacement for BaseClient._make_request, answers from the backend instead of sending the request
+    #
+    # Input: botocore client, operation model, serialized request, request context
+    # Output: (http response, parsed response)
+
+    try:
+        return FakeHttpResponse(200), _backend.call(client, operation_model.name, _local.api_params)
+    except ClientError as e:
+        return FakeHttpResponse(e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 400)), e.response
+
+
+
+def install(backend):
+
+    # Route all botocore API calls to a backend
+    #
+    # Parameters are still validated and serialized and the before-call and
+    # after-call hooks still run, only the HTTP request is replaced.
+    #
+    # Input: FakeAws backend
+    # Output: None
+
+    global _backend
+    _backend = backend
+    if botocore.client.BaseClient._make_request is not _make_request:
+        botocore.client.BaseClient._make_api_call = _api_call
+        botocore.client.BaseClient._make_request = _make_request
+
+
+
+def _filter_values(api_params, name):
+
+    # Get the values of a describe filter
+    #
+    # Input: API parameters, filter name
+    # Output: list of values, None if the filter is not used
+
+    for api_filter in api_params.get('Filters', []):
+        if api_filter['Name'] == name:
+            return api_filter['Values']
+    return None
+
+
+
+class FakeAws:
+
+    # In-memory AWS backend serving one scenario fixture
+
+    def __init__(self, fixture=None, latency_ms=0.0, jitter_ms=0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+        self.load(fixture or {})
+
+    def load(self, fixture):
+
+        # Replace the resources served by the backend
+        #
+        # Input: fixture with Instances, DBInstances, Subnets, Vpcs and RouteTables lists
+        # Output: None, tags written by the handler are kept in tags, by resource id or ARN
+
+        self.fixture = fixture
+        self.state = {}
+        self.audit = []
+        self.notifications = []
+        self.stopped = []
+        self.tags = {}
+        self.objects = {}
+
+    def reset_calls(self):
+
+        # Get and clear the call counts
+        #
+        # Input: None
+        # Output: dict of service.operation -> calls
+
+        with self.lock:
+            calls = dict(self.calls)
+            self.calls.clear()
+        return calls
+
+    def reset_state(self):
+
+        # Forget processed events, leases and pending remediations
+        #
+        # Input: None
+        # Output: None
+
+        with self.lock:
+            self.state.clear()
+
+    def call(self, client, operation, api_params):
+
+        # Answer one API call
+        #
+        # Input: botocore client, operation name, API parameters
+        # Output: response dict, raises the client's exceptions like the real service
+
+        service = client.meta.service_model.service_name
+        with self.lock:
+            self.calls[f"{service}.{operation}"] += 1
+        if self.latency_ms or self.jitter_ms:
+            time.sleep((self.latency_ms + random.uniform(0, self.jitter_ms)) / 1000)
+
+        handler = getattr(self, f"_{service}_{operation}", None)
+        if handler is None:
+            return {}
+        return handler(client, api_params)
+
+    def _error(self, client, code, operation):
+        # build the modeled exception of the calling client
+        return getattr(client.exceptions, code)({'Error': {'Code': code, 'Message': code}}, operation)
+
+    # STS
+
+    def _sts_AssumeRole(self, client, api_params):
+        expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+        return {'Credentials': {'AccessKeyId': 'testing', 'SecretAccessKey': 'testing', 'SessionToken': 'testing', 'Expiration': expiration}}
+
+    # EC2
+
+    def _ec2_DescribeInstances(self, client, api_params):
+        ids = api_params.get('InstanceIds') or _filter_values(api_params, 'instance-id')
+        states = _filter_values(api_params, 'instance-state-name')
+        vpcs = _filter_values(api_params, 'vpc-id')
+        instances = [instance for instance in self.fixture.get('Instances', [])
+                     if (ids is None or instance['InstanceId'] in ids) and (states is None or instance['State']['Name'] in states)
+                     and (vpcs is None or instance.get('VpcId') in vpcs)]
+        if api_params.get('InstanceIds') and not instances:
+            raise ClientError({'Error': {'Code': 'InvalidInstanceID.NotFound', 'Message': 'not found'}}, 'DescribeInstances')
+        return {'Reservations': [{'Instances': [instance]} for instance in instances]}
+
+    def _ec2_DescribeSubnets(self, client, api_params):
+        ids = api_params.get('SubnetIds')
+        return {'Subnets': [subnet for subnet in self.fixture.get('Subnets', []) if ids is None or subnet['SubnetId'] in ids]}
+
+    def _ec2_DescribeVpcs(self, client, api_params):
+        ids = api_params.get('VpcIds')
+        return {'Vpcs': [vpc for vpc in self.fixture.get('Vpcs', []) if ids is None or vpc['VpcId'] in ids]}
+
+    def _ec2_DescribeRouteTables(self, client, api_params):
+        ids = api_params.get('RouteTableIds')
+        vpcs = _filter_values(api_params, 'vpc-id')
+        return {'RouteTables': [table for table in self.fixture.get('RouteTables', [])
+                                if (ids is None or table['RouteTableId'] in ids) and (vpcs is None or table['VpcId'] in vpcs)]}
+
+    def _ec2_CreateTags(self, client, api_params):
+        with self.lock:
+            for resource_id in api_params['Resources']:
+                self.tags.setdefault(resource_id, {}).update({tag['Key']: tag['Value'] for tag in api_params['Tags']})
+        return {}
+
+    def _ec2_StopInstances(self, client, api_params):
+        self.stopped.extend(api_params['InstanceIds'])
+        return {'StoppingInstances': [{'InstanceId': instanceid} for instanceid in api_params['InstanceIds']]}
+
+    # RDS
+
+    def _rds_DescribeDBInstances(self, client, api_params):
+        ids = [api_params['DBInstanceIdentifier']] if 'DBInstanceIdentifier' in api_params else _filter_values(api_params, 'db-instance-id')
+        db_instances = [db_instance for db_instance in self.fixture.get('DBInstances', []) if ids is None or db_instance['DBInstanceIdentifier'] in ids]
+        if 'DBInstanceIdentifier' in api_params and not db_instances:
+            raise self._error(client, 'DBInstanceNotFoundFault', 'DescribeDBInstances')
+        return {'DBInstances': db_instances}
+
+    def _rds_ListTagsForResource(self, client, api_params):
+        for db_instance in self.fixture.get('DBInstances', []):
+            if db_instance['DBInstanceArn'] == api_params['ResourceName']:
+                return {'TagList': db_instance.get('TagList', [])}
+        return {'TagList': []}
+
+    def _rds_AddTagsToResource(self, client, api_params):
+        with self.lock:
+            self.tags.setdefault(api_params['ResourceName'], {}).update({tag['Key']: tag['Value'] for tag in api_params['Tags']})
+        return {}
+
+    def _rds_StopDBInstance(self, client, api_params):
+        self.stopped.append(api_params['DBInstanceIdentifier'])
+        return {}
+
+    # DynamoDB, the state table keeps conditional write semantics
+
+    def _dynamodb_BatchWriteItem(self, client, api_params):
+        for table, requests in api_params['RequestItems'].items():
+            items = [request['PutRequest']['Item'] for request in requests]
+            if table == os.environ.get('StateTable'):
+                with self.lock:
+                    self.state.update((self._state_key(item), item) for item in items)
+            else:
+                self.audit.extend(items)
+        return {'UnprocessedItems': {}}
+
+    def _dynamodb_BatchGetItem(self, client, api_params):
+        responses = {}
+        for table, request in api_params['RequestItems'].items():
+            items = [self.state.get(self._state_key(key)) for key in request['Keys']]
+            responses[table] = [item for item in items if item is not None]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+    def _dynamodb_Scan(self, client, api_params):
+        # filters are not applied, the audit records are returned in one page
+        return {'Items': list(self.audit), 'Count': len(self.audit), 'ScannedCount': len(self.audit)}
+
+    def _state_key(self, key):
+        return (key['Pk']['S'], key['Sk']['S'])
+
+    def _check_condition(self, client, api_params, current):
+        # supports the condition expressions written by the state module
+        condition = api_params.get('ConditionExpression')
+        if not condition:
+            return
+        values = api_params.get('ExpressionAttributeValues', {})
+        passed = False
+        if 'attribute_not_exists' in condition and current is None:
+            passed = True
+        if 'ExpiresAt <' in condition and current is not None and int(current['ExpiresAt']['N']) < int(values[':now']['N']):
+            passed = True
+        if 'Owner =' in condition and current is not None and current.get('Owner') == values[':owner']:
+            passed = True
+        if not passed:
+            raise self._error(client, 'ConditionalCheckFailedException', 'PutItem')
+
+    def _dynamodb_PutItem(self, client, api_params):
+        key = self._state_key(api_params['Item'])
+        with self.lock:
+            self._check_condition(client, api_params, self.state.get(key))
+            self.state[key] = api_params['Item']
+        return {}
+
+    def _dynamodb_GetItem(self, client, api_params):
+        item = self.state.get(self._state_key(api_params['Key']))
+        return {'Item': item} if item is not None else {}
+
+    def _dynamodb_DeleteItem(self, client, api_params):
+        key = self._state_key(api_params['Key'])
+        with self.lock:
+            self._check_condition(client, api_params, self.state.get(key))
+            self.state.pop(key, None)
+        return {}
+
+    # S3, objects are kept in memory by bucket and key
+
+    def _s3_PutObject(self, client, api_params):
+        body = api_params['Body']
+        self.objects[(api_params['Bucket'], api_params['Key'])] = body.read() if hasattr(body, 'read') else body
+        return {}
+
+    def _s3_GetObject(self, client, api_params):
+        body = self.objects.get((api_params['Bucket'], api_params['Key']))
+        if body is None:
+            raise self._error(client, 'NoSuchKey', 'GetObject')
+        return {'Body': io.BytesIO(body)}
+
+    # notifications and orchestration
+
+    def _sns_Publish(self, client, api_params):
+        self.notifications.append(api_params['Message'])
+        return {'MessageId': str(len(self.notifications))}
+
+    def _stepfunctions_StartExecution(self, client, api_params):
+        return {'executionArn': f"{api_params['stateMachineArn']}:{len(self.calls)}", 'startDate': datetime.datetime.now(datetime.timezone.utc)}
@@ -0,0 +1,202 @@
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import shutil
+import sys
+import time
+import uuid
+
+# Offline replay benchmark for the compliance Lambda function
+#
+# Replays the recorded events in events/ through lambda_handler against the
+# in-memory AWS backend of fake_aws.py, so no network or AWS account is
+# needed. Each scenario reports latency percentiles and the AWS calls made
+# per invocation, and fails when the handler's verdict or the instances it
+# stops differ from what the scenario expects.
+#
+# usage: python replay.py [--iterations N] [--latency-ms MS] [--jitter-ms MS] [--cold-caches] [--snapshot-dir DIR] [--json out.json] [scenario ...]
+
+benchmark_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(benchmark_dir))
+
+import fake_aws
+
+fake_aws.configure_environment()
+
+import huit_public_compliance
+import huit_public_compliance_names
+import huit_public_compliance_network
+import huit_public_compliance_snapshot
+import huit_public_compliance_utils
+
+
+class Context:
+
+    # Minimal stand-in for the Lambda context object
+
+    invoked_function_arn = 'arn:aws:lambda:us-east-1:123456789012:function:huit-public-compliance'
+
+    def get_remaining_time_in_millis(self):
+        return 900000
+
+
+
+def percentile(values, pct):
+
+    # Nearest-rank percentile
+    #
+    # Input: list of values, percentile between 0 and 100
+    # Output: value
+
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+
+
+def load_scenarios(names):
+
+    # Load the scenario files from the events folder
+    #
+    # Input: scenario names, all scenarios if empty
+    # Output: list of (name, scenario)
+
+    scenarios = []
+    for path in sorted(glob.glob(os.path.join(benchmark_dir, 'events', '*.json'))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        if names and name not in names:
+            continue
+        with open(path) as f:
+            scenarios.append((name, json.load(f)))
+    return scenarios
+
+
+
+def clear_caches():
+
+    # Drop the credential pool, subnet indexes, names and network snapshots kept between warm invocations
+    #
+    # Input: None
+    # Output: None
+
+    huit_public_compliance_utils._credential_pool.clear()
+    with huit_public_compliance_names._name_cache_lock:
+        huit_public_compliance_names._name_cache.clear()
+    with huit_public_compliance_network._subnet_index_lock:
+        huit_public_compliance_network._subnet_index.clear()
+    with huit_public_compliance_snapshot._snapshots_lock:
+        huit_public_compliance_snapshot._snapshots.clear()
+        huit_public_compliance_snapshot._changes.clear()
+
+
+
+def run_scenario(backend, name, scenario, iterations, cold_caches):
+
+    # Replay one scenario
+    #
+    # Input: backend, scenario name, scenario, iterations, flag to start every iteration with empty caches
+    # Output: scenario report
+
+    backend.load(scenario['Fixture'])
+    clear_caches()
+    if huit_public_compliance_snapshot.snapshot_dir:
+        # snapshots of the previous scenario describe another topology
+        shutil.rmtree(huit_public_compliance_snapshot.snapshot_dir, ignore_errors=True)
+    expect = scenario.get('Expect', {})
+    latencies = []
+    calls = {}
+    errors = []
+
+    for n in range(iterations):
+        if cold_caches:
+            clear_caches()
+        # a fresh event id and state table so dedup and leases do not skip the replay
+        backend.reset_state()
+        backend.stopped.clear()
+        backend.reset_calls()
+        event = dict(scenario['Event'], id=str(uuid.uuid4()))
+
+        # the embedded metrics the handler prints are part of the cost, but not of the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            started = time.perf_counter()
+            response = huit_public_compliance.lambda_handler(event, Context())
+            latencies.append((time.perf_counter() - started) * 1000)
+
+        invocation_calls = backend.reset_calls()
+        for operation, count in invocation_calls.items():
+            calls[operation] = calls.get(operation, 0) + count
+        if 'InstanceStopped' in expect and response.get('InstanceStopped') != expect['InstanceStopped']:
+            errors.append(f"iteration {n}: InstanceStopped is {response.get('InstanceStopped')}, expected {expect['InstanceStopped']}")
+        if 'Stopped' in expect and sorted(backend.stopped) != sorted(expect['Stopped']):
+            errors.append(f"iteration {n}: stopped {backend.stopped}, expected {expect['Stopped']}")
+        if response.get('batchItemFailures'):
+            errors.append(f"iteration {n}: {len(response['batchItemFailures'])} messages failed")
+        for operation, count in expect.get('Calls', {}).items():
+            if invocation_calls.get(operation, 0) != count:
+                errors.append(f"iteration {n}: {invocation_calls.get(operation, 0)} {operation} calls, expected {count}")
+
+    return {
+        'Scenario': name,
+        'Iterations': iterations,
+        'LatencyMs': {label: percentile(latencies, pct) for label, pct in [('p50', 50), ('p90', 90), ('p99', 99), ('max', 100)]},
+        'CallsPerInvocation': {operation: count / iterations for operation, count in sorted(calls.items())},
+        'Errors': errors[:5],
+    }
+
+
+
+def print_report(reports):
+
+    # Print the scenario reports as a table
+    #
+    # Input: list of scenario reports
+    # Output: None
+
+    print(f"{'scenario':24}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}{'calls':>8}  result")
+    for report in reports:
+        latency = report['LatencyMs']
+        total = sum(report['CallsPerInvocation'].values())
+        result = 'FAIL' if report['Errors'] else 'ok'
+        print(f"{report['Scenario']:24}{latency['p50']:10.2f}{latency['p90']:10.2f}{latency['p99']:10.2f}{latency['max']:10.2f}{total:8.1f}  {result}")
+    for report in reports:
+        print(f"\n{report['Scenario']}")
+        for operation, count in report['CallsPerInvocation'].items():
+            print(f"    {operation:40}{count:8.2f}")
+        for error in report['Errors']:
+            print(f"    ERROR {error}")
+
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Replay recorded events through the public compliance Lambda function without AWS')
+    parser.add_argument('scenarios', nargs='*', help='scenario names from the events folder, all by default')
+    parser.add_argument('--iterations', type=int, default=50, help='invocations per scenario')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='simulated latency of every AWS call')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='random latency added on top of --latency-ms')
+    parser.add_argument('--cold-caches', action='store_true', help='clear credential and subnet caches before every invocation')
+    parser.add_argument('--snapshot-dir', help='keep network snapshots in this directory, emptied before every scenario')
+    parser.add_argument('--json', help='also write the reports to this file')
+    args = parser.parse_args()
+    if args.snapshot_dir:
+        huit_public_compliance_snapshot.snapshot_dir = args.snapshot_dir
+
+    backend = fake_aws.FakeAws(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms)
+    fake_aws.install(backend)
+
+    reports = [run_scenario(backend, name, scenario, args.iterations, args.cold_caches) for name, scenario in load_scenarios(args.scenarios)]
+    print_report(reports)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(reports, f, indent=2)
+
+    if any(report['Errors'] for report in reports):
+        sys.exit(1)
+
+
+
+if __name__ == '__main__':
+    main()
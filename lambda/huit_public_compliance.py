@@ -1,13 +1,27 @@
-import boto3
 import logging
 import os
 import json
+import time
 
-from huit_public_compliance_utils import get_handles
+# start of the init phase, imports below are included in the measured init time
+_init_started = time.perf_counter()
+
+from huit_public_compliance_utils import get_handles, get_local_client, get_event_region, utc_timestamp
 from huit_public_compliance_remediate import remediate_and_notify
+from huit_public_compliance_network import is_subnet_public
+from huit_public_compliance_names import get_cached_name
+from huit_public_compliance_audit import flush_audit_records
+from huit_public_compliance_notify import flush_notifications, outbox_handler, digest_handler
+from huit_public_compliance_metrics import start_invocation, set_event_type, emit_metrics
+from huit_public_compliance_snapshot import flush_snapshots
+from huit_public_compliance_throttle import RetryableError, is_retryable
+from huit_public_compliance_state import is_state_enabled, save_pending_remediation
+from huit_public_compliance_state import get_pending_remediation, delete_pending_remediation
+from huit_public_compliance_state import is_event_processed, mark_event_processed, acquire_lease, release_lease
 
 from huit_public_compliance_utils import const_resource_type_ec2
 from huit_public_compliance_utils import const_resource_type_rds
+from huit_public_compliance_utils import const_resource_type_network
 from huit_public_compliance_utils import const_resource_type_unknown
 
 
@@ -18,16 +32,35 @@ logger = logging.getLogger(__name__)
 trueval = ['true', 'True', 'yes', 'Yes']
 compliancemode = os.environ.get('ComplianceMode') in trueval
 exception = os.environ.get('ExceptionTag')
+
+# test stacks only: instances carrying this tag key use its value as their compliance mode
+compliance_override_tag = os.environ.get('ComplianceModeOverrideTag')
 step_function_arn = os.environ.get('StepFunctionArn')
 
+# backstop timer for RDS instances waiting to be stoppable, doubled after every check
+backstop_seconds = int(os.environ.get('BackstopSeconds', 300))
+backstop_max_seconds = int(os.environ.get('BackstopMaxSeconds', 3600))
+
+# RDS events that only resume a pending remediation, for instances that just became available
+rds_drain_events = ['RDS-EVENT-0002']
+
+# CloudTrail API calls that can make a subnet public, the instances of the affected subnets are re-evaluated
+route_change_events = ['CreateRoute', 'ReplaceRoute', 'AssociateRouteTable', 'ReplaceRouteTableAssociation']
+
+# init phase settings
+loglevel = os.environ.get('LogLevel', logging.INFO)
+prewarm_clients = os.environ.get('PrewarmClients', 'true') in trueval
+init_seconds = 0.0
+cold_start = True
 
 
 
-def check_if_public(client, vpcid, subnets):
+
+def check_if_public(client, accountid, vpcid, subnets):
     
   # Check if instance is in public subnet
   #
-  # Input: EC2 client, vpcid and subnetid
+  # Input: EC2 client, account id, vpcid and subnetids
   # Output: True if in public subnet, false otherwise
 
   logger.info("Checking route tables for public egress")
@@ -38,38 +71,17 @@ def check_if_public(client, vpcid, subnets):
   # https://docs.aws.amazon.com/AmazonRDS/latest/UserGuide/USER_VPC.WorkingWithRDSInstanceinaVPC.html
   #
   # HOWEVER, after testing, this is not the case; can actually mix private and public subnets in a subnet group
-  # so we'll cycle through all the subnets
+  # so we'll cycle through all the subnets, using the cached public subnet index for the VPC
 
-  # cycle through route tables to see if an igw is attached
   found = False
-  n = 0
-  while n < len(subnets) and not found:
-    subnetid = subnets[n]
-    vpcroutetable = False
-    rt = client.describe_route_tables(Filters=[{'Name':'association.subnet-id','Values': [subnetid]}])
-    if len(rt['RouteTables']) == 0:
-      # this subnet is associated with the main VPC route table
-      logger.info("Instance is using the default VPC route table")
-      vpcroutetable = True
-      rt = client.describe_route_tables(Filters=[{'Name':'vpc-id','Values': [vpcid]}])
-
-    logger.info("Iterating through route tables")
-    # Iterate through the route tables looking for an igw
-    for ra in rt['RouteTables']:
-      if found:
-        break
-      if vpcroutetable == False or (ra['Associations'][0]['Main'] == True):
-        route = ra['Routes']
-        for i in route:
-          gid = i.get('GatewayId', '')
-          destinationcidr = i.get('DestinationCidrBlock', '')
-          if gid.startswith('igw-') and destinationcidr == '0.0.0.0/0':
-            # Found igw attached - this is a public subnet
-            logger.info(f"Found igw connected to subnet for route {i}")
-            found = True
-            break
-          else:
-            logger.info(f"No public path for route {i}")
+  for subnetid in subnets:
+    if is_subnet_public(client, accountid, vpcid, subnetid):
+      # Found igw attached - this is a public subnet
+      logger.info(f"Found igw connected to subnet {subnetid}")
+      found = True
+      break
+    else:
+      logger.info(f"No public path for subnet {subnetid}")
 
   if found:
     logger.info("Instance IS in public subnet")
@@ -81,6 +93,375 @@ def check_if_public(client, vpcid, subnets):
     
 
 
+def get_resource_type(event):
+
+  # Determine which kind of resource an AWS event refers to
+  #
+  # Input: AWS event
+  # Output: resource type constant, unknown if the event is not processed
+
+  # only need to process a limited set of events, for now only EC2 and RDS
+  resource_type = const_resource_type_unknown
+  if event['source'] == 'aws.ec2' and event['detail-type'] == 'EC2 Instance State-change Notification':
+    resource_type = const_resource_type_ec2
+  elif event['source'] == 'aws.rds' and event['detail-type'] == 'RDS DB Instance Event':
+    rds_events = ['RDS-EVENT-0005', 'RDS-EVENT-0088', 'RDS-EVENT-0154'] + rds_drain_events
+    rds_event = event['detail']['EventID']
+    if rds_event in rds_events:
+      resource_type = const_resource_type_rds
+      if rds_event == 'RDS-EVENT-0002':
+        logger.info("Processing RDS Backup Finished event")
+      elif rds_event == 'RDS-EVENT-0005':
+        logger.info("Processing RDS Created event")
+      elif rds_event == 'RDS-EVENT-0088':
+        logger.info("Processing RDS Started event")
+      elif rds_event == 'RDS-EVENT-0154':
+        logger.info("Processing RDS Started Due to Exceeding Allowed Time to be Stopped event")
+    elif event['detail']['Message'] == 'Finished moving DB instance to target VPC':
+      # Not sure why AWS is sending this without an event ID
+      resource_type = const_resource_type_rds
+      logger.info("Processing RDS moved VPC event")
+  elif event['source'] == 'aws.ec2' and event['detail-type'] == 'AWS API Call via CloudTrail':
+    if event['detail'].get('eventName') in route_change_events:
+      resource_type = const_resource_type_network
+      logger.info(f"Processing {event['detail']['eventName']} route change event")
+
+  return resource_type
+
+
+
+
+def get_instance_id(event, resource_type):
+
+  # Get the EC2 instance id or RDS DB identifier an event refers to
+  #
+  # Input: AWS event, resource type
+  # Output: instance id
+
+  if resource_type == const_resource_type_ec2:
+    return event['detail']['instance-id']
+  return event['detail']['SourceIdentifier']
+
+
+
+
+def is_drain_only_event(event):
+
+  # Check if an event is only used to resume pending remediations
+  #
+  # Input: AWS event
+  # Output: True if the event should not trigger an evaluation
+
+  return event['detail'].get('EventID') in rds_drain_events
+
+
+
+
+def wait_for_stoppable(instance_params, notify_params, tag_params, db_params):
+
+  # Park a remediation until the RDS instance can be stopped
+  #
+  # Input: parameters of the remediation
+  # Output: None
+
+  parameters = {'InstanceParameters': instance_params, 'NotificationParameters': notify_params, 'TagParameters': tag_params, 'DBParameters': db_params}
+  saved = not is_state_enabled() or save_pending_remediation(parameters)
+
+  # the pending remediation now guards the instance, let the next RDS event resume it
+  release_lease(instance_params['AccountId'], instance_params.get('Region'), instance_params['InstanceId'])
+  if not saved:
+    logger.info("Remediation already pending for this instance")
+    return
+
+  # the step function is only a backstop for missed events, RDS events normally resume the remediation
+  logger.info("Triggering step function")
+  parameters['InstanceState'] = {'InstanceStopped': False, 'WaitSeconds': backstop_seconds}
+  client = get_local_client('stepfunctions')
+  client.start_execution(stateMachineArn = step_function_arn, input = json.dumps(parameters))
+  logger.info("Waiting")
+
+
+
+
+def resume_pending_remediation(accountid, region, instanceid):
+
+  # Stop an instance whose remediation was waiting for it to become stoppable
+  #
+  # Input: account id, region, instance id
+  # Output: None if nothing is pending, otherwise True if the instance was stopped
+
+  if not is_state_enabled():
+    return None
+  parameters = get_pending_remediation(accountid, region, instanceid)
+  if parameters is None:
+    return None
+  if not acquire_lease(accountid, region, instanceid):
+    return False
+
+  logger.info(f"Resuming pending remediation for {instanceid}")
+  try:
+    stopped = remediate_and_notify(True, False, parameters['InstanceParameters'], parameters['NotificationParameters'], parameters['TagParameters'], parameters['DBParameters'])
+  except Exception:
+    release_lease(accountid, region, instanceid)
+    raise
+
+  # once stopped, the lease is kept so events following this one are suppressed
+  if stopped:
+    delete_pending_remediation(accountid, region, instanceid)
+  else:
+    release_lease(accountid, region, instanceid)
+  return stopped
+
+
+
+
+def enrich_instance(accountid, details, ec2_client):
+
+  # Get the public verdict, and the names used in messages from the name cache so they never delay it
+  #
+  # Input: account id, instance details, EC2 client
+  # Output: (public verdict, VPC name, subnet name), names are the raw ids until the cache is filled
+
+  vpcid = details['VpcId']
+  vpcname = get_cached_name(ec2_client, accountid, vpcid)
+  subnetname = details['SubnetName'] or get_cached_name(ec2_client, accountid, details['Subnets'][0])
+  is_public = check_if_public(ec2_client, accountid, vpcid, details['Subnets'])
+  return is_public, vpcname, subnetname
+
+
+
+
+def get_ec2_details(ec2_client, instance):
+
+  # Extract what is needed to evaluate an EC2 instance
+  #
+  # Input: EC2 client, instance as returned by describe_instances
+  # Output: instance details, SubnetName is None since it comes from the name cache
+
+  subnets = [instance['SubnetId']]
+  subnetname = None
+
+  details = {}
+  details['InstanceId'] = instance['InstanceId']
+  details['VpcId'] = instance['VpcId']
+  details['Subnets'] = subnets
+  details['SubnetName'] = subnetname
+  details['InstanceTags'] = instance.get('Tags')
+  return details
+
+
+
+
+def get_rds_details(rds_client, db_instance):
+
+  # Extract what is needed to evaluate an RDS instance
+  #
+  # Input: RDS client, DB instance as returned by describe_db_instances
+  # Output: instance details
+
+  subnets = []
+  for subnet in db_instance['DBSubnetGroup']['Subnets']:
+    subnets.append(subnet['SubnetIdentifier'])
+  instance_arn = db_instance['DBInstanceArn']
+  if 'TagList' in db_instance:
+    instancetags = db_instance['TagList']
+  else:
+    instancetags = rds_client.list_tags_for_resource(ResourceName=instance_arn)['TagList']
+
+  details = {}
+  details['InstanceId'] = db_instance['DBInstanceIdentifier']
+  details['InstanceArn'] = instance_arn
+  details['VpcId'] = db_instance['DBSubnetGroup']['VpcId']
+  details['Subnets'] = subnets
+  details['SubnetName'] = db_instance['DBSubnetGroup']['DBSubnetGroupName']
+  details['InstanceTags'] = instancetags
+  return details
+
+
+
+
+def get_tag_settings(details, compliancemode):
+
+  # Read the name, scaling group, exception and compliance mode override tags of an instance
+  #
+  # Input: instance details, compliance mode
+  # Output: (instance name, autoscaling group name or 'None', True if the exception tag is set, compliance mode for this instance)
+
+  instancename = details['InstanceId']
+  autoscalegroupname = 'None'
+  is_exception = False
+
+  if details['InstanceTags'] is not None:
+    for tag in details['InstanceTags']:
+      if tag['Key'] == 'Name':
+        instancename = tag['Value']
+      if tag['Key'] == exception:
+        is_exception = True
+      if tag['Key'] == 'aws:autoscaling:groupName':
+        autoscalegroupname = tag['Value']
+      if compliance_override_tag and tag['Key'] == compliance_override_tag:
+        compliancemode = tag['Value'] in trueval
+        logger.info(f"Compliance mode set to {compliancemode} by tag {compliance_override_tag}")
+
+  return instancename, autoscalegroupname, is_exception, compliancemode
+
+
+
+
+def get_db_params(accountid, resource_type, details, instancename, autoscalegroupname, vpcname, subnetname, verdict_time):
+
+  # Initialize the audit record of an instance found in a public subnet
+  #
+  # Input: account id, resource type, instance details, names, verdict time
+  # Output: DynamoDB parameters, DateTime and Action are set by the remediation
+
+  db_params = {}
+  db_params['AccountId'] = accountid
+  db_params['DateTime'] = "$currtime$"
+  db_params['VpcName'] = vpcname
+  db_params['SubnetName'] = subnetname
+  db_params['InstanceId'] = details['InstanceId']
+  db_params['InstanceName'] = instancename
+  db_params['AutoScaleGroupName'] = autoscalegroupname
+  db_params['ResourceType'] = resource_type.upper()
+  db_params['EventTime'] = details['EventTime']
+  db_params['HandlerStartTime'] = details.get('HandlerStartTime', verdict_time)
+  db_params['VerdictTime'] = verdict_time
+  return db_params
+
+
+
+
+def evaluate_instance(accountid, resource_type, details, ec2_client, compliancemode, leased=False, finding=None):
+
+  # Check an instance for public subnets, then tag, stop and notify as required
+  #
+  # Input: account id, resource type, instance details, EC2 client, compliance mode, flag set when the caller holds the lease,
+  #        optional id of the finding, a finding already processed is not tagged, audited and notified again unless it is stopped
+  # Output: True if the instance was remediated, False otherwise
+
+  instanceid = details['InstanceId']
+  instance_arn = details['InstanceArn']
+
+  logger.info("Processing tags")
+  instancename, autoscalegroupname, is_exception, compliancemode = get_tag_settings(details, compliancemode)
+
+  logger.info("Checking route tables")
+  is_public, vpcname, subnetname = enrich_instance(accountid, details, ec2_client)
+  verdict_time = utc_timestamp()
+
+  logger.info(f"Instance is in VPC {vpcname}, subnet {subnetname}")
+
+  if not is_public:
+    logger.info(f"{resource_type.upper()} instance is not in public subnet")
+    # a route change can make the subnet public right after this verdict, its re-evaluation must not be skipped
+    if leased:
+      release_lease(accountid, ec2_client.meta.region_name, instanceid)
+    return False
+
+
+  # the instance keeps running in audit mode or with an exception tag, it was already reported
+  if finding is not None and (is_exception or not compliancemode) and is_event_processed(finding):
+    logger.info(f"{resource_type.upper()} instance {instanceid} in public subnet was already reported")
+    return False
+
+  # Initialize info to send to DynamoDB
+  db_params = get_db_params(accountid, resource_type, details, instancename, autoscalegroupname, vpcname, subnetname, verdict_time)
+
+
+  # Create sub-messages
+  if resource_type == const_resource_type_ec2:
+    instance_msg = f"instance {instancename} ({instanceid})"
+  else:
+    instance_msg = f"instance {instancename}"
+
+  if autoscalegroupname == 'None':
+    asg_msg = ""
+  else:
+    asg_msg = f" in autoscalinggroup {autoscalegroupname}"
+
+  if is_exception:
+    exception_tag_msg = " with an exception tag"
+  else:
+    exception_tag_msg = ""
+
+  # Create the messages, tags, etc...
+  if is_exception or not compliancemode:
+    # System is in audit mode OR instance has an exception tag - just tag
+    logger.info(f"Found {resource_type.upper()} instance in public subnet{exception_tag_msg}")
+    tag_value = f"Out of Compliance on $currtime$ because instance is in public subnet. {'Exception applied.' if is_exception else ''}"
+    subject = f"WARNING: {resource_type.upper()} detected in public subnet{exception_tag_msg}."
+    message = f"{resource_type.upper()} {instance_msg}{asg_msg} in account {accountid} was detected running in public subnet {subnetname}, VPC {vpcname} on $currtime${exception_tag_msg}."
+    if is_exception:
+      db_params['Action'] = "None, exception tag found"
+    else:
+      db_params['Action'] = "None, in audit mode"
+
+  else:
+    # Running in compliance mode and found instance in public subnet
+    logger.info(f"In compliance mode. Adding tag and stopping {resource_type.upper()} instance.")
+    tag_value = f"Stopped on $currtime$ because instance is in public subnet"
+    subject = f"{resource_type.upper()} instance in public subnet STOPPED"
+    message = f"{resource_type.upper()} {instance_msg}{asg_msg} in account {accountid} was stopped because it was running in public subnet {subnetname}, VPC {vpcname} on $currtime$"
+    db_params['Action'] = "Instance stopped"
+
+  tag_params = {}
+  tag_params['Key'] = 'HUIT Compliance'
+  tag_params['Value'] = tag_value
+
+  notify_params = {}
+  notify_params['Subject'] = subject
+  notify_params['Message'] = message
+
+  instance_params = {}
+  instance_params['AccountId'] = accountid
+  instance_params['Region'] = ec2_client.meta.region_name
+  instance_params['InstanceId'] = instanceid
+  instance_params['InstanceArn'] = instance_arn
+  instance_params['ResourceType'] = resource_type
+
+
+  done = remediate_and_notify(compliancemode, is_exception, instance_params, notify_params, tag_params, db_params)
+  if not done:
+    wait_for_stoppable(instance_params, notify_params, tag_params, db_params)
+  else:
+    logger.info("Done")
+
+  return done
+
+
+
+
+def get_batch_failures(event):
+
+  # Get the partial batch response that retries every record of an SQS or DynamoDB stream batch
+  #
+  # Input: SQS or DynamoDB stream event
+  # Output: partial batch response
+
+  records = event['Records']
+  if records[0].get('eventSource') == 'aws:dynamodb':
+    # a stream is retried from the first record listed
+    return {'batchItemFailures': [{'itemIdentifier': records[0]['dynamodb']['SequenceNumber']}]}
+  return {'batchItemFailures': [{'itemIdentifier': record['messageId']} for record in records]}
+
+
+
+
+def write_audit_records():
+
+  # Write the buffered audit records before the events that produced them are marked processed
+  #
+  # Input: None
+  # Output: None, raises RetryableError if a record could not be written
+
+  # a lost audit record fails the event, its redelivery evaluates the resource and writes the record again
+  if not flush_audit_records():
+    raise RetryableError("Unable to write the audit records of this event")
+
+
+
+
 def lambda_handler(event, context):
     
   # Lambda handler to manage events from CloudWatch
@@ -88,60 +469,81 @@ def lambda_handler(event, context):
   # Input: AWS event, context objects
   # Output: None
 
+  leased = False
+  handler_started = utc_timestamp()
+  start_invocation()
   try:
 
-    # set log level according to environment variable
-    loglevel = os.environ.get('LogLevel', logging.INFO)
-    logging.basicConfig(level=loglevel)
-    logger.setLevel(loglevel)
+    global cold_start
+    if cold_start:
+      logger.info(f"Cold start, init took {init_seconds * 1000:.0f} ms")
+      cold_start = False
 
     # get information from event object
     logger.info('Event: ' + str(event))
 
+    # new audit records are counted into the per-account rollups
+    if event.get('Records') and event['Records'][0].get('eventSource') == 'aws:dynamodb':
+      set_event_type('Rollup')
+      from huit_public_compliance_rollup import stream_handler
+      return stream_handler(event, context)
+
+    # batches of events buffered through SQS are handled separately
+    if 'Records' in event:
+      set_event_type('Batch')
+      from huit_public_compliance_batch import batch_handler
+      return batch_handler(event, context)
+
+    # scheduled reconciliation sweep across the organization
+    if 'Sweep' in event:
+      set_event_type('Sweep')
+      from huit_public_compliance_sweep import sweep_handler
+      return sweep_handler(event, context)
+
+    # retry notifications that could not be delivered
+    if 'NotificationOutbox' in event:
+      set_event_type('NotificationOutbox')
+      return outbox_handler(event, context)
+
+    # send the findings queued for the notification digest
+    if 'NotificationDigest' in event:
+      set_event_type('NotificationDigest')
+      return digest_handler(event, context)
+
     # first check if it is a callback from step function
     if 'InstanceParameters' in event:
       # Callback from stepfunction
+      set_event_type('StepFunction')
       logger.info(f"Processing input from step function: {json.dumps(event)}")
       instance_params = event['InstanceParameters']
       notify_params = event['NotificationParameters']
       tag_params = event['TagParameters']
       db_params = event['DBParameters']
 
-      stopped = remediate_and_notify(True, False, instance_params, notify_params, tag_params, db_params)
-      response = {'InstanceStopped': stopped}
+      try:
+        if is_state_enabled():
+          stopped = resume_pending_remediation(instance_params['AccountId'], instance_params.get('Region'), instance_params['InstanceId'])
+          if stopped is None:
+            logger.info("Remediation was already completed by an RDS event")
+            stopped = True
+        else:
+          stopped = remediate_and_notify(True, False, instance_params, notify_params, tag_params, db_params)
+      except Exception as e:
+        # the Wait state needs WaitSeconds, a failed or throttled check is tried again at the next one
+        logger.error(f"Step function check of {instance_params['InstanceId']} failed: {e}")
+        stopped = False
+
+      # back off the next check
+      wait_seconds = event.get('InstanceState', {}).get('WaitSeconds', backstop_seconds)
+      response = {'InstanceStopped': stopped, 'WaitSeconds': min(wait_seconds * 2, backstop_max_seconds)}
       logger.info(f"Response: {json.dumps(response)}")
       return response
 
     # Otherwise, continue and process AWS events
     accountid = event['account']
-    detail = event['detail']
-    etime = event['time']
-
-    # define global flags
-    is_public = False
-    is_exception = False
-
-    # only need to process a limited set of events, for now only EC2 and RDS
-    resource_type = const_resource_type_unknown
-    if event['source'] == 'aws.ec2' and event['detail-type'] == 'EC2 Instance State-change Notification':
-      resource_type = const_resource_type_ec2
-    elif event['source'] == 'aws.rds' and event['detail-type'] == 'RDS DB Instance Event':
-      rds_events = ['RDS-EVENT-0005', 'RDS-EVENT-0088', 'RDS-EVENT-0154']
-      rds_event = event['detail']['EventID']
-      if rds_event in rds_events:
-        resource_type = const_resource_type_rds
-        if rds_event == 'RDS-EVENT-0005':
-          logger.info("Processing RDS Created event")
-        elif rds_event == 'RDS-EVENT-0088':
-          logger.info("Processing RDS Started event")
-        elif rds_event == 'RDS-EVENT-0154':
-          logger.info("Processing RDS Started Due to Exceeding Allowed Time to be Stopped event")
-      elif event['detail']['Message'] == 'Finished moving DB instance to target VPC':
-        # Not sure why AWS is sending this without an event ID
-        resource_type = const_resource_type_rds
-        logger.info("Processing RDS moved VPC event")
-
 
+    resource_type = get_resource_type(event)
+    set_event_type(resource_type.upper())
     if resource_type == const_resource_type_unknown:
       logger.info('Invalid event. Exiting.')
       response = {'InstanceStopped': False}      
@@ -151,159 +553,110 @@ def lambda_handler(event, context):
     # re-read compliance mode in case it changes
     compliancemode = os.environ.get('ComplianceMode') in trueval
 
-    # set default values
-    autoscalegroupname = 'None'
-
+    # route changes re-evaluate the instances of the subnets they made public
+    if resource_type == const_resource_type_network:
+      from huit_public_compliance_routes import route_change_handler
+      return route_change_handler(event, compliancemode, handler_started)
+
+    instanceid = get_instance_id(event, resource_type)
+    region = get_event_region(event)
+
+    # duplicate events stop here, before any cross-account call
+    if is_event_processed(event.get('id')):
+      logger.info(f"Event {event.get('id')} was already processed. Exiting.")
+      return {'InstanceStopped': False}
+
+    if resource_type == const_resource_type_rds:
+      # an RDS event for an instance waiting to be stopped resumes its remediation
+      resumed = resume_pending_remediation(accountid, region, instanceid)
+      if resumed is not None:
+        write_audit_records()
+        mark_event_processed(event.get('id'))
+        return {'InstanceStopped': resumed}
+      if is_drain_only_event(event):
+        logger.info(f"No pending remediation for DB identifier {instanceid}. Exiting.")
+        return {'InstanceStopped': False}
+
+    # only one invocation evaluates a resource within the lease window
+    if not acquire_lease(accountid, region, instanceid):
+      logger.info(f"{instanceid} is being evaluated by another invocation. Exiting.")
+      return {'InstanceStopped': False}
+    leased = True
 
     if resource_type == const_resource_type_ec2:
       # get EC2 information
-      instanceid = detail['instance-id']
-      instance_arn = event['resources'][0]
-      logger.info(f"Processing EC2 state change notification for instance {instanceid} in account {accountid}")
-      ec2_client, ec2 = get_handles(accountid, const_resource_type_ec2)
-      instance = ec2.Instance(instanceid)
-      subnets = [instance.subnet_id]
-      vpcid = instance.vpc_id
-      instancetags = instance.tags
-      instancename = instanceid
-      subnetname = subnets[0]
-      subnet = ec2_client.describe_subnets(SubnetIds=subnets)['Subnets'][0]
-      if 'Tags' in subnet:
-        subnettags = subnet['Tags']
-        for tag in subnettags:
-          if tag['Key'] == 'Name':
-            subnetname = tag['Value']
-            break
-
+      ec2_client, ec2 = get_handles(accountid, const_resource_type_ec2, region)
+      logger.info(f"Processing EC2 state change notification for instance {instanceid} in account {accountid}, region {region}")
+      instance = ec2_client.describe_instances(InstanceIds=[instanceid])['Reservations'][0]['Instances'][0]
+      details = get_ec2_details(ec2_client, instance)
+      details['InstanceArn'] = event['resources'][0]
+      details['EventTime'] = event['time']
+      details['HandlerStartTime'] = handler_started
 
     else:
       # get RDS information
-      instanceid = detail['SourceIdentifier']
-      logger.info(f"Processing RDS event notification for DB identifier {instanceid} in account {accountid}")
-      rds_client, rds = get_handles(accountid, const_resource_type_rds)
-      ec2_client, ec2 = get_handles(accountid, const_resource_type_ec2)
+      logger.info(f"Processing RDS event notification for DB identifier {instanceid} in account {accountid}, region {region}")
+      ec2_client, ec2 = get_handles(accountid, const_resource_type_ec2, region)
+      rds_client, rds = get_handles(accountid, const_resource_type_rds, region)
       db_instance = rds_client.describe_db_instances(DBInstanceIdentifier=instanceid)['DBInstances'][0]
-      vpcid = db_instance['DBSubnetGroup']['VpcId']
-      subnet_details = db_instance['DBSubnetGroup']['Subnets']
-      subnets = []
-      for detail in subnet_details:
-        subnets.append(detail['SubnetIdentifier'])
-      subnetname = db_instance['DBSubnetGroup']['DBSubnetGroupName']
-      instance_arn = db_instance['DBInstanceArn']
-      tag_list = rds_client.list_tags_for_resource(ResourceName=instance_arn)
-      instancetags = tag_list['TagList']
-      instancename = instanceid
-
-    logger.info("Processing tags")
-    if instancetags is not None:
-      for tag in instancetags:
-        if tag['Key'] == 'Name':
-          instancename = tag['Value']
-        if tag['Key'] == exception:
-          is_exception = True
-        if tag['Key'] == 'aws:autoscaling:groupName':
-          autoscalegroupname = tag['Value']
-      
-    logger.info("Getting VPC information")
-    vpcname = vpcid
-    vpc = ec2_client.describe_vpcs(VpcIds=[vpcid])['Vpcs'][0]
-    if 'Tags' in vpc:
-      vpctags = vpc['Tags']
-      for tag in vpctags:
-        if tag['Key'] == 'Name':
-          vpcname = tag['Value']
-          break
-
-    logger.info(f"Instance is in VPC {vpcname}, subnet {subnetname}")
-
-    is_public = check_if_public(ec2_client, vpcid, subnets)
-
-    if not is_public:
-      logger.info(f"{resource_type.upper()} instance is not in public subnet")
-      response = {'InstanceStopped': False}      
-      return response
-
-
-    # Initialize info to send to DynamoDB
-    db_params = {}
-    db_params['AccountId'] = accountid
-    db_params['DateTime'] = "$currtime$"
-    db_params['VpcName'] = vpcname
-    db_params['SubnetName'] = subnetname
-    db_params['InstanceId'] = instanceid
-    db_params['InstanceName'] = instancename
-    db_params['AutoScaleGroupName'] = autoscalegroupname
-    db_params['ResourceType'] = resource_type.upper()
-
-
-    # Create sub-messages
-    if resource_type == const_resource_type_ec2:
-      instance_msg = f"instance {instancename} ({instanceid})"
-    else:
-      instance_msg = f"instance {instancename}"
-
-    if autoscalegroupname == 'None':
-      asg_msg = ""
-    else:
-      asg_msg = f" in autoscalinggroup {autoscalegroupname}"
+      details = get_rds_details(rds_client, db_instance)
+      details['EventTime'] = event['time']
+      details['HandlerStartTime'] = handler_started
 
-    if is_exception:
-      exception_tag_msg = " with an exception tag"
-    else:
-      exception_tag_msg = ""
-
-    # Create the messages, tags, etc...
-    if is_exception or not compliancemode:
-      # System is in audit mode OR instance has an exception tag - just tag
-      logger.info(f"Found {resource_type.upper()} instance in public subnet{exception_tag_msg}")
-      tag_value = f"Out of Compliance on $currtime$ because instance is in public subnet. {'Exception applied.' if is_exception else ''}"
-      subject = f"WARNING: {resource_type.upper()} detected in public subnet{exception_tag_msg}."
-      message = f"{resource_type.upper()} {instance_msg}{asg_msg} in account {accountid} was detected running in public subnet {subnetname}, VPC {vpcname} on $currtime${exception_tag_msg}."
-      if is_exception:
-        db_params['Action'] = "None, exception tag found"
-      else:
-        db_params['Action'] = "None, in audit mode"
-
-    else:
-      # Running in compliance mode and found instance in public subnet
-      logger.info(f"In compliance mode. Adding tag and stopping {resource_type.upper()} instance.")
-      tag_value = f"Stopped on $currtime$ because instance is in public subnet"
-      subject = f"{resource_type.upper()} instance in public subnet STOPPED"
-      message = f"{resource_type.upper()} {instance_msg}{asg_msg} in account {accountid} was stopped because it was running in public subnet {subnetname}, VPC {vpcname} on $currtime$"
-      db_params['Action'] = "Instance stopped"
-
-    tag_params = {}
-    tag_params['Key'] = 'HUIT Compliance'
-    tag_params['Value'] = tag_value
-
-    notify_params = {}
-    notify_params['Subject'] = subject
-    notify_params['Message'] = message
-
-    instance_params = {}
-    instance_params['AccountId'] = accountid
-    instance_params['InstanceId'] = instanceid
-    instance_params['InstanceArn'] = instance_arn
-    instance_params['ResourceType'] = resource_type
-
-
-    done = remediate_and_notify(compliancemode, is_exception, instance_params, notify_params, tag_params, db_params)
-    if not done:
-      logger.info("Triggering step function")
-      client = boto3.client('stepfunctions')
-      stepFunctionInput = {'InstanceParameters': instance_params, 'NotificationParameters': notify_params, 'TagParameters': tag_params, 'DBParameters': db_params}
-      client.start_execution(stateMachineArn = step_function_arn, input = json.dumps(stepFunctionInput))
-      logger.info("Waiting")
-    else:
-      logger.info("Done")
+    done = evaluate_instance(accountid, resource_type, details, ec2_client, compliancemode, leased=True)
+    write_audit_records()
+    mark_event_processed(event.get('id'))
 
 
   except Exception as e:
     done = False
     message = f"Lambda checking for public resources failed: {e}"
     logger.error(message)
+    # let a retry of this event evaluate the resource again
+    if leased:
+      release_lease(accountid, region, instanceid)
+    # an SQS or stream batch would be acknowledged by the response below, every record is retried instead
+    if event.get('Records'):
+      return get_batch_failures(event)
+    # a throttled event fails the invocation, so Lambda delivers it again instead of dropping it
+    if is_retryable(e):
+      raise RetryableError(message) from e
+
+  finally:
+    # write the audit records buffered during this invocation, then wait for notifications to be delivered
+    flush_audit_records()
+    flush_notifications()
+    # share the network topology read from AWS with the containers started later
+    flush_snapshots()
+    # one Embedded Metric Format summary of the AWS calls made by this invocation
+    emit_metrics()
 
 
   response = {'InstanceStopped': done}
   return response
 
+
+
+
+def initialize():
+
+  # Init phase work, done once per container before the first event
+  #
+  # Input: None
+  # Output: None
+
+  global init_seconds
+
+  # set log level according to environment variable
+  logging.basicConfig(level=loglevel)
+  logger.setLevel(loglevel)
+
+  # create the clients every event uses while the init phase runs, other clients are created on first use
+  if prewarm_clients and is_state_enabled():
+    get_local_client('dynamodb')
+
+  init_seconds = time.perf_counter() - _init_started
+
+
+
+initialize()
@@ -0,0 +1,147 @@
+import logging
+
+from huit_public_compliance_utils import utc_timestamp
+from huit_public_compliance_utils import const_resource_type_ec2
+
+from huit_public_compliance import get_instance_id, get_ec2_details, get_tag_settings, get_db_params, enrich_instance
+from huit_public_compliance_remediate import remediate_and_notify_group
+
+from huit_public_compliance_state import release_lease
+
+
+# define global logger
+logger = logging.getLogger(__name__)
+
+# instances of a scaling group evaluated together, fewer go through the per-instance path
+const_min_scale_out = 2
+
+# instances named in a group notification, the others are counted
+const_message_instances = 20
+
+
+
+def get_scale_out_key(details, compliancemode):
+
+    # Get what the instances of a scale-out must share to be remediated together
+    #
+    # Input: EC2 instance details, compliance mode
+    # Output: (scaling group, subnet, exception flag, compliance mode), None for instances outside a scaling group
+
+    instancename, autoscalegroupname, is_exception, compliancemode = get_tag_settings(details, compliancemode)
+    if autoscalegroupname == 'None':
+        return None
+    return autoscalegroupname, details['Subnets'][0], is_exception, compliancemode
+
+
+
+def get_group_messages(accountid, autoscalegroupname, names, vpcname, subnetname, is_exception, compliancemode):
+
+    # Create the tag, subject and message shared by the instances of a scale-out
+    #
+    # Input: account id, scaling group, list of "name (id)", VPC and subnet names, exception flag, compliance mode
+    # Output: (tag value, subject, message, audit action)
+
+    listed = ', '.join(names[:const_message_instances])
+    if len(names) > const_message_instances:
+        listed += f" and {len(names) - const_message_instances} more"
+    instance_msg = f"{len(names)} instances {listed} in autoscalinggroup {autoscalegroupname}"
+    exception_tag_msg = " with an exception tag" if is_exception else ""
+
+    if is_exception or not compliancemode:
+        tag_value = f"Out of Compliance on $currtime$ because instance is in public subnet. {'Exception applied.' if is_exception else ''}"
+        subject = f"WARNING: {len(names)} EC2 instances detected in public subnet{exception_tag_msg}."
+        message = f"EC2 {instance_msg} in account {accountid} were detected running in public subnet {subnetname}, VPC {vpcname} on $currtime${exception_tag_msg}."
+        action = "None, exception tag found" if is_exception else "None, in audit mode"
+    else:
+        tag_value = "Stopped on $currtime$ because instance is in public subnet"
+        subject = f"{len(names)} EC2 instances in public subnet STOPPED"
+        message = f"EC2 {instance_msg} in account {accountid} were stopped because they were running in public subnet {subnetname}, VPC {vpcname} on $currtime$"
+        action = "Instance stopped"
+    return tag_value, subject, message, action
+
+
+
+def evaluate_scale_out(accountid, region, group, ec2_client, compliancemode):
+
+    # Check the shared subnet of a scale-out once, then tag, stop and notify all its instances together
+    #
+    # Input: account id, region, details of instances sharing scaling group, subnet, exception flag and compliance mode, EC2 client, compliance mode
+    # Output: dict of instance id -> exception, for the instances that could not be remediated
+
+    instancename, autoscalegroupname, is_exception, compliancemode = get_tag_settings(group[0], compliancemode)
+    is_public, vpcname, subnetname = enrich_instance(accountid, group[0], ec2_client)
+    verdict_time = utc_timestamp()
+    logger.info(f"{len(group)} instances of autoscalinggroup {autoscalegroupname} are in VPC {vpcname}, subnet {subnetname}, public: {is_public}")
+    if not is_public:
+        # a route change can make the subnet public right after this verdict, its re-evaluation must not be skipped
+        for details in group:
+            release_lease(accountid, region, details['InstanceId'])
+        return {}
+
+    db_params_list = []
+    names = []
+    for details in group:
+        instancename = get_tag_settings(details, compliancemode)[0]
+        db_params_list.append(get_db_params(accountid, const_resource_type_ec2, details, instancename, autoscalegroupname, vpcname, subnetname, verdict_time))
+        names.append(f"{instancename} ({details['InstanceId']})")
+
+    tag_value, subject, message, action = get_group_messages(accountid, autoscalegroupname, names, vpcname, subnetname, is_exception, compliancemode)
+    for db_params in db_params_list:
+        db_params['Action'] = action
+
+    instance_params = {'AccountId': accountid, 'Region': region, 'InstanceIds': [details['InstanceId'] for details in group]}
+    notify_params = {'Subject': subject, 'Message': message}
+    tag_params = {'Key': 'HUIT Compliance', 'Value': tag_value}
+    return remediate_and_notify_group(compliancemode, is_exception, instance_params, notify_params, tag_params, db_params_list)
+
+
+
+def coalesce_scale_outs(accountid, region, entries, described, ec2_client, compliancemode, started, failures, processed):
+
+    # Evaluate the EC2 events of a batch that belong to the same scale-out together
+    #
+    # Input: account id, region, list of (message id, event), dict of instance id -> described instance, EC2 client,
+    #        compliance mode, handler start time, list collecting failed message ids, list collecting processed (message id, event)
+    # Output: list of (message id, event) left for the per-instance evaluation
+
+    # scale-out key -> instance id -> (details, list of (message id, event))
+    groups = {}
+    for message_id, event in entries:
+        instanceid = get_instance_id(event, const_resource_type_ec2)
+        if instanceid not in described:
+            continue
+        details = get_ec2_details(ec2_client, described[instanceid])
+        key = get_scale_out_key(details, compliancemode)
+        if key is not None:
+            groups.setdefault(key, {}).setdefault(instanceid, (details, []))[1].append((message_id, event))
+
+    coalesced = set()
+    for key, instances in groups.items():
+        if len(instances) < const_min_scale_out:
+            continue
+        group = []
+        for instanceid, (details, instance_entries) in instances.items():
+            message_id, event = instance_entries[0]
+            details['InstanceArn'] = event['resources'][0]
+            details['EventTime'] = event['time']
+            details['HandlerStartTime'] = started
+            group.append(details)
+
+        logger.info(f"Evaluating {len(group)} instances of autoscalinggroup {key[0]} in subnet {key[1]} together")
+        try:
+            failed = evaluate_scale_out(accountid, region, group, ec2_client, compliancemode)
+        except Exception as e:
+            logger.error(f"Failed evaluating {len(group)} instances of autoscalinggroup {key[0]}: {e}")
+            failed = {instanceid: e for instanceid in instances}
+
+        for instanceid, (details, instance_entries) in instances.items():
+            coalesced.add(instanceid)
+            if instanceid in failed:
+                logger.error(f"Failed remediating EC2 instance {instanceid} of autoscalinggroup {key[0]}: {failed[instanceid]}")
+                failures.extend(message_id for message_id, event in instance_entries)
+                # let the retried messages evaluate the instance again
+                release_lease(accountid, region, instanceid)
+            else:
+                processed.extend(instance_entries)
+
+    return [(message_id, event) for message_id, event in entries if get_instance_id(event, const_resource_type_ec2) not in coalesced]
@@ -0,0 +1,121 @@
+import logging
+import os
+import random
+import threading
+import time
+
+from huit_public_compliance_utils import get_local_client
+
+
+# define global logger
+logger = logging.getLogger(__name__)
+
+# DynamoDB Table
+tablename = os.environ.get('DynamoTable')
+
+# buffered records are written once this many are waiting
+audit_flush_size = int(os.environ.get('AuditFlushSize', 100))
+
+# attempts to write items DynamoDB returns as unprocessed
+audit_max_attempts = int(os.environ.get('AuditMaxAttempts', 8))
+
+# BatchWriteItem accepts at most 25 items
+const_batch_write_size = 25
+
+
+# (AccountId, DateTime) -> item; a record written twice in one invocation is only sent once
+_audit_buffer = {}
+_audit_lock = threading.Lock()
+
+
+
+def _serialize(item):
+
+    # Convert a flat item of strings and numbers to DynamoDB attribute values
+    #
+    # Input: item
+    # Output: item in DynamoDB attribute value format
+
+    serialized = {}
+    for key, value in item.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            serialized[key] = {'N': str(value)}
+        else:
+            serialized[key] = {'S': str(value)}
+    return serialized
+
+
+
+def add_audit_record(item):
+
+    # Buffer a record for the DynamoDB audit table
+    #
+    # Input: item, keyed on AccountId and DateTime
+    # Output: None
+
+    with _audit_lock:
+        _audit_buffer[(item['AccountId'], item['DateTime'])] = dict(item)
+        full = len(_audit_buffer) >= audit_flush_size
+    if full:
+        flush_audit_records()
+
+
+
+def wait_before_retry(attempt, unprocessed, what):
+
+    # Wait before sending the items DynamoDB returned as unprocessed again, with jittered exponential backoff
+    #
+    # Input: attempts made so far, number of unprocessed items, description of the items
+    # Output: None, raises an exception once AuditMaxAttempts attempts were made
+
+    if attempt >= audit_max_attempts:
+        raise Exception(f"{unprocessed} {what} still unprocessed after {attempt} attempts")
+    delay = min(5.0, 0.05 * 2 ** attempt) * random.uniform(0.5, 1.0)
+    logger.info(f"{unprocessed} {what} unprocessed, retrying in {delay:.2f}s")
+    time.sleep(delay)
+
+
+
+def _write_batch(client, requests):
+
+    # Write up to 25 put requests, retrying unprocessed items with backoff
+    #
+    # Input: DynamoDB client, list of put requests
+    # Output: None
+
+    attempt = 0
+    while requests:
+        response = client.batch_write_item(RequestItems={tablename: requests})
+        requests = response.get('UnprocessedItems', {}).get(tablename, [])
+        if not requests:
+            break
+        attempt += 1
+        wait_before_retry(attempt, len(requests), 'audit records')
+
+
+
+def flush_audit_records():
+
+    # Write all buffered records to the audit table with BatchWriteItem
+    #
+    # Input: None
+    # Output: True if every record was written, False otherwise
+
+    with _audit_lock:
+        items = list(_audit_buffer.values())
+        _audit_buffer.clear()
+    if not items:
+        return True
+
+    logger.info(f"Writing {len(items)} audit records to DynamoDB")
+    client = get_local_client('dynamodb')
+    written = True
+    for n in range(0, len(items), const_batch_write_size):
+        requests = [{'PutRequest': {'Item': _serialize(item)}} for item in items[n:n + const_batch_write_size]]
+        try:
+            _write_batch(client, requests)
+        except Exception as e:
+            written = False
+            for request in requests:
+                logger.error(f"Unable to write audit record {request['PutRequest']['Item']}: {e}")
+    return written
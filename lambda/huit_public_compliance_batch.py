@@ -0,0 +1,296 @@
+import json
+import logging
+import os
+
+from huit_public_compliance_utils import get_handles, get_event_region, utc_timestamp
+
+from huit_public_compliance_utils import const_resource_type_ec2
+from huit_public_compliance_utils import const_resource_type_rds
+from huit_public_compliance_utils import const_resource_type_network
+from huit_public_compliance_utils import const_resource_type_unknown
+
+from huit_public_compliance import get_resource_type, get_instance_id
+from huit_public_compliance import get_ec2_details, get_rds_details, evaluate_instance
+from huit_public_compliance import resume_pending_remediation, is_drain_only_event
+from huit_public_compliance import trueval
+
+from huit_public_compliance_audit import flush_audit_records
+from huit_public_compliance_state import get_processed_events, mark_events_processed, acquire_lease, release_lease, lease_seconds
+from huit_public_compliance_asg import coalesce_scale_outs
+
+
+# define global logger
+logger = logging.getLogger(__name__)
+
+# maximum number of ids passed in one describe filter
+const_describe_chunk_size = 100
+
+
+
+def _chunks(items, size):
+
+    # Split a list in chunks of at most size items
+    #
+    # Input: list, chunk size
+    # Output: generator of lists
+
+    for n in range(0, len(items), size):
+        yield items[n:n + size]
+
+
+
+def parse_records(records):
+
+    # Parse the EventBridge events carried in SQS records and group them
+    #
+    # Input: SQS records
+    # Output: dict of (account, region, resource type) -> list of (message id, event), list of failed message ids
+
+    groups = {}
+    failures = []
+    events = []
+    for record in records:
+        message_id = record['messageId']
+        try:
+            events.append((message_id, json.loads(record['body'])))
+        except Exception as e:
+            logger.error(f"Unable to parse message {message_id}: {e}")
+            failures.append(message_id)
+
+    # one lookup for the whole batch, a scale-out delivers hundreds of events at once
+    try:
+        seen = get_processed_events(event.get('id') for message_id, event in events)
+    except Exception as e:
+        # without the lookup duplicates cannot be told apart, the whole batch is delivered again
+        logger.error(f"Unable to look up processed events, retrying {len(records)} messages: {e}")
+        return {}, [record['messageId'] for record in records]
+    for message_id, event in events:
+        try:
+            resource_type = get_resource_type(event)
+            if resource_type == const_resource_type_unknown:
+                logger.info(f"Ignoring unsupported event in message {message_id}")
+                continue
+            if event.get('id') in seen:
+                logger.info(f"Ignoring duplicate event {event.get('id')} in message {message_id}")
+                continue
+            seen.add(event.get('id'))
+            key = (event['account'], get_event_region(event), resource_type)
+            groups.setdefault(key, []).append((message_id, event))
+        except Exception as e:
+            logger.error(f"Unable to parse message {message_id}: {e}")
+            failures.append(message_id)
+
+    return groups, failures
+
+
+
+def describe_ec2_group(ec2_client, instance_ids):
+
+    # Describe all EC2 instances of a group
+    #
+    # Input: EC2 client, instance ids
+    # Output: dict of instance id -> instance
+
+    instances = {}
+    paginator = ec2_client.get_paginator('describe_instances')
+    for chunk in _chunks(instance_ids, const_describe_chunk_size):
+        for page in paginator.paginate(Filters=[{'Name': 'instance-id', 'Values': chunk}]):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    instances[instance['InstanceId']] = instance
+    return instances
+
+
+
+def describe_rds_group(rds_client, db_identifiers):
+
+    # Describe all RDS instances of a group
+    #
+    # Input: RDS client, DB identifiers
+    # Output: dict of DB identifier -> DB instance
+
+    db_instances = {}
+    paginator = rds_client.get_paginator('describe_db_instances')
+    for chunk in _chunks(db_identifiers, const_describe_chunk_size):
+        for page in paginator.paginate(Filters=[{'Name': 'db-instance-id', 'Values': chunk}]):
+            for db_instance in page['DBInstances']:
+                db_instances[db_instance['DBInstanceIdentifier']] = db_instance
+    return db_instances
+
+
+
+def resume_group(accountid, region, entries, failures, processed):
+
+    # Resume the pending remediations of a group of RDS events
+    #
+    # Input: account id, region, list of (message id, event), list collecting failed message ids,
+    #        list collecting processed (message id, event)
+    # Output: list of (message id, event) that still need an evaluation
+
+    remaining = []
+    for message_id, event in entries:
+        instanceid = get_instance_id(event, const_resource_type_rds)
+        try:
+            resumed = resume_pending_remediation(accountid, region, instanceid)
+            if resumed is not None:
+                processed.append((message_id, event))
+            elif not is_drain_only_event(event):
+                remaining.append((message_id, event))
+        except Exception as e:
+            logger.error(f"Failed resuming remediation of RDS instance {instanceid} from message {message_id}: {e}")
+            failures.append(message_id)
+    return remaining
+
+
+
+def process_route_changes(entries, compliancemode, started, processed):
+
+    # Re-evaluate the subnets of route change events one event at a time
+    #
+    # Input: list of (message id, event), compliance mode, handler start time, list collecting processed (message id, event)
+    # Output: list of failed message ids
+
+    from huit_public_compliance_routes import process_route_change
+
+    failures = []
+    for message_id, event in entries:
+        try:
+            process_route_change(event, compliancemode, started)
+            processed.append((message_id, event))
+        except Exception as e:
+            logger.error(f"Failed processing route change from message {message_id}: {e}")
+            failures.append(message_id)
+    return failures
+
+
+
+def process_group(accountid, region, resource_type, entries, compliancemode, processed):
+
+    # Evaluate all events of one account, region and resource type with a single describe call
+    #
+    # Input: account id, region, resource type, list of (message id, event), compliance mode,
+    #        list collecting processed (message id, event)
+    # Output: list of failed message ids
+
+    failures = []
+    started = utc_timestamp()
+    if resource_type == const_resource_type_network:
+        return process_route_changes(entries, compliancemode, started, processed)
+    if resource_type == const_resource_type_rds:
+        entries = resume_group(accountid, region, entries, failures, processed)
+        if not entries:
+            return failures
+
+    instance_ids = []
+    try:
+        # only evaluate the instances no other invocation is working on
+        for instanceid in dict.fromkeys(get_instance_id(event, resource_type) for message_id, event in entries):
+            if acquire_lease(accountid, region, instanceid):
+                instance_ids.append(instanceid)
+            else:
+                logger.info(f"{instanceid} is being evaluated by another invocation, skipping its events")
+        entries = [(message_id, event) for message_id, event in entries if get_instance_id(event, resource_type) in instance_ids]
+        if not entries:
+            return failures
+
+        ec2_client, ec2 = get_handles(accountid, const_resource_type_ec2, region)
+        logger.info(f"Processing {len(entries)} {resource_type.upper()} events for {len(instance_ids)} instances in account {accountid}, region {region}")
+
+        if resource_type == const_resource_type_ec2:
+            client = ec2_client
+            described = describe_ec2_group(ec2_client, instance_ids)
+            # instances a scaling group launched into the same subnet share one verdict, tag, stop and notification
+            entries = coalesce_scale_outs(accountid, region, entries, described, ec2_client, compliancemode, started, failures, processed)
+        else:
+            client, rds = get_handles(accountid, const_resource_type_rds, region)
+            described = describe_rds_group(client, instance_ids)
+
+        for message_id, event in entries:
+            instanceid = get_instance_id(event, resource_type)
+            try:
+                if instanceid not in described:
+                    raise Exception(f"{resource_type.upper()} instance {instanceid} not found")
+                if resource_type == const_resource_type_ec2:
+                    details = get_ec2_details(client, described[instanceid])
+                    details['InstanceArn'] = event['resources'][0]
+                else:
+                    details = get_rds_details(client, described[instanceid])
+                details['EventTime'] = event['time']
+                details['HandlerStartTime'] = started
+                evaluate_instance(accountid, resource_type, details, ec2_client, compliancemode, leased=True)
+                processed.append((message_id, event))
+            except Exception as e:
+                logger.error(f"Failed processing {resource_type.upper()} instance {instanceid} from message {message_id}: {e}")
+                failures.append(message_id)
+                # let the retried message evaluate the instance again
+                release_lease(accountid, region, instanceid)
+    except Exception:
+        # the group fails as a whole, the retried messages must be able to take the leases again
+        for instanceid in instance_ids:
+            try:
+                release_lease(accountid, region, instanceid)
+            except Exception as e:
+                logger.error(f"Unable to release the lease of {instanceid}, it expires in {lease_seconds}s: {e}")
+        raise
+
+    return failures
+
+
+
+def retry_processed(processed):
+
+    # Release the leases of processed events whose audit records were lost, so their retried messages evaluate them again
+    #
+    # Input: list of (message id, event)
+    # Output: list of message ids to retry
+
+    for message_id, event in processed:
+        resource_type = get_resource_type(event)
+        # a route change holds no lease of its own
+        if resource_type == const_resource_type_network:
+            continue
+        instanceid = get_instance_id(event, resource_type)
+        try:
+            release_lease(event['account'], get_event_region(event), instanceid)
+        except Exception as e:
+            logger.error(f"Unable to release the lease of {instanceid}, it expires in {lease_seconds}s: {e}")
+    return [message_id for message_id, event in processed]
+
+
+
+def batch_handler(event, context):
+
+    # Lambda handler for batches of EC2 and RDS events buffered through SQS
+    #
+    # Input: SQS event, context objects
+    # Output: partial batch response listing the messages to retry
+
+    groups, failures = parse_records(event['Records'])
+    processed = []
+
+    # re-read compliance mode in case it changes
+    compliancemode = os.environ.get('ComplianceMode') in trueval
+
+    for (accountid, region, resource_type), entries in groups.items():
+        try:
+            failures.extend(process_group(accountid, region, resource_type, entries, compliancemode, processed))
+        except Exception as e:
+            logger.error(f"Failed processing {resource_type.upper()} events for account {accountid}, region {region}: {e}")
+            failures.extend(message_id for message_id, group_event in entries)
+
+    # the audit records are written before the events are marked processed, a lost record fails its messages
+    failed = set(failures)
+    processed = [(message_id, processed_event) for message_id, processed_event in processed if message_id not in failed]
+    if not flush_audit_records():
+        logger.error(f"Unable to write the audit records of {len(processed)} processed messages, retrying them")
+        failures.extend(retry_processed(processed))
+    else:
+        try:
+            mark_events_processed(processed_event.get('id') for message_id, processed_event in processed)
+        except Exception as e:
+            # the audit records are written, retrying the messages would audit and notify the instances again
+            logger.error(f"Unable to mark {len(processed)} events processed, duplicates will be evaluated again: {e}")
+
+    logger.info(f"Processed {len(event['Records'])} messages, {len(failures)} failed")
+    response = {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failures]}
+    return response
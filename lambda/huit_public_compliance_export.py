@@ -0,0 +1,214 @@
+import argparse
+import collections
+import csv
+import datetime
+import gzip
+import json
+import os
+import sys
+import tempfile
+
+import boto3
+from botocore.exceptions import ClientError
+from dateutil import tz
+
+from huit_public_compliance_query import query_range, consumed_capacity
+
+
+# columns of the exported files, attributes the Lambda function does not write are left empty
+const_columns = ['AccountId', 'DateTime', 'ResourceType', 'Action', 'InstanceId', 'InstanceName', 'AutoScaleGroupName',
+                 'VpcName', 'SubnetName', 'EventTime', 'HandlerStartTime', 'VerdictTime', 'StopIssuedTime', 'StopAcceptedTime',
+                 'ProcessedTime', 'DetectionSeconds', 'VerdictSeconds', 'StopIssuedSeconds', 'StopAcceptedSeconds']
+
+# bumped when the manifest or file layout changes
+const_manifest_version = 1
+
+# partition files kept open at the same time, the least recently written one is closed first
+const_max_open_partitions = 64
+
+# DateTime the first export starts after, sorts before every record
+const_first_mark = '0000'
+
+
+
+def get_cutoff(settle_hours, until=None):
+
+    # Get the newest DateTime an export includes
+    #
+    # Input: hours a record is given to be written after its event, optional date the export stops before (YYYY-MM-DD)
+    # Output: cutoff, in the eastern time DateTime format of the audit records
+
+    # DateTime is the event time, records of RDS instances waiting to become stoppable are written hours later
+    settled = datetime.datetime.now(tz=tz.gettz('US/Eastern')) - datetime.timedelta(hours=settle_hours)
+    cutoff = settled.strftime('%Y-%m-%d %H:%M:%S')
+    # a date sorts before every record of that day
+    return min(cutoff, until) if until else cutoff
+
+
+
+def get_partition_key(prefix, record, mark):
+
+    # Get the file a record is written to
+    #
+    # Input: key prefix, record, high-water mark the export started after
+    # Output: key, relative to the bucket or directory
+
+    # named after the starting mark, so an export that failed before its manifest was written overwrites its own files when rerun
+    run = mark.replace('-', '').replace(':', '').replace(' ', 'T') if mark != const_first_mark else 'initial'
+    return f"{prefix}/account={record['AccountId']}/month={record['DateTime'][:7]}/part-{run}.csv.gz"
+
+
+
+class PartitionWriter:
+
+    # Streams records to compressed CSV files in a staging directory, one per partition
+
+    def __init__(self, staging):
+        self.staging = staging
+        self.open = collections.OrderedDict()
+        self.counts = {}
+
+
+    def write(self, key, record):
+        # reopened files get another gzip member, which readers decompress as one file
+        if key not in self.open:
+            if len(self.open) >= const_max_open_partitions:
+                self.open.popitem(last=False)[1][0].close()
+            path = os.path.join(self.staging, key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            f = gzip.open(path, 'at', newline='')
+            writer = csv.DictWriter(f, fieldnames=const_columns, extrasaction='ignore')
+            if key not in self.counts:
+                writer.writeheader()
+                self.counts[key] = 0
+            self.open[key] = (f, writer)
+        self.open.move_to_end(key)
+        self.open[key][1].writerow(record)
+        self.counts[key] += 1
+
+
+    def close(self):
+        for f, writer in self.open.values():
+            f.close()
+        self.open.clear()
+
+
+
+def read_manifest(bucket, path, prefix):
+
+    # Read the manifest of previous exports
+    #
+    # Input: bucket or None, local directory or None, key prefix
+    # Output: manifest dict, a new one if there was no export yet
+
+    key = f"{prefix}/manifest.json"
+    try:
+        if bucket:
+            body = boto3.client('s3').get_object(Bucket=bucket, Key=key)['Body'].read()
+        else:
+            with open(os.path.join(path, key), 'rb') as f:
+                body = f.read()
+        manifest = json.loads(body)
+    except FileNotFoundError:
+        manifest = None
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ['NoSuchKey', '404']:
+            raise
+        manifest = None
+    if manifest is None:
+        return {'Version': const_manifest_version, 'HighWaterMark': const_first_mark, 'Exports': []}
+    if manifest.get('Version') != const_manifest_version:
+        raise Exception(f"Manifest {key} has version {manifest.get('Version')}, expected {const_manifest_version}")
+    return manifest
+
+
+
+def publish(staging, bucket, path, keys, manifest, prefix):
+
+    # Move the partition files to S3 or the local directory, then the manifest that makes them part of the export
+    #
+    # Input: staging directory, bucket or None, local directory or None, partition keys, manifest, key prefix
+    # Output: None
+
+    s3 = boto3.client('s3') if bucket else None
+    for key in keys:
+        if s3:
+            # uploaded from disk, in parts when large
+            s3.upload_file(os.path.join(staging, key), bucket, key, ExtraArgs={'ContentType': 'application/gzip'})
+        else:
+            target = os.path.join(path, key)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(os.path.join(staging, key), target)
+
+    body = json.dumps(manifest, indent=2).encode()
+    key = f"{prefix}/manifest.json"
+    if s3:
+        s3.put_object(Bucket=bucket, Key=key, Body=body, ContentType='application/json')
+    else:
+        os.makedirs(os.path.join(path, prefix), exist_ok=True)
+        with open(os.path.join(path, key + '.tmp'), 'wb') as f:
+            f.write(body)
+        os.replace(os.path.join(path, key + '.tmp'), os.path.join(path, key))
+
+
+
+def export(tablename, bucket=None, path=None, prefix='compliance-export', segments=4, settle_hours=24, until=None, client=None):
+
+    # Export the audit records written since the last export
+    #
+    # Input: table name, bucket or local directory, key prefix, number of scan segments, hours records are given to settle,
+    #        optional date the export stops before, DynamoDB client
+    # Output: summary of the export, None if there was nothing new to export
+
+    client = client or boto3.client('dynamodb')
+    manifest = read_manifest(bucket, path, prefix)
+    mark = manifest['HighWaterMark']
+    cutoff = get_cutoff(settle_hours, until)
+    if cutoff <= mark:
+        return None
+
+    with tempfile.TemporaryDirectory() as staging:
+        writer = PartitionWriter(staging)
+        try:
+            # the ResourceActionIndex holds every record under its resource type and action, sorted by DateTime
+            for record in query_range(mark, cutoff, tablename, segments, client):
+                writer.write(get_partition_key(prefix, record, mark), record)
+        finally:
+            writer.close()
+
+        summary = {'After': mark, 'Upto': cutoff, 'Exported': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                   'Records': sum(writer.counts.values()), 'Files': writer.counts}
+        manifest['HighWaterMark'] = cutoff
+        manifest['Exports'].append(summary)
+        publish(staging, bucket, path, sorted(writer.counts), manifest, prefix)
+    return summary
+
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Export the public compliance audit table to gzip CSV files per account and month')
+    parser.add_argument('--table', default=os.environ.get('DynamoTable', 'huit_public_compliance'), help='audit table name')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--bucket', help='S3 bucket the files are written to')
+    target.add_argument('--path', help='local directory the files are written to, instead of a bucket')
+    parser.add_argument('--prefix', default='compliance-export', help='key prefix of the files and manifest')
+    parser.add_argument('--segments', type=int, default=4, help='parallel scan segments, if the ResourceActionIndex does not exist')
+    parser.add_argument('--settle-hours', type=int, default=24, help='only export records whose event is at least this old')
+    parser.add_argument('--until', help='only export records before this date, YYYY-MM-DD in eastern time')
+    args = parser.parse_args()
+
+    summary = export(args.table, args.bucket, args.path, args.prefix, args.segments, args.settle_hours, args.until)
+    if summary is None:
+        print('Nothing new to export', file=sys.stderr)
+        return
+    print(f"Exported {summary['Records']} records after {summary['After']} up to {summary['Upto']} to {len(summary['Files'])} files")
+    for key, count in sorted(summary['Files'].items()):
+        print(f"    {key} {count}")
+    capacity = ', '.join(f"{name} {units:.1f}" for name, units in consumed_capacity.items())
+    print(f"read capacity consumed: {capacity or 'none'}", file=sys.stderr)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+
+# define global logger
+logger = logging.getLogger(__name__)
+
+# flags set as environment variables
+metrics_enabled = os.environ.get('Metrics', 'true') in ['true', 'True', 'yes', 'Yes']
+metrics_namespace = os.environ.get('MetricsNamespace', 'HUIT/PublicCompliance')
+
+# error codes counted as throttles
+const_throttle_codes = ['Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottled',
+    'RequestThrottledException', 'TooManyRequestsException', 'ProvisionedThroughputExceededException',
+    'RequestLimitExceeded', 'SlowDown', 'PriorRequestNotComplete']
+
+# EMF accepts at most 100 values per metric
+const_emf_max_values = 100
+
+# account recorded for clients of the account the Lambda function runs in
+const_local_account = 'local'
+
+# detection-to-remediation latencies published per audit record
+const_stage_metrics = ['DetectionSeconds', 'VerdictSeconds', 'StopIssuedSeconds', 'StopAcceptedSeconds']
+
+
+# (service, operation, account) -> call statistics of the current invocation
+_calls = {}
+_calls_lock = threading.Lock()
+_invocation = {'EventType': 'Unknown', 'Started': time.time()}
+
+# stage latencies of the remediations recorded during the current invocation
+_stages = []
+
+
+
+def _get_stats(service, operation, accountid):
+
+    # Get the statistics of an API operation, creating them if needed
+    #
+    # Input: service name, operation name, account id
+    # Output: dict of call statistics, to be updated while holding the lock
+
+    key = (service, operation, accountid)
+    stats = _calls.get(key)
+    if stats is None:
+        stats = {'Calls': 0, 'Errors': 0, 'Retries': 0, 'Throttles': 0, 'LatencyMs': []}
+        _calls[key] = stats
+    return stats
+
+
+
+def _before_call(accountid, model, context, **kwargs):
+
+    # botocore before-call hook, remembers when the call started
+    #
+    # Input: account id, operation model, request context
+    # Output: None
+
+    context['MetricsStarted'] = time.perf_counter()
+
+
+
+def _after_call(accountid, model, context, http_response=None, parsed=None, **kwargs):
+
+    # botocore after-call hook, records the latency and outcome of a call
+    #
+    # Input: account id, operation model, request context, HTTP response, parsed response
+    # Output: None
+
+    started = context.get('MetricsStarted')
+    if started is None:
+        return
+    latency = (time.perf_counter() - started) * 1000
+    parsed = parsed or {}
+    with _calls_lock:
+        stats = _get_stats(model.service_model.service_name, model.name, accountid)
+        stats['Calls'] += 1
+        stats['LatencyMs'].append(latency)
+        stats['Retries'] += parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        if http_response is not None and http_response.status_code >= 300:
+            stats['Errors'] += 1
+
+
+
+def _after_call_error(accountid, model, context, exception=None, **kwargs):
+
+    # botocore after-call-error hook, records calls that failed without a response
+    #
+    # Input: account id, operation model, request context, exception
+    # Output: None
+
+    started = context.get('MetricsStarted')
+    if started is None:
+        return
+    with _calls_lock:
+        stats = _get_stats(model.service_model.service_name, model.name, accountid)
+        stats['Calls'] += 1
+        stats['Errors'] += 1
+        stats['LatencyMs'].append((time.perf_counter() - started) * 1000)
+
+
+
+def _needs_retry(accountid, operation, response=None, attempts=None, **kwargs):
+
+    # botocore needs-retry hook, emitted after every attempt, counts the throttled ones
+    #
+    # Input: account id, operation model, (http response, parsed response), attempt number
+    # Output: None, the retry decision is left to botocore
+
+    if response is None:
+        return None
+    error_code = response[1].get('Error', {}).get('Code')
+    if error_code in const_throttle_codes:
+        with _calls_lock:
+            _get_stats(operation.service_model.service_name, operation.name, accountid)['Throttles'] += 1
+    return None
+
+
+
+def instrument_client(client, accountid=None):
+
+    # Register the call accounting hooks on a client
+    #
+    # Input: boto3 client, account id the client's credentials belong to, None for the local account
+    # Output: the client
+
+    if not metrics_enabled:
+        return client
+    accountid = accountid or const_local_account
+    events = client.meta.events
+    events.register('before-call.*.*', functools.partial(_before_call, accountid), unique_id='huit-metrics-before-call')
+    events.register('after-call.*.*', functools.partial(_after_call, accountid), unique_id='huit-metrics-after-call')
+    events.register('after-call-error.*.*', functools.partial(_after_call_error, accountid), unique_id='huit-metrics-after-call-error')
+    events.register('needs-retry.*.*', functools.partial(_needs_retry, accountid), unique_id='huit-metrics-needs-retry')
+    return client
+
+
+
+def record_stage_latencies(params):
+
+    # Keep the stage latencies of a remediation for the end of the invocation
+    #
+    # Input: audit record parameters with the latencies computed from the event time
+    # Output: None
+
+    if not metrics_enabled:
+        return
+    with _calls_lock:
+        _stages.append(dict(params))
+
+
+
+def start_invocation(event_type='Unknown'):
+
+    # Forget the statistics of the previous invocation
+    #
+    # Input: event type used as metric dimension
+    # Output: None
+
+    with _calls_lock:
+        _calls.clear()
+        del _stages[:]
+    _invocation['EventType'] = event_type
+    _invocation['Started'] = time.time()
+
+
+
+def set_event_type(event_type):
+
+    # Set the event type once the handler knows it
+    #
+    # Input: event type used as metric dimension
+    # Output: None
+
+    _invocation['EventType'] = event_type
+
+
+
+def _emf_document(timestamp, dimensions, metrics, properties):
+
+    # Build one CloudWatch Embedded Metric Format document
+    #
+    # Input: timestamp in milliseconds, dimension sets, dict of name -> (unit, value), properties
+    # Output: dict
+
+    document = {
+        '_aws': {
+            'Timestamp': timestamp,
+            'CloudWatchMetrics': [{
+                'Namespace': metrics_namespace,
+                'Dimensions': dimensions,
+                'Metrics': [{'Name': name, 'Unit': unit} for name, (unit, value) in metrics.items()],
+            }],
+        },
+    }
+    document.update(properties)
+    for name, (unit, value) in metrics.items():
+        document[name] = value
+    return document
+
+
+
+def emit_metrics():
+
+    # Write the statistics of the current invocation to the log in Embedded Metric Format
+    #
+    # Input: None
+    # Output: None
+
+    if not metrics_enabled:
+        return
+    timestamp = int(time.time() * 1000)
+    event_type = _invocation['EventType']
+    with _calls_lock:
+        calls = {key: dict(stats, LatencyMs=list(stats['LatencyMs'])) for key, stats in _calls.items()}
+        _calls.clear()
+        stages = list(_stages)
+        del _stages[:]
+
+    documents = []
+    totals = {'ApiCalls': 0, 'ApiErrors': 0, 'ApiRetries': 0, 'ApiThrottles': 0}
+    operations = {}
+    for (service, operation, accountid), stats in calls.items():
+        totals['ApiCalls'] += stats['Calls']
+        totals['ApiErrors'] += stats['Errors']
+        totals['ApiRetries'] += stats['Retries']
+        totals['ApiThrottles'] += stats['Throttles']
+        merged = operations.setdefault((service, operation), {'Calls': 0, 'Errors': 0, 'Retries': 0, 'Throttles': 0, 'LatencyMs': [], 'CallsByAccount': {}})
+        for name in ['Calls', 'Errors', 'Retries', 'Throttles']:
+            merged[name] += stats[name]
+        merged['LatencyMs'] += stats['LatencyMs']
+        merged['CallsByAccount'][accountid] = stats['Calls']
+
+    for (service, operation), stats in operations.items():
+        # accounts are kept as a property, as a dimension they would create a metric per account
+        documents.append(_emf_document(timestamp, [['EventType', 'Service', 'Operation']], {
+            'Calls': ('Count', stats['Calls']),
+            'Errors': ('Count', stats['Errors']),
+            'Retries': ('Count', stats['Retries']),
+            'Throttles': ('Count', stats['Throttles']),
+            'Latency': ('Milliseconds', [round(value, 2) for value in stats['LatencyMs'][:const_emf_max_values]]),
+        }, {'EventType': event_type, 'Service': service, 'Operation': operation, 'CallsByAccount': stats['CallsByAccount']}))
+
+    for params in stages:
+        # how long each instance was exposed, from the event to each remediation stage
+        metrics = {name: ('Seconds', params[name]) for name in const_stage_metrics if name in params}
+        if metrics:
+            documents.append(_emf_document(timestamp, [['ResourceType'], ['ResourceType', 'Action']], metrics, {
+                'ResourceType': params.get('ResourceType'), 'Action': params.get('Action'),
+                'AccountId': params.get('AccountId'), 'InstanceId': params.get('InstanceId')}))
+
+    metrics = {name: ('Count', value) for name, value in totals.items()}
+    metrics['InvocationDuration'] = ('Milliseconds', round((time.time() - _invocation['Started']) * 1000, 2))
+    documents.append(_emf_document(timestamp, [['EventType']], metrics, {'EventType': event_type}))
+
+    # EMF documents must be written as one line each
+    for document in documents:
+        print(json.dumps(document))
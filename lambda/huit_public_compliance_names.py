@@ -0,0 +1,149 @@
+import collections
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+
+from huit_public_compliance_snapshot import load_snapshot, update_snapshot_names
+
+
+# define global logger
+logger = logging.getLogger(__name__)
+
+# seconds the names of an account are used before they are filled again
+name_cache_ttl = int(os.environ.get('NameCacheTTL', 3600))
+
+# names kept per account and region, the least recently used are evicted first
+name_cache_size = int(os.environ.get('NameCacheSize', 5000))
+
+# a name missing from a cache older than this many seconds triggers a new fill
+name_cache_miss_refresh = int(os.environ.get('NameCacheMissRefresh', 60))
+
+
+# (accountid, region) -> {'Filled': time, 'Names': OrderedDict of resource id -> name}, kept between warm invocations
+_name_cache = {}
+_name_cache_lock = threading.Lock()
+
+# fills run in the background so names never delay a verdict
+_fill_executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+_filling = {}
+
+# describe calls of a fill, run at the same time so a fill takes as long as the slowest one
+const_name_lookups = [('describe_vpcs', 'Vpcs', 'VpcId'), ('describe_subnets', 'Subnets', 'SubnetId')]
+
+
+
+def get_name_tag(tags, default):
+
+    # Get the Name tag of a resource
+    #
+    # Input: list of tags or None, value returned when there is no Name tag
+    # Output: name
+
+    for tag in tags or []:
+        if tag['Key'] == 'Name':
+            return tag['Value']
+    return default
+
+
+
+def describe_names(ec2_client, operation, key, resource_key):
+
+    # Read the names of every resource one paginated describe call returns
+    #
+    # Input: EC2 client for the region, describe operation, response key, id attribute
+    # Output: dict of resource id -> name
+
+    names = {}
+    paginator = ec2_client.get_paginator(operation)
+    for page in paginator.paginate():
+        for resource in page[key]:
+            names[resource[resource_key]] = get_name_tag(resource.get('Tags'), resource[resource_key])
+    return names
+
+
+
+def fill_name_cache(ec2_client, accountid):
+
+    # Load the names of every VPC and subnet of an account and region
+    #
+    # Input: EC2 client for the region, account id
+    # Output: number of names loaded
+
+    # a pool per fill, the sweep fills many accounts at once and would queue on a shared one
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(const_name_lookups)) as executor:
+        futures = [executor.submit(describe_names, ec2_client, *lookup) for lookup in const_name_lookups]
+    names = collections.OrderedDict()
+    for future in futures:
+        names.update(future.result())
+    while len(names) > name_cache_size:
+        names.popitem(last=False)
+
+    with _name_cache_lock:
+        _name_cache[(accountid, ec2_client.meta.region_name)] = {'Filled': time.time(), 'Names': names}
+    update_snapshot_names(accountid, ec2_client.meta.region_name, names)
+    logger.info(f"Loaded {len(names)} VPC and subnet names for account {accountid}, region {ec2_client.meta.region_name}")
+    return len(names)
+
+
+
+def _fill_in_background(ec2_client, accountid):
+
+    # Start filling the names of an account unless a fill is already running
+    #
+    # Input: EC2 client for the region, account id
+    # Output: None
+
+    key = (accountid, ec2_client.meta.region_name)
+    with _name_cache_lock:
+        future = _filling.get(key)
+        if future is not None and not future.done():
+            return
+        _filling[key] = _fill_executor.submit(_fill_logged, ec2_client, accountid)
+
+
+
+def _fill_logged(ec2_client, accountid):
+
+    # Fill the names of an account, logging failures since nobody waits for the result
+    #
+    # Input: EC2 client for the region, account id
+    # Output: None
+
+    try:
+        fill_name_cache(ec2_client, accountid)
+    except Exception as e:
+        logger.warning(f"Unable to load VPC and subnet names for account {accountid}: {e}")
+
+
+
+def get_cached_name(ec2_client, accountid, resource_id):
+
+    # Get the Name tag of a VPC or subnet without waiting for AWS
+    #
+    # Input: EC2 client for the region, account id, VPC or subnet id
+    # Output: the cached name, the id itself while the names are being filled
+
+    key = (accountid, ec2_client.meta.region_name)
+    now = time.time()
+    if key not in _name_cache:
+        snapshot = load_snapshot(accountid, ec2_client.meta.region_name)
+        if snapshot is not None and snapshot['Names']:
+            with _name_cache_lock:
+                _name_cache.setdefault(key, {'Filled': snapshot['NamesFilled'], 'Names': collections.OrderedDict(snapshot['Names'])})
+    with _name_cache_lock:
+        entry = _name_cache.get(key)
+        if entry is not None and resource_id in entry['Names']:
+            entry['Names'].move_to_end(resource_id)
+            name = entry['Names'][resource_id]
+            if now - entry['Filled'] <= name_cache_ttl:
+                return name
+        else:
+            name = resource_id
+        # a resource created after the last fill only triggers a new fill once that fill is old enough
+        stale = entry is None or now - entry['Filled'] > name_cache_ttl or (resource_id not in entry['Names'] and now - entry['Filled'] > name_cache_miss_refresh)
+
+    if stale:
+        _fill_in_background(ec2_client, accountid)
+    return name
@@ -0,0 +1,141 @@
+import logging
+import os
+import threading
+import time
+
+from huit_public_compliance_snapshot import load_snapshot, update_snapshot_vpc, invalidate_snapshot, snapshot_ttl
+
+
+# define global logger
+logger = logging.getLogger(__name__)
+
+# seconds a VPC public-subnet index is kept in warm Lambda memory
+subnet_index_ttl = int(os.environ.get('SubnetIndexTTL', 300))
+
+# a subnet missing from an index older than this many seconds triggers a rebuild,
+# in case it was associated with its own route table after the index was built
+subnet_index_miss_refresh = int(os.environ.get('SubnetIndexMissRefresh', 60))
+
+
+# (accountid, region, vpcid) -> index, kept between warm invocations
+_subnet_index = {}
+_subnet_index_lock = threading.Lock()
+
+
+
+def is_public_route_table(route_table):
+
+    # Check if a route table sends 0.0.0.0/0 to an internet gateway
+    #
+    # Input: route table as returned by describe_route_tables
+    # Output: True if the route table is public
+
+    for route in route_table.get('Routes', []):
+        gid = route.get('GatewayId', '')
+        destinationcidr = route.get('DestinationCidrBlock', '')
+        if gid.startswith('igw-') and destinationcidr == '0.0.0.0/0':
+            logger.debug(f"Found igw route {route} in route table {route_table['RouteTableId']}")
+            return True
+    return False
+
+
+
+def build_subnet_index(client, vpcid):
+
+    # Build the public/private verdict for every subnet of a VPC
+    #
+    # Input: EC2 client, vpcid
+    # Output: index with explicit subnet verdicts and the main route table verdict
+
+    logger.info(f"Building public subnet index for VPC {vpcid}")
+    subnets = {}
+    main_public = False
+    paginator = client.get_paginator('describe_route_tables')
+    for page in paginator.paginate(Filters=[{'Name':'vpc-id','Values': [vpcid]}]):
+        for route_table in page['RouteTables']:
+            public = is_public_route_table(route_table)
+            for association in route_table.get('Associations', []):
+                state = association.get('AssociationState', {}).get('State', 'associated')
+                if state != 'associated':
+                    continue
+                if association.get('Main'):
+                    main_public = public
+                elif 'SubnetId' in association:
+                    subnets[association['SubnetId']] = public
+
+    return {'Built': time.time(), 'Subnets': subnets, 'MainPublic': main_public}
+
+
+
+def is_index_expired(index):
+
+    # Check if a subnet index is too old to be used
+    #
+    # Input: subnet index
+    # Output: True if it was read from AWS more than SubnetIndexTTL, or SnapshotTTL for snapshot verdicts, seconds ago
+
+    ttl = snapshot_ttl if index.get('Snapshot') else subnet_index_ttl
+    return time.time() - index['Built'] > ttl
+
+
+
+def get_subnet_index(client, accountid, vpcid, refresh=False):
+
+    # Get the cached public subnet index for a VPC, building it if needed
+    #
+    # Input: EC2 client for the VPC's region, account id, vpcid, flag to force a rebuild
+    # Output: subnet index
+
+    key = (accountid, client.meta.region_name, vpcid)
+    index = _subnet_index.get(key)
+    if index is None and not refresh:
+        # a new container starts from the verdicts another one already read from AWS
+        snapshot = load_snapshot(accountid, client.meta.region_name)
+        vpc = snapshot['Vpcs'].get(vpcid) if snapshot is not None else None
+        if vpc is not None:
+            # the verdicts are as old as the snapshot's read from AWS, not as old as this load
+            index = {'Built': vpc['Built'], 'Subnets': dict(vpc['Subnets']), 'MainPublic': vpc['MainPublic'], 'Snapshot': True}
+            with _subnet_index_lock:
+                _subnet_index[key] = index
+    if refresh or index is None or is_index_expired(index):
+        index = build_subnet_index(client, vpcid)
+        with _subnet_index_lock:
+            _subnet_index[key] = index
+        update_snapshot_vpc(accountid, client.meta.region_name, vpcid, index['Subnets'], index['MainPublic'])
+    return index
+
+
+
+def invalidate_subnet_index(accountid, region=None, vpcid=None):
+
+    # Drop cached subnet indexes for a VPC, or for all VPCs of an account or region, and their snapshot
+    #
+    # Input: account id, optional region, optional vpcid
+    # Output: None
+
+    with _subnet_index_lock:
+        for key in list(_subnet_index):
+            if key[0] == accountid and region in (None, key[1]) and vpcid in (None, key[2]):
+                del _subnet_index[key]
+    if region is not None:
+        invalidate_snapshot(accountid, region, vpcid)
+
+
+
+def is_subnet_public(client, accountid, vpcid, subnetid):
+
+    # Look up the public/private verdict for a subnet
+    #
+    # Input: EC2 client, account id, vpcid, subnetid
+    # Output: True if the subnet routes to an internet gateway
+
+    index = get_subnet_index(client, accountid, vpcid)
+    if subnetid not in index['Subnets'] and time.time() - index['Built'] > subnet_index_miss_refresh:
+        index = get_subnet_index(client, accountid, vpcid, refresh=True)
+
+    if subnetid in index['Subnets']:
+        return index['Subnets'][subnetid]
+
+    # this subnet is associated with the main VPC route table
+    logger.info(f"Subnet {subnetid} is using the main VPC route table")
+    return index['MainPublic']
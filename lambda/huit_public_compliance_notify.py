@@ -0,0 +1,441 @@
+import concurrent.futures
+import json
+import logging
+import os
+import threading
+import time
+
+from botocore.config import Config
+
+from huit_public_compliance_utils import get_local_client
+
+
+# define global logger
+logger = logging.getLogger(__name__)
+
+# Notification Information
+sns_topic = os.environ.get('Topic')
+slack_url = os.environ.get('SlackURL')
+sendtoslack = os.environ.get('SendToSlack') in ['true', 'True', 'yes', 'Yes']
+sendtosns = os.environ.get('SendToSNS') in ['true', 'True', 'yes', 'Yes']
+
+# SQS queue holding notifications that could not be delivered
+outbox_url = os.environ.get('NotificationOutbox')
+
+# seconds allowed to connect to and read from a notification channel
+notify_timeout = float(os.environ.get('NotifyTimeout', 3))
+
+# consecutive failures that open a channel's circuit, and how long it stays open
+breaker_threshold = int(os.environ.get('NotifyBreakerThreshold', 3))
+breaker_seconds = int(os.environ.get('NotifyBreakerSeconds', 300))
+
+# outbox messages are dropped after this many delivery attempts
+outbox_max_attempts = int(os.environ.get('NotifyMaxAttempts', 10))
+
+# Immediate sends a notification per finding, Digest queues the findings and sends a grouped summary on a schedule
+notify_mode = os.environ.get('NotifyMode', 'Immediate')
+
+# SQS queue holding the findings of the next digest
+digest_url = os.environ.get('NotificationDigest')
+
+# in digest mode, stopped instances are still notified when they are stopped
+digest_immediate_stops = os.environ.get('DigestImmediateStops', 'true') in ['true', 'True', 'yes', 'Yes']
+
+# Slack incoming webhooks accept about one message a second, 0 sends without waiting
+slack_rate = float(os.environ.get('SlackMessagesPerSecond', 1))
+
+# longest wait for a Slack slot, later messages go to the outbox instead of holding the invocation
+const_max_slot_wait = 5
+
+# characters per digest message and instances listed per action, longer digests are split
+const_digest_max_chars = 3500
+const_digest_instances = 50
+
+# audit action of a finding that is always sent immediately when DigestImmediateStops is set
+const_action_stopped = 'Instance stopped'
+
+# channel names
+const_channel_slack = 'slack'
+const_channel_sns = 'sns'
+
+
+# shared between warm invocations
+_http = None
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+_pending = []
+_pending_lock = threading.Lock()
+_digest_pending = []
+_next_send = {}
+_rate_lock = threading.Lock()
+_breakers = {}
+_breaker_lock = threading.Lock()
+
+
+
+def _get_http():
+
+    # Get the shared connection pool used for Slack, urllib3 is only loaded when Slack is used
+    #
+    # Input: None
+    # Output: urllib3.PoolManager
+
+    global _http
+    if _http is None:
+        import urllib3
+        _http = urllib3.PoolManager(timeout=urllib3.Timeout(connect=notify_timeout, read=notify_timeout), retries=False)
+    return _http
+
+
+
+def _get_sns():
+
+    # Get the SNS client, with the same strict timeouts as Slack
+    #
+    # Input: None
+    # Output: boto3 SNS client
+
+    config = Config(connect_timeout=notify_timeout, read_timeout=notify_timeout, retries={'max_attempts': 2})
+    return get_local_client('sns', config)
+
+
+
+def is_circuit_open(channel):
+
+    # Check if a channel has failed too often to be tried now
+    #
+    # Input: channel name
+    # Output: True if sends to the channel should be skipped
+
+    breaker = _breakers.get(channel)
+    return breaker is not None and breaker['Failures'] >= breaker_threshold and time.time() < breaker['OpenUntil']
+
+
+
+def _record_result(channel, success):
+
+    # Update a channel's circuit breaker after a send
+    #
+    # Input: channel name, whether the send succeeded
+    # Output: None
+
+    with _breaker_lock:
+        breaker = _breakers.setdefault(channel, {'Failures': 0, 'OpenUntil': 0})
+        if success:
+            breaker['Failures'] = 0
+        else:
+            breaker['Failures'] += 1
+            if breaker['Failures'] >= breaker_threshold:
+                breaker['OpenUntil'] = time.time() + breaker_seconds
+                logger.warning(f"Opening circuit for {channel} notifications for {breaker_seconds} seconds")
+
+
+
+def _wait_for_slot(channel):
+
+    # Space the messages sent to Slack from this container to the webhook rate limit
+    #
+    # Input: channel name
+    # Output: True once the message can be sent, False if that would take longer than const_max_slot_wait
+
+    if channel != const_channel_slack or slack_rate <= 0:
+        return True
+    with _rate_lock:
+        now = time.monotonic()
+        slot = max(now, _next_send.get(channel, 0))
+        if slot - now > const_max_slot_wait:
+            return False
+        _next_send[channel] = slot + 1 / slack_rate
+    if slot > now:
+        time.sleep(slot - now)
+    return True
+
+
+
+def deliver(channel, subject, message):
+
+    # Send a message to one channel
+    #
+    # Input: channel name, subject, message
+    # Output: None, raises an exception if the channel did not accept the message
+
+    if channel == const_channel_slack:
+        response = _get_http().request("POST", slack_url, body=json.dumps({'text': message}), headers={"Content-Type": "application/json"})
+        if response.status >= 300:
+            raise Exception(f"Slack returned HTTP {response.status}")
+    else:
+        _get_sns().publish(TargetArn= sns_topic, Subject=subject, Message=message)
+
+
+
+def add_to_outbox(channel, subject, message, attempts=0):
+
+    # Keep an undelivered message for a later retry
+    #
+    # Input: channel name, subject, message, delivery attempts so far
+    # Output: None
+
+    if not outbox_url:
+        logger.error(f"Dropping {channel} notification, no outbox configured: {message}")
+        return
+    body = json.dumps({'Channel': channel, 'Subject': subject, 'Message': message, 'Attempts': attempts})
+    get_local_client('sqs').send_message(QueueUrl=outbox_url, MessageBody=body)
+
+
+
+def _send(channel, subject, message, attempts=0):
+
+    # Send a message to a channel, moving it to the outbox if that fails
+    #
+    # Input: channel name, subject, message, delivery attempts so far
+    # Output: True if the message was delivered
+
+    if is_circuit_open(channel):
+        logger.info(f"Circuit open for {channel}, sending notification to outbox")
+        add_to_outbox(channel, subject, message, attempts)
+        return False
+
+    # not a failure, the outbox sends it once the burst is over
+    if not _wait_for_slot(channel):
+        logger.info(f"Rate limit of {channel} reached, sending notification to outbox")
+        add_to_outbox(channel, subject, message, attempts)
+        return False
+
+    try:
+        deliver(channel, subject, message)
+        _record_result(channel, True)
+        return True
+    except Exception as e:
+        logger.error(f"Unable to send {channel} notification: {e}")
+        _record_result(channel, False)
+        add_to_outbox(channel, subject, message, attempts + 1)
+        return False
+
+
+
+def get_channels():
+
+    # Get the enabled notification channels
+    #
+    # Input: None
+    # Output: list of channel names
+
+    channels = []
+    if sendtoslack:
+        channels.append(const_channel_slack)
+    if sendtosns:
+        channels.append(const_channel_sns)
+    return channels
+
+
+
+def is_digest_enabled():
+
+    # Check if findings are sent as digests
+    #
+    # Input: None
+    # Output: True if NotifyMode is Digest and a digest queue is configured
+
+    return notify_mode == 'Digest' and bool(digest_url)
+
+
+
+def send_notification(subject, message, finding=None):
+
+    # Send a notification to every enabled channel without waiting for delivery, or keep its finding for the next digest
+    #
+    # Input: subject, message, optional finding with AccountId, VpcName, SubnetName, ResourceType, Action, Instances and Time
+    # Output: None
+
+    if finding is not None and is_digest_enabled() and not (digest_immediate_stops and finding['Action'] == const_action_stopped):
+        with _pending_lock:
+            _digest_pending.append(finding)
+        return
+
+    channels = get_channels()
+    with _pending_lock:
+        for channel in channels:
+            logger.info(f"Sending {channel} message")
+            _pending.append(_executor.submit(_send, channel, subject, message))
+
+
+
+def flush_notifications():
+
+    # Wait for the notifications sent during this invocation
+    #
+    # Input: None
+    # Output: None
+
+    with _pending_lock:
+        findings = list(_digest_pending)
+        _digest_pending.clear()
+    if findings:
+        queue_findings(findings)
+
+    with _pending_lock:
+        pending = list(_pending)
+        _pending.clear()
+    for future in concurrent.futures.as_completed(pending):
+        try:
+            future.result()
+        except Exception as e:
+            logger.error(f"Notification failed: {e}")
+
+
+
+def outbox_handler(event, context):
+
+    # Lambda handler that retries the notifications kept in the outbox
+    #
+    # Input: event with a NotificationOutbox entry, context objects
+    # Output: number of messages delivered and still pending
+
+    summary = {'Delivered': 0, 'Requeued': 0, 'Dropped': 0, 'Deferred': 0}
+    if not outbox_url:
+        return summary
+
+    sqs = get_local_client('sqs')
+    while context.get_remaining_time_in_millis() > 30000:
+        response = sqs.receive_message(QueueUrl=outbox_url, MaxNumberOfMessages=10, WaitTimeSeconds=1)
+        messages = response.get('Messages', [])
+        deferred = 0
+        for entry in messages:
+            body = json.loads(entry['Body'])
+            if is_circuit_open(body['Channel']):
+                # leave the message in the queue until the circuit closes
+                deferred += 1
+                continue
+            if body['Attempts'] >= outbox_max_attempts:
+                logger.error(f"Dropping {body['Channel']} notification after {body['Attempts']} attempts: {body['Message']}")
+                summary['Dropped'] += 1
+            elif _send(body['Channel'], body['Subject'], body['Message'], body['Attempts']):
+                summary['Delivered'] += 1
+            else:
+                summary['Requeued'] += 1
+            sqs.delete_message(QueueUrl=outbox_url, ReceiptHandle=entry['ReceiptHandle'])
+        summary['Deferred'] += deferred
+        if deferred == len(messages):
+            break
+
+    logger.info(f"Notification outbox: {json.dumps(summary)}")
+    return summary
+
+
+
+def queue_findings(findings):
+
+    # Add the findings of this invocation to the digest queue, sending them immediately if that fails
+    #
+    # Input: list of findings
+    # Output: None
+
+    sqs = get_local_client('sqs')
+    for n in range(0, len(findings), 10):
+        chunk = findings[n:n + 10]
+        try:
+            entries = [{'Id': str(i), 'MessageBody': json.dumps(finding)} for i, finding in enumerate(chunk)]
+            failed = sqs.send_message_batch(QueueUrl=digest_url, Entries=entries).get('Failed', [])
+            chunk = [chunk[int(entry['Id'])] for entry in failed]
+            if not chunk:
+                continue
+            logger.error(f"Unable to queue {len(chunk)} findings for the digest, sending them now")
+        except Exception as e:
+            logger.error(f"Unable to queue {len(chunk)} findings for the digest, sending them now: {e}")
+        subject, messages = render_digest(chunk)
+        for channel in get_channels():
+            for message in messages:
+                _send(channel, subject, message)
+
+
+
+def render_digest(findings):
+
+    # Render findings as a summary grouped by account, VPC and action
+    #
+    # Input: list of findings
+    # Output: (subject, list of messages of at most const_digest_max_chars characters)
+
+    # account -> VPC -> action -> list of "TYPE name (id)"
+    groups = {}
+    for finding in findings:
+        instances = groups.setdefault(finding['AccountId'], {}).setdefault(finding['VpcName'], {}).setdefault(finding['Action'], [])
+        instances.extend(f"{finding['ResourceType']} {instance}" for instance in finding['Instances'])
+
+    total = sum(len(finding['Instances']) for finding in findings)
+    times = sorted(finding['Time'] for finding in findings)
+    subject = f"Public subnet compliance digest: {total} instances in {len(groups)} accounts"
+    header = f"{subject}, {times[0][:16]} to {times[-1][:16]}"
+
+    lines = []
+    for accountid in sorted(groups):
+        lines.append(f"Account {accountid}")
+        for vpcname in sorted(groups[accountid]):
+            lines.append(f"  VPC {vpcname}")
+            for action, instances in sorted(groups[accountid][vpcname].items()):
+                listed = ', '.join(instances[:const_digest_instances])
+                if len(instances) > const_digest_instances:
+                    listed += f" and {len(instances) - const_digest_instances} more"
+                lines.append(f"    {action} ({len(instances)}): {listed}")
+
+    # split at line ends, every part starts with the header
+    messages = []
+    message = header
+    for line in lines:
+        if len(message) + len(line) + 1 > const_digest_max_chars:
+            messages.append(message)
+            message = f"{header} (continued)"
+        message += '\n' + line
+    messages.append(message)
+    return subject, messages
+
+
+
+def _send_all(channel, subject, messages):
+
+    # Send the parts of a digest to one channel in order
+    #
+    # Input: channel name, subject, messages
+    # Output: number of parts delivered, the others are in the outbox
+
+    return sum(1 for message in messages if _send(channel, subject, message))
+
+
+
+def digest_handler(event, context):
+
+    # Lambda handler that sends the findings queued since the last digest as a grouped summary
+    #
+    # Input: event with a NotificationDigest entry, context objects
+    # Output: number of findings and messages sent
+
+    summary = {'Findings': 0, 'Messages': 0, 'Delivered': 0}
+    if not digest_url:
+        return summary
+
+    sqs = get_local_client('sqs')
+    findings = []
+    receipts = []
+    while context.get_remaining_time_in_millis() > 60000:
+        response = sqs.receive_message(QueueUrl=digest_url, MaxNumberOfMessages=10, WaitTimeSeconds=1)
+        messages = response.get('Messages', [])
+        if not messages:
+            break
+        for entry in messages:
+            findings.append(json.loads(entry['Body']))
+            receipts.append(entry['ReceiptHandle'])
+
+    if findings:
+        subject, messages = render_digest(findings)
+        summary['Findings'] = len(findings)
+        summary['Messages'] = len(messages)
+        # channels are sent to in parallel, Slack parts are spaced to its rate limit
+        futures = [_executor.submit(_send_all, channel, subject, messages) for channel in get_channels()]
+        summary['Delivered'] = sum(future.result() for future in futures)
+
+    # undelivered parts are in the outbox, the findings are done
+    for n in range(0, len(receipts), 10):
+        entries = [{'Id': str(i), 'ReceiptHandle': receipt} for i, receipt in enumerate(receipts[n:n + 10])]
+        sqs.delete_message_batch(QueueUrl=digest_url, Entries=entries)
+
+    logger.info(f"Notification digest: {json.dumps(summary)}")
+    return summary
@@ -0,0 +1,492 @@
+import argparse
+import concurrent.futures
+import datetime
+import heapq
+import json
+import os
+import queue
+import sys
+import threading
+
+import boto3
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.exceptions import ClientError
+
+
+# secondary indexes of the audit table
+const_instance_index = 'InstanceIdIndex'
+const_resource_action_index = 'ResourceActionIndex'
+
+# actions recorded by the Lambda function
+const_actions = ['Instance stopped', 'None, in audit mode', 'None, exception tag found']
+const_resource_types = ['EC2', 'RDS']
+
+# sorts after every character used in DateTime, makes a date the inclusive upper bound of a key condition
+const_date_upper = '~'
+
+# items read per request
+const_page_size = 100
+
+# rollup items in the state table, see huit_public_compliance_rollup.py
+const_prefix_rollup = 'ROLLUP'
+
+# read capacity consumed by the queries of this process, per table or index
+consumed_capacity = {}
+
+
+
+def get_resource_action(resource_type, action):
+
+    # Build the partition key of the ResourceActionIndex, as written by the Lambda function
+    #
+    # Input: resource type, action
+    # Output: composite key
+
+    return f"{resource_type}#{action}"
+
+
+
+def _date_range(since, until):
+
+    # Convert a date range to DateTime bounds
+    #
+    # Input: first date, last date (YYYY-MM-DD, eastern time), either can be None
+    # Output: (lower bound, upper bound)
+
+    return since or '0000', (until or '9999') + const_date_upper
+
+
+
+def _record_capacity(response):
+
+    # Add the capacity consumed by a request to the totals
+    #
+    # Input: DynamoDB response
+    # Output: None
+
+    capacity = response.get('ConsumedCapacity')
+    if not capacity:
+        return
+    indexes = capacity.get('GlobalSecondaryIndexes') or {capacity['TableName']: capacity}
+    for name, units in indexes.items():
+        consumed_capacity[name] = consumed_capacity.get(name, 0) + units['CapacityUnits']
+
+
+
+def _query(client, tablename, index, key_name, key_value, since, until, limit=None, newest_first=False, sort_name='DateTime'):
+
+    # Query a table or index by partition key and DateTime range, one page at a time
+    #
+    # Input: DynamoDB client, table name, index name or None, partition key name and value, date range, maximum items, sort order,
+    #        name of the sort key starting with the date
+    # Output: generator of records
+
+    deserializer = TypeDeserializer()
+    lower, upper = _date_range(since, until)
+    kwargs = {
+        'TableName': tablename,
+        'KeyConditionExpression': '#k = :k AND #d BETWEEN :lower AND :upper',
+        'ExpressionAttributeNames': {'#k': key_name, '#d': sort_name},
+        'ExpressionAttributeValues': {':k': {'S': key_value}, ':lower': {'S': lower}, ':upper': {'S': upper}},
+        'ScanIndexForward': not newest_first,
+        'ReturnConsumedCapacity': 'INDEXES',
+        'Limit': const_page_size,
+    }
+    if index:
+        kwargs['IndexName'] = index
+
+    returned = 0
+    while True:
+        response = client.query(**kwargs)
+        _record_capacity(response)
+        for item in response['Items']:
+            yield {key: deserializer.deserialize(value) for key, value in item.items()}
+            returned += 1
+            if limit and returned >= limit:
+                return
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+
+def _is_missing_index(error):
+
+    # Check if a query failed because the index does not exist (yet)
+    #
+    # Input: ClientError
+    # Output: True if the index is missing
+
+    message = error.response['Error'].get('Message', '')
+    return error.response['Error']['Code'] == 'ValidationException' and 'index' in message.lower()
+
+
+
+def scan_records(client, tablename, filters, segments=4, limit=None, after=None, upto=None):
+
+    # Read records matching attribute values with a parallel segmented scan, the fallback when no index fits
+    #
+    # Input: DynamoDB client, table name, dict of attribute -> value, number of segments, maximum items,
+    #        optional DateTime range (after is exclusive, upto inclusive)
+    # Output: generator of records, in no particular order
+
+    deserializer = TypeDeserializer()
+    serializer = TypeSerializer()
+    kwargs = {'TableName': tablename, 'ReturnConsumedCapacity': 'TOTAL', 'Limit': const_page_size, 'TotalSegments': segments}
+    conditions = [f"#a{n} = :v{n}" for n in range(len(filters))]
+    names = {f"#a{n}": attribute for n, attribute in enumerate(filters)}
+    values = {f":v{n}": serializer.serialize(value) for n, value in enumerate(filters.values())}
+    if after:
+        conditions.append('#d > :after')
+        values[':after'] = {'S': after}
+    if upto:
+        conditions.append('#d <= :upto')
+        values[':upto'] = {'S': upto}
+    if after or upto:
+        names['#d'] = 'DateTime'
+    if conditions:
+        kwargs['FilterExpression'] = ' AND '.join(conditions)
+        kwargs['ExpressionAttributeNames'] = names
+        kwargs['ExpressionAttributeValues'] = values
+
+    # every segment is read by its own thread, pages are handed over as they arrive
+    pages = queue.Queue(maxsize=segments * 2)
+    stop = threading.Event()
+    done = object()
+
+    def hand_over(page):
+        # give up when the consumer stopped reading
+        while not stop.is_set():
+            try:
+                pages.put(page, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read_segment(segment):
+        try:
+            segment_kwargs = dict(kwargs, Segment=segment)
+            while True:
+                response = client.scan(**segment_kwargs)
+                if not hand_over(response) or 'LastEvaluatedKey' not in response:
+                    break
+                segment_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        finally:
+            hand_over(done)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=segments)
+    futures = [executor.submit(read_segment, segment) for segment in range(segments)]
+    returned = 0
+    finished = 0
+    try:
+        while finished < segments:
+            response = pages.get()
+            if response is done:
+                finished += 1
+                continue
+            _record_capacity(response)
+            for item in response['Items']:
+                yield {key: deserializer.deserialize(value) for key, value in item.items()}
+                returned += 1
+                if limit and returned >= limit:
+                    return
+        for future in futures:
+            future.result()
+    finally:
+        # a consumer that stops early leaves the remaining pages unread
+        stop.set()
+        executor.shutdown(wait=True)
+
+
+
+def query_instance(instanceid, since=None, until=None, tablename=None, limit=None, client=None):
+
+    # Get the records of an EC2 instance or RDS DB identifier, oldest first
+    #
+    # Input: instance id, date range, table name, maximum items, DynamoDB client
+    # Output: generator of records
+
+    client = client or boto3.client('dynamodb')
+    tablename = tablename or os.environ.get('DynamoTable', 'huit_public_compliance')
+    try:
+        yield from _query(client, tablename, const_instance_index, 'InstanceId', instanceid, since, until, limit)
+    except ClientError as e:
+        if not _is_missing_index(e):
+            raise
+        print(f"Index {const_instance_index} is missing, scanning the table", file=sys.stderr)
+        yield from _filter_dates(scan_records(client, tablename, {'InstanceId': instanceid}, limit=None), since, until, limit)
+
+
+
+def query_actions(resource_type, action=None, since=None, until=None, tablename=None, limit=None, client=None):
+
+    # Get the records of a resource type with one or all actions, oldest first
+    #
+    # Input: resource type (EC2 or RDS), action or None for all, date range, table name, maximum items, DynamoDB client
+    # Output: generator of records
+
+    client = client or boto3.client('dynamodb')
+    tablename = tablename or os.environ.get('DynamoTable', 'huit_public_compliance')
+    actions = [action] if action else const_actions
+    try:
+        # one query per action, merged on the sort key so the result stays in date order
+        streams = [_query(client, tablename, const_resource_action_index, 'ResourceAction', get_resource_action(resource_type, each), since, until)
+                   for each in actions]
+        merged = heapq.merge(*streams, key=lambda record: record['DateTime'])
+        for n, record in enumerate(merged):
+            if limit and n >= limit:
+                return
+            yield record
+    except ClientError as e:
+        if not _is_missing_index(e):
+            raise
+        print(f"Index {const_resource_action_index} is missing, scanning the table", file=sys.stderr)
+        filters = {'ResourceType': resource_type}
+        if action:
+            filters['Action'] = action
+        yield from _filter_dates(scan_records(client, tablename, filters), since, until, limit)
+
+
+
+def query_range(after, upto, tablename=None, segments=4, client=None):
+
+    # Get the records of every resource type and action in a DateTime range, oldest first
+    #
+    # Input: DateTime range (after is exclusive, upto inclusive), table name, number of scan segments if the index is missing,
+    #        DynamoDB client
+    # Output: generator of records
+
+    client = client or boto3.client('dynamodb')
+    tablename = tablename or os.environ.get('DynamoTable', 'huit_public_compliance')
+    try:
+        # one query per resource type and action reads only the range, the key condition bounds are narrowed here
+        streams = [_query(client, tablename, const_resource_action_index, 'ResourceAction', get_resource_action(resource_type, action), after, upto)
+                   for resource_type in const_resource_types for action in const_actions]
+        for record in heapq.merge(*streams, key=lambda record: record['DateTime']):
+            if after < record['DateTime'] <= upto:
+                yield record
+    except ClientError as e:
+        if not _is_missing_index(e):
+            raise
+        print(f"Index {const_resource_action_index} is missing, scanning the table", file=sys.stderr)
+        yield from scan_records(client, tablename, {}, segments, after=after, upto=upto)
+
+
+
+def query_account(accountid, since=None, until=None, tablename=None, limit=None, client=None):
+
+    # Get the records of an account, oldest first
+    #
+    # Input: account id, date range, table name, maximum items, DynamoDB client
+    # Output: generator of records
+
+    client = client or boto3.client('dynamodb')
+    tablename = tablename or os.environ.get('DynamoTable', 'huit_public_compliance')
+    yield from _query(client, tablename, None, 'AccountId', accountid, since, until, limit)
+
+
+
+def _filter_dates(records, since, until, limit):
+
+    # Keep the scanned records within a date range
+    #
+    # Input: records, date range, maximum items
+    # Output: generator of records
+
+    lower, upper = _date_range(since, until)
+    returned = 0
+    for record in records:
+        if lower <= record.get('DateTime', '') <= upper:
+            yield record
+            returned += 1
+            if limit and returned >= limit:
+                return
+
+
+
+def backfill_resource_action(tablename=None, segments=4, client=None):
+
+    # Add the ResourceAction attribute to records written before the index existed
+    #
+    # Input: table name, number of scan segments, DynamoDB client
+    # Output: number of records updated
+
+    client = client or boto3.client('dynamodb')
+    tablename = tablename or os.environ.get('DynamoTable', 'huit_public_compliance')
+    updated = 0
+    for record in scan_records(client, tablename, {}, segments):
+        if 'ResourceAction' in record or 'ResourceType' not in record or 'Action' not in record:
+            continue
+        client.update_item(TableName=tablename, Key={'AccountId': {'S': record['AccountId']}, 'DateTime': {'S': record['DateTime']}},
+                           UpdateExpression='SET ResourceAction = :ra',
+                           ExpressionAttributeValues={':ra': {'S': get_resource_action(record['ResourceType'], record['Action'])}})
+        updated += 1
+    return updated
+
+
+
+def query_rollups(accountid, since=None, until=None, tablename=None, client=None):
+
+    # Get the daily finding counts of an account
+    #
+    # Input: account id, date range, state table name, DynamoDB client
+    # Output: generator of rollups with AccountId, Day, ResourceType, Action and Count, oldest first
+
+    client = client or boto3.client('dynamodb')
+    tablename = tablename or os.environ.get('StateTable', 'huit_public_compliance-state')
+    yield from _query(client, tablename, None, 'Pk', f"{const_prefix_rollup}#{accountid}", since, until, sort_name='Sk')
+
+
+
+def summarize_rollups(rollups, period='day'):
+
+    # Add up daily finding counts per account, period, resource type and action
+    #
+    # Input: rollups, day, week (starting on Monday) or month
+    # Output: list of rows with AccountId, Period, ResourceType, Action and Count
+
+    totals = {}
+    for rollup in rollups:
+        day = rollup['Day']
+        if period == 'month':
+            day = day[:7]
+        elif period == 'week':
+            date = datetime.date.fromisoformat(day)
+            day = (date - datetime.timedelta(days=date.weekday())).isoformat()
+        key = (rollup['AccountId'], day, rollup['ResourceType'], rollup['Action'])
+        totals[key] = totals.get(key, 0) + int(rollup['Count'])
+    return [{'AccountId': accountid, 'Period': day, 'ResourceType': resource_type, 'Action': action, 'Count': count}
+            for (accountid, day, resource_type, action), count in sorted(totals.items())]
+
+
+
+def backfill_rollups(before, tablename=None, state_tablename=None, segments=4, client=None):
+
+    # Count the audit records written before the rollups were kept
+    #
+    # Input: time the audit table stream was enabled (YYYY-MM-DD HH:MM:SS, eastern time), table names, number of scan segments, DynamoDB client
+    # Output: number of records counted
+
+    client = client or boto3.client('dynamodb')
+    tablename = tablename or os.environ.get('DynamoTable', 'huit_public_compliance')
+    state_tablename = state_tablename or os.environ.get('StateTable', f"{tablename}-state")
+    totals = {}
+    for record in scan_records(client, tablename, {}, segments):
+        # records without ProcessedTime were all written before the stream existed, later ones are counted by the stream
+        if 'Action' not in record or record.get('ProcessedTime', '') >= before:
+            continue
+        key = (record['AccountId'], record['DateTime'][:10], record.get('ResourceType', 'UNKNOWN'), record['Action'])
+        totals[key] = totals.get(key, 0) + 1
+
+    for (accountid, day, resource_type, action), count in totals.items():
+        client.update_item(TableName=state_tablename,
+                           Key={'Pk': {'S': f"{const_prefix_rollup}#{accountid}"}, 'Sk': {'S': f"{day}#{resource_type}#{action}"}},
+                           UpdateExpression='ADD #count :n SET #account = :account, #day = :day, #type = :type, #action = :action',
+                           ExpressionAttributeNames={'#count': 'Count', '#account': 'AccountId', '#day': 'Day', '#type': 'ResourceType', '#action': 'Action'},
+                           ExpressionAttributeValues={':n': {'N': str(count)}, ':account': {'S': accountid}, ':day': {'S': day},
+                                                      ':type': {'S': resource_type}, ':action': {'S': action}})
+    return sum(totals.values())
+
+
+
+def _default(value):
+    # Decimal numbers and anything else JSON does not know are printed as strings or floats
+    return float(value) if hasattr(value, 'as_tuple') else str(value)
+
+
+
+def print_rollups(args):
+
+    # Print the finding counts of the accounts given on the command line
+    #
+    # Input: parsed arguments
+    # Output: None
+
+    accountids = args.accountids
+    if args.organization:
+        accountids = []
+        for page in boto3.client('organizations').get_paginator('list_accounts').paginate():
+            accountids.extend(account['Id'] for account in page['Accounts'] if account['Status'] == 'ACTIVE')
+    if not accountids:
+        sys.exit('Account ids or --organization are required')
+
+    client = boto3.client('dynamodb')
+    state_tablename = args.state_table or os.environ.get('StateTable', f"{args.table}-state")
+    rollups = (rollup for accountid in accountids
+               for rollup in query_rollups(accountid, args.since, args.until, state_tablename, client))
+    rows = summarize_rollups(rollups, args.period)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        for row in rows:
+            print(f"{row['AccountId']:14}{row['Period']:12}{row['ResourceType']:5}{row['Count']:8}  {row['Action']}")
+    capacity = ', '.join(f"{name} {units:.1f}" for name, units in consumed_capacity.items())
+    print(f"{len(rows)} rows, read capacity consumed: {capacity or 'none'}", file=sys.stderr)
+
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Query the public compliance audit table through its indexes')
+    parser.add_argument('--table', default=os.environ.get('DynamoTable', 'huit_public_compliance'), help='audit table name')
+    parser.add_argument('--since', help='first date, YYYY-MM-DD in eastern time')
+    parser.add_argument('--until', help='last date, YYYY-MM-DD in eastern time')
+    parser.add_argument('--days', type=int, help='only the last DAYS days, instead of --since')
+    parser.add_argument('--limit', type=int, help='maximum number of records')
+    parser.add_argument('--json', action='store_true', help='print one JSON record per line')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('instance', help='records of an EC2 instance id or RDS DB identifier')
+    command.add_argument('instanceid')
+    command = commands.add_parser('actions', help='records of a resource type and action')
+    command.add_argument('resource_type', choices=const_resource_types)
+    command.add_argument('action', nargs='?', choices=const_actions, help='all actions if omitted')
+    command = commands.add_parser('account', help='records of an account')
+    command.add_argument('accountid')
+    command = commands.add_parser('backfill', help='add the ResourceAction attribute to older records')
+    command.add_argument('--segments', type=int, default=4, help='parallel scan segments')
+    command = commands.add_parser('rollups', help='finding counts per account, period, resource type and action')
+    command.add_argument('accountids', nargs='*', help='account ids')
+    command.add_argument('--organization', action='store_true', help='every active account of the organization')
+    command.add_argument('--period', default='day', choices=['day', 'week', 'month'], help='period the counts are added up for')
+    command.add_argument('--state-table', help='state table name (default StateTable environment variable, or <table>-state)')
+    command = commands.add_parser('backfill-rollups', help='count the records written before the audit table stream was enabled')
+    command.add_argument('before', help='time the stream was enabled, "YYYY-MM-DD HH:MM:SS" in eastern time')
+    command.add_argument('--state-table', help='state table name (default StateTable environment variable, or <table>-state)')
+    command.add_argument('--segments', type=int, default=4, help='parallel scan segments')
+    args = parser.parse_args()
+
+    if args.days:
+        args.since = (datetime.date.today() - datetime.timedelta(days=args.days)).isoformat()
+
+    if args.command == 'backfill':
+        print(f"Updated {backfill_resource_action(args.table, args.segments)} records")
+        return
+    if args.command == 'backfill-rollups':
+        print(f"Counted {backfill_rollups(args.before, args.table, args.state_table, args.segments)} records")
+        return
+    if args.command == 'rollups':
+        print_rollups(args)
+        return
+    if args.command == 'instance':
+        records = query_instance(args.instanceid, args.since, args.until, args.table, args.limit)
+    elif args.command == 'actions':
+        records = query_actions(args.resource_type, args.action, args.since, args.until, args.table, args.limit)
+    else:
+        records = query_account(args.accountid, args.since, args.until, args.table, args.limit)
+
+    count = 0
+    for record in records:
+        count += 1
+        if args.json:
+            print(json.dumps(record, default=_default))
+        else:
+            print(f"{record.get('DateTime', '')[:19]:20}{record.get('AccountId', ''):14}{record.get('ResourceType', ''):5}"
+                  f"{record.get('InstanceId', ''):22}{record.get('Action', '')}")
+    capacity = ', '.join(f"{name} {units:.1f}" for name, units in consumed_capacity.items())
+    print(f"{count} records, read capacity consumed: {capacity or 'none'}", file=sys.stderr)
+
+
+
+if __name__ == '__main__':
+    main()
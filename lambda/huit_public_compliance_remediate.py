@@ -1,49 +1,76 @@
-import json
-import boto3
 import logging
-import os
-import urllib3
 import datetime
-import dateutil
 
 
 from huit_public_compliance_utils import const_resource_type_ec2, get_handles
-from huit_public_compliance_utils import const_resource_type_rds
-from huit_public_compliance_utils import const_resource_type_unknown
+from huit_public_compliance_utils import utc_timestamp, parse_utc_timestamp
+from huit_public_compliance_audit import add_audit_record
+from huit_public_compliance_notify import send_notification
+from huit_public_compliance_metrics import record_stage_latencies
+from huit_public_compliance_throttle import is_retryable
+
+# eastern time zone, loaded on first use since only remediations need it
+_eastern = None
+
+# stage timestamp -> latency attribute, measured from the event time
+const_stage_latencies = {
+    'HandlerStartTime': 'DetectionSeconds',
+    'VerdictTime': 'VerdictSeconds',
+    'StopIssuedTime': 'StopIssuedSeconds',
+    'StopAcceptedTime': 'StopAcceptedSeconds',
+}
+
+# instance ids passed in one CreateTags or StopInstances call
+const_instance_chunk_size = 100
 
-# setup for eastern time zone
-eastern = dateutil.tz.gettz('US/Eastern')
+# Setup logger
+logger = logging.getLogger(__name__)
 
-# get required boto3 resources
-sns = boto3.client('sns')
-dynamodb = boto3.resource('dynamodb')
 
-# DynamoDB Table
-tablename = os.environ.get('DynamoTable')
-table = dynamodb.Table(tablename)
 
-# Notification Information
-sns_topic = os.environ.get('Topic')
-slack_url = os.environ.get('SlackURL')
-sendtoslack = os.environ.get('SendToSlack') in ['true', 'True', 'yes', 'Yes']
-sendtosns = os.environ.get('SendToSNS') in ['true', 'True', 'yes', 'Yes']
+def get_eastern():
 
-# Setup logger
-logger = logging.getLogger(__name__)
-loglevel = os.environ.get('LogLevel', logging.INFO)
-logging.basicConfig(level=loglevel)
-logger.setLevel(loglevel)
+    # Get the eastern time zone used in messages and audit records
+    #
+    # Input: None
+    # Output: tzinfo
+
+    global _eastern
+    if _eastern is None:
+        from dateutil import tz
+        _eastern = tz.gettz('US/Eastern')
+    return _eastern
+
+
+
+def add_stage_latencies(params):
+
+    # Compute the seconds between the event and each stage the remediation reached
+    #
+    # Input: Parameters related to public resource, with EventTime and stage timestamps
+    # Output: None, latencies are added to the parameters
+
+    if not params.get('EventTime'):
+        return
+    event_time = parse_utc_timestamp(params['EventTime'])
+    for stage, latency in const_stage_latencies.items():
+        if params.get(stage):
+            params[latency] = round((parse_utc_timestamp(params[stage]) - event_time).total_seconds(), 3)
 
 
 
 def add_info_to_dynamo(params):
     
-    # Log information to DynamoDB Table
+    # Log information to DynamoDB Table, the record is written when the invocation ends
     #
     # Input: Parameters related to public resource
     # Output: None
 
-    table.put_item(Item= params)
+    add_stage_latencies(params)
+    record_stage_latencies(params)
+    # partition key of the ResourceActionIndex, every record of an action can be queried by date
+    params['ResourceAction'] = f"{params['ResourceType']}#{params['Action']}"
+    add_audit_record(params)
     return
 
 
@@ -60,6 +87,11 @@ def add_tag_to_instance(instance_type, instance_arn, instance_id, client, instan
 
 def stop_instance(instance_type, client, instance_id):
 
+    # Stop an EC2 or RDS instance
+    #
+    # Input: resource type, client, instance id
+    # Output: True if AWS accepted the stop request
+
     if instance_type == const_resource_type_ec2:
         client.stop_instances(InstanceIds=[instance_id])
     else:
@@ -70,9 +102,39 @@ def stop_instance(instance_type, client, instance_id):
             # we've already checked that it is in a 'stoppable' state, but may have changed
             # since that last check
             logger.info(f"Error trying to stop RDS instance {instance_id}: {e}")
-            pass
+            return False
                 
-    return
+    return True
+
+
+def _call_in_chunks(call, instance_ids, **kwargs):
+
+    # Make a multi-id EC2 call in chunks, falling back to one call per instance for a chunk AWS rejects
+    #
+    # Input: EC2 client method, instance ids, keyword name of the id list and other arguments
+    # Output: dict of instance id -> exception, for the instances the call failed for
+
+    failed = {}
+    id_argument = kwargs.pop('id_argument')
+    for n in range(0, len(instance_ids), const_instance_chunk_size):
+        chunk = instance_ids[n:n + const_instance_chunk_size]
+        try:
+            call(**{id_argument: chunk}, **kwargs)
+            continue
+        except Exception as e:
+            # throttling fails the whole group, it is retried later
+            if len(chunk) == 1 or is_retryable(e):
+                failed.update((instance_id, e) for instance_id in chunk)
+                continue
+            # one terminated instance fails the call for every id of the chunk
+            logger.info(f"{call.__name__} failed for {len(chunk)} instances, retrying them one by one: {e}")
+        for instance_id in chunk:
+            try:
+                call(**{id_argument: [instance_id]}, **kwargs)
+            except Exception as e:
+                failed[instance_id] = e
+    return failed
+
 
 
 def is_instance_stoppable(instance_type, client, instance_id):
@@ -89,9 +151,37 @@ def is_instance_stoppable(instance_type, client, instance_id):
 
 
 
+def get_audit_datetime(db_params, dt_db):
+
+    # Build the DateTime sort key of an audit record
+    #
+    # Input: DynamoDB parameters, formatted current time
+    # Output: sort key, derived from the event time and instance so a replayed event overwrites its row
+
+    event_time = db_params.get('EventTime')
+    if not event_time:
+        # executions started before event times were recorded
+        return db_params['DateTime'].replace('$currtime$', dt_db)
+
+    dt_event = parse_utc_timestamp(event_time)
+    return f"{dt_event.astimezone(get_eastern()).strftime('%Y-%m-%d %H:%M:%S')}#{db_params['InstanceId']}"
+
+
+
 def update_parameters(notify_params, tag_params, db_params):
 
-    dt = datetime.datetime.now(tz=eastern)
+    update_group_parameters(notify_params, tag_params, [db_params])
+
+
+
+def update_group_parameters(notify_params, tag_params, db_params_list):
+
+    # Set the current time in the tag, the message and the audit records of one or more instances
+    #
+    # Input: notification, tag and DynamoDB parameters of every instance
+    # Output: None
+
+    dt = datetime.datetime.now(tz=get_eastern())
 
     # format current time for messages
     dt_msg = dt.strftime("%b-%d at %Hh%M")
@@ -102,7 +192,23 @@ def update_parameters(notify_params, tag_params, db_params):
     # update parameters
     tag_params['Value'] = tag_params['Value'].replace('$currtime$', dt_msg)
     notify_params['Message'] = notify_params['Message'].replace('$currtime$', dt_msg)
-    db_params['DateTime'] = db_params['DateTime'].replace('$currtime$', dt_db)
+    for db_params in db_params_list:
+        db_params['DateTime'] = get_audit_datetime(db_params, dt_db)
+        db_params['ProcessedTime'] = dt_db
+
+
+
+def get_finding(db_params_list):
+
+    # Summarize the audit records of a notification for the digest
+    #
+    # Input: DynamoDB parameters of the instances sharing a notification
+    # Output: finding dict
+
+    db_params = db_params_list[0]
+    return {'AccountId': db_params['AccountId'], 'VpcName': db_params['VpcName'], 'SubnetName': db_params['SubnetName'],
+            'ResourceType': db_params['ResourceType'], 'Action': db_params['Action'], 'Time': db_params['ProcessedTime'],
+            'Instances': [f"{params['InstanceName']} ({params['InstanceId']})" for params in db_params_list]}
 
 
 
@@ -113,9 +219,10 @@ def remediate_and_notify(compliance_mode, is_exception, instance_params, notify_
     instance_type = instance_params['ResourceType']
     instance_id = instance_params['InstanceId']
     instance_arn = instance_params['InstanceArn']
+    # step function executions started before regions were tracked have no Region
+    region = instance_params.get('Region')
 
-    # fix later
-    client, instance = get_handles(account_id, instance_type)
+    client, instance = get_handles(account_id, instance_type, region)
 
     ok_to_proceed = True
     if compliance_mode and not is_exception:
@@ -136,24 +243,19 @@ def remediate_and_notify(compliance_mode, is_exception, instance_params, notify_
         # Stop the resource if necessary
         if compliance_mode and not is_exception:
             logger.info(f"Stopping {instance_type.upper()} instance {instance_id}")
-            stop_instance(instance_type, client, instance_id)
+            db_params['StopIssuedTime'] = utc_timestamp()
+            if stop_instance(instance_type, client, instance_id):
+                db_params['StopAcceptedTime'] = utc_timestamp()
 
         # Add info to DynamoDB Table
         logger.info("Logging data to DynamoDB")
         add_info_to_dynamo(db_params)
 
-        # Send notifications as required
+        # Send notifications as required, delivery completes in the background
         message = notify_params['Message']
         subject = notify_params['Subject']
         logger.info(message)
-        if sendtoslack:
-            logger.info("Sending Slack message")
-            slackmessage = json.dumps({'text':message})
-            http = urllib3.PoolManager()
-            http.request("POST", slack_url, body=slackmessage, headers={"Content-Type": "application/json"})
-        if sendtosns:
-            logger.info("Sending SNS message")
-            sns.publish(TargetArn= sns_topic, Subject=subject, Message=message)
+        send_notification(subject, message, get_finding([db_params]))
 
     else:
         logger.info("Instance cannot be stopped, going into wait-state")
@@ -162,3 +264,46 @@ def remediate_and_notify(compliance_mode, is_exception, instance_params, notify_
 
 
 
+def remediate_and_notify_group(compliance_mode, is_exception, instance_params, notify_params, tag_params, db_params_list):
+
+    # Tag, stop and notify EC2 instances of a scaling group that share a subnet and a verdict, with multi-id calls
+    #
+    # Input: compliance mode, exception flag, instance parameters with AccountId, Region and InstanceIds,
+    #        notification and tag parameters shared by the group, DynamoDB parameters of every instance
+    # Output: dict of instance id -> exception, for the instances that could not be remediated
+
+    account_id = instance_params['AccountId']
+    region = instance_params['Region']
+    instance_ids = instance_params['InstanceIds']
+    client, ec2 = get_handles(account_id, const_resource_type_ec2, region)
+
+    update_group_parameters(notify_params, tag_params, db_params_list)
+
+    logger.info(f"Adding tags to {len(instance_ids)} instances")
+    failed = _call_in_chunks(client.create_tags, instance_ids, id_argument='Resources',
+                             Tags=[{'Key': tag_params['Key'], 'Value': tag_params['Value']}])
+
+    if compliance_mode and not is_exception:
+        stopping = [instance_id for instance_id in instance_ids if instance_id not in failed]
+        logger.info(f"Stopping {len(stopping)} EC2 instances")
+        stop_issued = utc_timestamp()
+        failed.update(_call_in_chunks(client.stop_instances, stopping, id_argument='InstanceIds'))
+        stop_accepted = utc_timestamp()
+        for db_params in db_params_list:
+            db_params['StopIssuedTime'] = stop_issued
+            if db_params['InstanceId'] not in failed:
+                db_params['StopAcceptedTime'] = stop_accepted
+
+    # one audit record per instance, written with the other records of the invocation in BatchWriteItem calls
+    remediated = [db_params for db_params in db_params_list if db_params['InstanceId'] not in failed]
+    for db_params in remediated:
+        add_info_to_dynamo(db_params)
+
+    # one notification for the group
+    if remediated:
+        message = notify_params['Message']
+        subject = notify_params['Subject']
+        logger.info(message)
+        send_notification(subject, message, get_finding(remediated))
+
+    return failed
@@ -0,0 +1,122 @@
+import argparse
+import json
+import os
+
+import boto3
+from boto3.dynamodb.types import TypeDeserializer
+
+
+# latencies recorded on audit records, in seconds after the event time
+const_latency_attributes = ['DetectionSeconds', 'VerdictSeconds', 'StopIssuedSeconds', 'StopAcceptedSeconds']
+
+# percentiles reported
+const_percentiles = [50, 95, 99]
+
+
+
+def percentile(values, pct):
+
+    # Nearest-rank percentile
+    #
+    # Input: list of values, percentile between 0 and 100
+    # Output: value
+
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+
+
+def read_audit_records(tablename, since=None, accountid=None):
+
+    # Read the audit records that carry stage latencies
+    #
+    # Input: table name, optional first date (YYYY-MM-DD, eastern time), optional account id
+    # Output: generator of records
+
+    client = boto3.client('dynamodb')
+    deserializer = TypeDeserializer()
+    attributes = ['AccountId', 'DateTime', 'ResourceType', 'Action'] + const_latency_attributes
+    names = {f"#a{n}": attribute for n, attribute in enumerate(attributes)}
+    kwargs = {
+        'TableName': tablename,
+        'ProjectionExpression': ', '.join(names),
+        'ExpressionAttributeNames': names,
+    }
+
+    conditions = []
+    values = {}
+    if accountid:
+        conditions.append('#a0 = :account')
+        values[':account'] = {'S': accountid}
+    if since:
+        conditions.append('#a1 >= :since')
+        values[':since'] = {'S': since}
+    if conditions:
+        kwargs['ExpressionAttributeValues'] = values
+
+    # AccountId and DateTime are the table's keys, an account is read with a query instead of a scan
+    if accountid:
+        kwargs['KeyConditionExpression'] = ' AND '.join(conditions)
+        paginator = client.get_paginator('query')
+    else:
+        if conditions:
+            kwargs['FilterExpression'] = ' AND '.join(conditions)
+        paginator = client.get_paginator('scan')
+    for page in paginator.paginate(**kwargs):
+        for item in page['Items']:
+            yield {key: deserializer.deserialize(value) for key, value in item.items()}
+
+
+
+def summarize(records, metric):
+
+    # Compute latency percentiles per account and resource type, and per resource type
+    #
+    # Input: records, latency attribute
+    # Output: list of summary rows
+
+    groups = {}
+    for record in records:
+        if metric not in record:
+            continue
+        value = float(record[metric])
+        resource_type = record.get('ResourceType', 'UNKNOWN')
+        groups.setdefault((record['AccountId'], resource_type), []).append(value)
+        groups.setdefault(('ALL', resource_type), []).append(value)
+
+    rows = []
+    for (accountid, resource_type), values in sorted(groups.items()):
+        row = {'AccountId': accountid, 'ResourceType': resource_type, 'Count': len(values)}
+        for pct in const_percentiles:
+            row[f"p{pct}"] = percentile(values, pct)
+        row['Max'] = max(values)
+        rows.append(row)
+    return rows
+
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Report detection-to-remediation latency percentiles from the audit table')
+    parser.add_argument('--table', default=os.environ.get('DynamoTable', 'huit_public_compliance'), help='audit table name')
+    parser.add_argument('--metric', default='StopAcceptedSeconds', choices=const_latency_attributes, help='latency to report')
+    parser.add_argument('--since', help='only records from this date on, YYYY-MM-DD in eastern time')
+    parser.add_argument('--account', help='only records of this account')
+    parser.add_argument('--json', action='store_true', help='print the rows as JSON')
+    args = parser.parse_args()
+
+    rows = summarize(read_audit_records(args.table, args.since, args.account), args.metric)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+
+    print(f"{args.metric}")
+    print(f"{'account':14}{'type':6}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for row in rows:
+        print(f"{row['AccountId']:14}{row['ResourceType']:6}{row['Count']:8}{row['p50']:10.1f}{row['p95']:10.1f}{row['p99']:10.1f}{row['Max']:10.1f}")
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+import logging
+import time
+
+from botocore.exceptions import ClientError
+
+from huit_public_compliance_utils import get_local_client
+from huit_public_compliance_state import state_table, event_ttl
+
+
+# define global logger
+logger = logging.getLogger(__name__)
+
+# key prefix of the rollup items in the state table, they have no ExpiresAt and are kept
+const_prefix_rollup = 'ROLLUP'
+
+# key prefix of the markers of the audit records already counted, kept as long as processed events
+const_prefix_counted = 'COUNTED'
+
+# TransactWriteItems accepts at most 100 items, the markers of a run and its rollup update
+const_transaction_records = 99
+
+
+
+def get_rollup_key(accountid, day, resource_type, action):
+
+    # Build the key of a rollup item, one per account, day, resource type and action
+    #
+    # Input: account id, day (YYYY-MM-DD, eastern time), resource type, action
+    # Output: DynamoDB key
+
+    return {'Pk': {'S': f"{const_prefix_rollup}#{accountid}"}, 'Sk': {'S': f"{day}#{resource_type}#{action}"}}
+
+
+
+def parse_stream_record(record):
+
+    # Get the rollup an audit table stream record counts towards
+    #
+    # Input: DynamoDB stream record
+    # Output: ((account id, day, resource type, action), audit item key), None if the record is not a new audit record
+
+    # a replayed event overwrites its audit record, only the first write is counted
+    if record.get('eventName') != 'INSERT':
+        return None
+    image = record['dynamodb'].get('NewImage', {})
+    if 'Action' not in image or 'DateTime' not in image:
+        return None
+    resource_type = image.get('ResourceType', {}).get('S', 'UNKNOWN')
+    rollup = (image['AccountId']['S'], image['DateTime']['S'][:10], resource_type, image['Action']['S'])
+    return rollup, f"{image['AccountId']['S']}#{image['DateTime']['S']}"
+
+
+
+def add_to_rollup(client, rollup, keys):
+
+    # Atomically add audit records to a rollup item, creating it on first use, and remember them as counted
+    #
+    # Input: DynamoDB client, (account id, day, resource type, action), audit item keys of the records
+    # Output: None, the transaction is cancelled if one of the records was already counted
+
+    accountid, day, resource_type, action = rollup
+    keys = list(dict.fromkeys(keys))
+    expires = str(int(time.time()) + event_ttl)
+    markers = [{'Put': {'TableName': state_table, 'ConditionExpression': 'attribute_not_exists(Pk)',
+                        'Item': {'Pk': {'S': const_prefix_counted}, 'Sk': {'S': key}, 'ExpiresAt': {'N': expires}}}}
+               for key in keys]
+    update = {'Update': {'TableName': state_table, 'Key': get_rollup_key(accountid, day, resource_type, action),
+        'UpdateExpression': 'ADD #count :n SET #account = :account, #day = :day, #type = :type, #action = :action, #updated = :updated',
+        'ExpressionAttributeNames': {'#count': 'Count', '#account': 'AccountId', '#day': 'Day', '#type': 'ResourceType',
+                                     '#action': 'Action', '#updated': 'UpdatedAt'},
+        'ExpressionAttributeValues': {':n': {'N': str(len(keys))}, ':account': {'S': accountid}, ':day': {'S': day},
+                                      ':type': {'S': resource_type}, ':action': {'S': action}, ':updated': {'N': str(int(time.time()))}}}}
+    client.transact_write_items(TransactItems=markers + [update])
+
+
+
+def is_already_counted(error):
+
+    # Check if a rollup transaction was cancelled only because some of its records were counted before
+    #
+    # Input: exception raised by add_to_rollup
+    # Output: True if the records without a marker can be counted on their own
+
+    if not isinstance(error, ClientError) or error.response['Error']['Code'] != 'TransactionCanceledException':
+        return False
+    reasons = [reason.get('Code') for reason in error.response.get('CancellationReasons', [])]
+    return 'ConditionalCheckFailed' in reasons and all(reason in ('None', 'ConditionalCheckFailed') for reason in reasons)
+
+
+
+def add_run(client, rollup, keys):
+
+    # Add a run of audit records to its rollup, skipping the records a previous delivery of the stream already counted
+    #
+    # Input: DynamoDB client, (account id, day, resource type, action), audit item keys of the records
+    # Output: number of records counted
+
+    try:
+        add_to_rollup(client, rollup, keys)
+        return len(set(keys))
+    except Exception as e:
+        if not is_already_counted(e):
+            raise
+    # a redelivered run, each record is counted with its own transaction so the new ones are not lost
+    counted = 0
+    for key in dict.fromkeys(keys):
+        try:
+            add_to_rollup(client, rollup, [key])
+            counted += 1
+        except Exception as e:
+            if not is_already_counted(e):
+                raise
+    logger.info(f"Skipped {len(set(keys)) - counted} records of rollup {rollup} counted by a previous delivery")
+    return counted
+
+
+
+def stream_handler(event, context):
+
+    # Lambda handler for the audit table stream, counts new audit records per account, day, resource type and action
+    #
+    # Input: DynamoDB stream event, context objects
+    # Output: partial batch response, the stream is retried from the first record not counted
+
+    # consecutive records of the same rollup, e.g. the instances of a scaling group, are added with one transaction
+    runs = []
+    for record in event['Records']:
+        parsed = parse_stream_record(record)
+        if parsed is None:
+            continue
+        rollup, key = parsed
+        if runs and runs[-1][0] == rollup and len(runs[-1][2]) < const_transaction_records:
+            runs[-1][2].append(key)
+        else:
+            runs.append([rollup, record['dynamodb']['SequenceNumber'], [key]])
+
+    client = get_local_client('dynamodb')
+    counted = 0
+    for n, (rollup, sequence_number, keys) in enumerate(runs):
+        try:
+            counted += add_run(client, rollup, keys)
+        except Exception as e:
+            # the records already counted keep their marker, so the retry does not count them twice
+            logger.error(f"Failed adding {len(keys)} records to rollup {rollup}, {len(runs) - n} rollup updates left: {e}")
+            return {'batchItemFailures': [{'itemIdentifier': sequence_number}]}
+
+    logger.info(f"Counted {counted} of {len(event['Records'])} stream records in {len(runs)} rollup updates")
+    return {'batchItemFailures': []}
@@ -0,0 +1,215 @@
+import logging
+
+from huit_public_compliance_utils import get_handles, get_event_region, utc_timestamp
+from huit_public_compliance_network import get_subnet_index, invalidate_subnet_index
+
+from huit_public_compliance_utils import const_resource_type_ec2
+from huit_public_compliance_utils import const_resource_type_rds
+
+from huit_public_compliance import get_ec2_details, get_rds_details, evaluate_instance, write_audit_records
+
+from huit_public_compliance_state import is_event_processed, mark_event_processed, acquire_lease, release_lease
+from huit_public_compliance_throttle import RetryableError, is_retryable
+
+
+# define global logger
+logger = logging.getLogger(__name__)
+
+# DB instance states that have nothing to stop
+const_rds_inactive_states = ['stopped', 'stopping', 'deleting', 'deleted', 'failed']
+
+
+
+def can_make_public(detail):
+
+    # Check if a route change can send a subnet to an internet gateway
+    #
+    # Input: CloudTrail record
+    # Output: True if the change needs the affected subnets to be re-evaluated
+
+    if detail.get('errorCode'):
+        return False
+    if detail['eventName'] in ['CreateRoute', 'ReplaceRoute']:
+        request = detail.get('requestParameters') or {}
+        return request.get('destinationCidrBlock') == '0.0.0.0/0' and str(request.get('gatewayId', '')).startswith('igw-')
+    # any association can move a subnet to a public route table
+    return True
+
+
+
+def get_affected_subnets(route_table, detail):
+
+    # Find the subnets whose routing changed
+    #
+    # Input: changed route table as returned by describe_route_tables, CloudTrail record
+    # Output: list of explicitly associated subnet ids, True if the subnets using the main route table are affected
+
+    request = detail.get('requestParameters') or {}
+    response = detail.get('responseElements') or {}
+
+    if detail['eventName'] == 'AssociateRouteTable':
+        return ([request['subnetId']] if request.get('subnetId') else []), False
+
+    associations = [association for association in route_table.get('Associations', [])
+                    if association.get('AssociationState', {}).get('State', 'associated') == 'associated']
+    if detail['eventName'] == 'ReplaceRouteTableAssociation':
+        associations = [association for association in associations
+                        if association['RouteTableAssociationId'] == response.get('newAssociationId')]
+
+    subnets = [association['SubnetId'] for association in associations if 'SubnetId' in association]
+    main = any(association.get('Main') for association in associations)
+    return subnets, main
+
+
+
+def find_ec2_instances(ec2_client, vpcid, is_affected):
+
+    # Find the running EC2 instances of a VPC in affected subnets
+    #
+    # Input: EC2 client, vpcid, function telling if a subnet is affected
+    # Output: list of instances as returned by describe_instances
+
+    instances = []
+    paginator = ec2_client.get_paginator('describe_instances')
+    filters = [{'Name': 'vpc-id', 'Values': [vpcid]}, {'Name': 'instance-state-name', 'Values': ['running']}]
+    for page in paginator.paginate(Filters=filters):
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                if instance.get('SubnetId') and is_affected(instance['SubnetId']):
+                    instances.append(instance)
+    return instances
+
+
+
+def find_rds_instances(rds_client, vpcid, is_affected):
+
+    # Find the active DB instances of a VPC with a subnet group using an affected subnet
+    #
+    # Input: RDS client, vpcid, function telling if a subnet is affected
+    # Output: list of DB instances as returned by describe_db_instances
+
+    db_instances = []
+    paginator = rds_client.get_paginator('describe_db_instances')
+    for page in paginator.paginate():
+        for db_instance in page['DBInstances']:
+            subnet_group = db_instance.get('DBSubnetGroup') or {}
+            if subnet_group.get('VpcId') != vpcid or db_instance['DBInstanceStatus'] in const_rds_inactive_states:
+                continue
+            if any(is_affected(subnet['SubnetIdentifier']) for subnet in subnet_group.get('Subnets', [])):
+                db_instances.append(db_instance)
+    return db_instances
+
+
+
+def evaluate_leased(accountid, region, resource_type, details, ec2_client, compliancemode):
+
+    # Evaluate one instance unless another invocation is already working on it
+    #
+    # Input: account id, region, resource type, instance details, EC2 client, compliance mode
+    # Output: True if remediated, False if not, None if skipped
+
+    instanceid = details['InstanceId']
+    if not acquire_lease(accountid, region, instanceid):
+        logger.info(f"{instanceid} is being evaluated by another invocation, skipping it")
+        return None
+    try:
+        return evaluate_instance(accountid, resource_type, details, ec2_client, compliancemode, leased=True)
+    except Exception:
+        # let a retry of the route change evaluate the instance again
+        release_lease(accountid, region, instanceid)
+        raise
+
+
+
+def process_route_change(event, compliancemode, handler_started=None):
+
+    # Re-evaluate the running instances of the subnets a route change made public
+    #
+    # Input: CloudTrail route change event, compliance mode, handler start time
+    # Output: summary of the instances evaluated, raises if any of them failed
+
+    detail = event['detail']
+    accountid = detail.get('recipientAccountId') or event['account']
+    region = get_event_region(event)
+    handler_started = handler_started or utc_timestamp()
+    summary = {'Evaluated': 0, 'Remediated': 0, 'Skipped': 0, 'Failed': 0, 'Throttled': 0}
+
+    if not can_make_public(detail):
+        logger.info(f"{detail['eventName']} in account {accountid} cannot make a subnet public, nothing to re-evaluate")
+        return summary
+
+    routetableid = (detail.get('requestParameters') or {}).get('routeTableId')
+    ec2_client, ec2 = get_handles(accountid, const_resource_type_ec2, region)
+    route_table = ec2_client.describe_route_tables(RouteTableIds=[routetableid])['RouteTables'][0]
+    vpcid = route_table['VpcId']
+
+    # the cached verdicts of this VPC are stale now
+    invalidate_subnet_index(accountid, region, vpcid)
+    index = get_subnet_index(ec2_client, accountid, vpcid, refresh=True)
+    subnets, main = get_affected_subnets(route_table, detail)
+    public_subnets = set(subnetid for subnetid in subnets if index['Subnets'].get(subnetid, index['MainPublic']))
+    main_public = main and index['MainPublic']
+    logger.info(f"{detail['eventName']} on {routetableid} in VPC {vpcid} affects subnets {subnets}{' and the main route table' if main else ''}, public: {sorted(public_subnets)}{' and the main route table' if main_public else ''}")
+    if not public_subnets and not main_public:
+        return summary
+
+    def is_affected(subnetid):
+        # explicit associations first, the remaining subnets use the main route table
+        if subnetid in index['Subnets']:
+            return subnetid in public_subnets
+        return main_public
+
+    candidates = []
+    for instance in find_ec2_instances(ec2_client, vpcid, is_affected):
+        details = get_ec2_details(ec2_client, instance)
+        details['InstanceArn'] = f"arn:aws:ec2:{region}:{accountid}:instance/{instance['InstanceId']}"
+        candidates.append((const_resource_type_ec2, details))
+    rds_client, rds = get_handles(accountid, const_resource_type_rds, region)
+    for db_instance in find_rds_instances(rds_client, vpcid, is_affected):
+        candidates.append((const_resource_type_rds, get_rds_details(rds_client, db_instance)))
+    logger.info(f"Re-evaluating {len(candidates)} instances in VPC {vpcid} of account {accountid}, region {region}")
+
+    for resource_type, details in candidates:
+        details['EventTime'] = event['time']
+        details['HandlerStartTime'] = handler_started
+        try:
+            remediated = evaluate_leased(accountid, region, resource_type, details, ec2_client, compliancemode)
+        except Exception as e:
+            logger.error(f"Failed re-evaluating {resource_type.upper()} instance {details['InstanceId']}: {e}")
+            summary['Failed'] += 1
+            summary['Throttled'] += 1 if is_retryable(e) else 0
+            continue
+        if remediated is None:
+            summary['Skipped'] += 1
+        else:
+            summary['Evaluated'] += 1
+            summary['Remediated'] += 1 if remediated else 0
+
+    if summary['Throttled']:
+        raise RetryableError(f"Throttled re-evaluating {summary['Throttled']} of {len(candidates)} instances after {detail['eventName']} on {routetableid}")
+    if summary['Failed']:
+        raise Exception(f"Failed re-evaluating {summary['Failed']} of {len(candidates)} instances after {detail['eventName']} on {routetableid}")
+    # the other invocation may have read the topology before this route change, the event is delivered again
+    if summary['Skipped']:
+        raise RetryableError(f"{summary['Skipped']} of {len(candidates)} instances were being evaluated by another invocation after {detail['eventName']} on {routetableid}")
+    return summary
+
+
+
+def route_change_handler(event, compliancemode, handler_started=None):
+
+    # Handle one route change event delivered directly by EventBridge
+    #
+    # Input: CloudTrail route change event, compliance mode, handler start time
+    # Output: response with the number of instances evaluated and stopped
+
+    if is_event_processed(event.get('id')):
+        logger.info(f"Event {event.get('id')} was already processed. Exiting.")
+        return {'InstanceStopped': False}
+
+    summary = process_route_change(event, compliancemode, handler_started)
+    write_audit_records()
+    mark_event_processed(event.get('id'))
+    logger.info(f"Route change summary: {summary}")
+    response = {'InstanceStopped': summary['Remediated'] > 0, 'Evaluated': summary['Evaluated'], 'Remediated': summary['Remediated']}
+    return response
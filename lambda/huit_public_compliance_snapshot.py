@@ -0,0 +1,297 @@
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+
+from huit_public_compliance_utils import get_local_client
+
+
+# define global logger
+logger = logging.getLogger(__name__)
+
+# where snapshots are kept, an S3 bucket or a local directory standing in for it, nothing is kept if neither is set
+snapshot_bucket = os.environ.get('SnapshotBucket')
+snapshot_dir = os.environ.get('SnapshotDir')
+snapshot_prefix = os.environ.get('SnapshotPrefix', 'network-snapshots')
+
+# seconds the VPCs and names of a snapshot are trusted after they were read from AWS
+snapshot_ttl = int(os.environ.get('SnapshotTTL', 900))
+
+# bumped when the snapshot layout changes, snapshots of other versions are never read
+const_snapshot_version = 1
+
+
+# (accountid, region) -> snapshot, None when there is no usable snapshot, kept between warm invocations
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+# (accountid, region) -> VPCs rebuilt, VPCs invalidated and names read by this container since the last flush
+_changes = {}
+
+
+
+def is_snapshot_enabled():
+
+    # Check if network snapshots are kept
+    #
+    # Input: None
+    # Output: True if a bucket or directory is configured
+
+    return bool(snapshot_bucket or snapshot_dir)
+
+
+
+def get_snapshot_key(accountid, region):
+
+    # Get the object key of a snapshot
+    #
+    # Input: account id, region
+    # Output: key, relative to the bucket or directory
+
+    return f"{snapshot_prefix}/v{const_snapshot_version}/{accountid}/{region}.json.gz"
+
+
+
+def _read(key):
+
+    # Read a compressed snapshot from S3 or the local directory
+    #
+    # Input: key
+    # Output: snapshot dict, None if there is none
+
+    try:
+        if snapshot_bucket:
+            body = get_local_client('s3').get_object(Bucket=snapshot_bucket, Key=key)['Body'].read()
+        else:
+            with open(os.path.join(snapshot_dir, key), 'rb') as f:
+                body = f.read()
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        if getattr(e, 'response', {}).get('Error', {}).get('Code') in ['NoSuchKey', '404']:
+            return None
+        raise
+    return json.loads(gzip.decompress(body))
+
+
+
+def _write(key, snapshot):
+
+    # Write a compressed snapshot to S3 or the local directory
+    #
+    # Input: key, snapshot dict
+    # Output: None
+
+    # compact separators keep the object small, a few KB even for accounts with hundreds of subnets
+    body = gzip.compress(json.dumps(snapshot, separators=(',', ':')).encode())
+    if snapshot_bucket:
+        get_local_client('s3').put_object(Bucket=snapshot_bucket, Key=key, Body=body, ContentType='application/json', ContentEncoding='gzip')
+    else:
+        path = os.path.join(snapshot_dir, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(body)
+        os.replace(path + '.tmp', path)
+
+
+
+def _new_snapshot(accountid, region):
+
+    # Create an empty snapshot
+    #
+    # Input: account id, region
+    # Output: snapshot dict
+
+    return {'Version': const_snapshot_version, 'AccountId': accountid, 'Region': region, 'Vpcs': {}, 'Names': {}, 'NamesFilled': 0, 'Invalidated': {}}
+
+
+
+def _drop_expired(snapshot):
+
+    # Remove the VPCs, names and invalidations older than SnapshotTTL from a snapshot
+    #
+    # Input: snapshot dict
+    # Output: the snapshot
+
+    now = time.time()
+    snapshot['Vpcs'] = {vpcid: vpc for vpcid, vpc in snapshot['Vpcs'].items() if now - vpc['Built'] <= snapshot_ttl}
+    if now - snapshot.get('NamesFilled', 0) > snapshot_ttl:
+        snapshot['Names'] = {}
+    # an invalidation only has to outlive the VPC entries built before it
+    snapshot['Invalidated'] = {vpcid: when for vpcid, when in snapshot.get('Invalidated', {}).items() if now - when <= snapshot_ttl}
+    return snapshot
+
+
+
+def load_snapshot(accountid, region):
+
+    # Get the network snapshot of an account and region, reading it once per container
+    #
+    # Input: account id, region
+    # Output: snapshot with Vpcs (vpcid -> Subnets, MainPublic, Built) and Names read within SnapshotTTL, None if there is none
+
+    if not is_snapshot_enabled():
+        return None
+    key = (accountid, region)
+    with _snapshots_lock:
+        if key in _snapshots:
+            return _snapshots[key]
+
+    try:
+        snapshot = _read(get_snapshot_key(accountid, region))
+    except Exception as e:
+        logger.warning(f"Unable to read network snapshot of account {accountid}, region {region}: {e}")
+        snapshot = None
+    if snapshot is not None and snapshot.get('Version') != const_snapshot_version:
+        snapshot = None
+    if snapshot is not None:
+        # every VPC, and the names, expire on their own
+        _drop_expired(snapshot)
+        logger.info(f"Loaded network snapshot of account {accountid}, region {region} with {len(snapshot['Vpcs'])} current VPCs and {len(snapshot['Names'])} names")
+
+    with _snapshots_lock:
+        # another thread may have loaded or updated it meanwhile
+        return _snapshots.setdefault(key, snapshot)
+
+
+
+def _get_writable(accountid, region):
+
+    # Get the cached snapshot of an account and region, and the changes to flush, must be called while holding the lock
+    #
+    # Input: account id, region
+    # Output: (snapshot dict, changes dict)
+
+    key = (accountid, region)
+    snapshot = _snapshots.get(key)
+    if snapshot is None:
+        snapshot = _new_snapshot(accountid, region)
+        _snapshots[key] = snapshot
+    changes = _changes.setdefault(key, {'Vpcs': {}, 'Invalidated': {}, 'Names': None, 'NamesFilled': 0})
+    return snapshot, changes
+
+
+
+def update_snapshot_vpc(accountid, region, vpcid, subnets, main_public):
+
+    # Record the public subnet verdicts of a VPC that were just read from AWS
+    #
+    # Input: account id, region, vpcid, dict of subnetid -> public, main route table verdict
+    # Output: None
+
+    if not is_snapshot_enabled():
+        return
+    # the other VPCs of the stored snapshot are kept
+    load_snapshot(accountid, region)
+    vpc = {'Subnets': dict(subnets), 'MainPublic': main_public, 'Built': time.time()}
+    with _snapshots_lock:
+        snapshot, changes = _get_writable(accountid, region)
+        snapshot['Vpcs'][vpcid] = vpc
+        changes['Vpcs'][vpcid] = vpc
+
+
+
+def update_snapshot_names(accountid, region, names):
+
+    # Record the VPC and subnet names of an account and region that were just read from AWS
+    #
+    # Input: account id, region, dict of resource id -> name
+    # Output: None
+
+    if not is_snapshot_enabled():
+        return
+    load_snapshot(accountid, region)
+    with _snapshots_lock:
+        snapshot, changes = _get_writable(accountid, region)
+        snapshot['Names'] = dict(names)
+        snapshot['NamesFilled'] = time.time()
+        changes['Names'] = snapshot['Names']
+        changes['NamesFilled'] = snapshot['NamesFilled']
+
+
+
+def invalidate_snapshot(accountid, region, vpcid=None):
+
+    # Drop a VPC, or everything, from the snapshot of an account and region after its topology changed
+    #
+    # Input: account id, region, optional vpcid
+    # Output: None
+
+    if not is_snapshot_enabled():
+        return
+    load_snapshot(accountid, region)
+    now = time.time()
+    with _snapshots_lock:
+        snapshot, changes = _get_writable(accountid, region)
+        # '*' stands for every VPC of the account and region
+        vpcids = list(snapshot['Vpcs']) if vpcid is None else [vpcid]
+        for key in vpcids:
+            snapshot['Vpcs'].pop(key, None)
+            changes['Vpcs'].pop(key, None)
+        changes['Invalidated'][vpcid or '*'] = now
+
+
+
+def merge_changes(snapshot, changes):
+
+    # Apply the changes of this container to the stored snapshot, entries other containers read from AWS later are kept
+    #
+    # Input: stored snapshot dict, changes dict
+    # Output: the snapshot
+
+    invalidated = snapshot.setdefault('Invalidated', {})
+    for vpcid, when in changes['Invalidated'].items():
+        invalidated[vpcid] = max(when, invalidated.get(vpcid, 0))
+        for key in (list(snapshot['Vpcs']) if vpcid == '*' else [vpcid]):
+            if key in snapshot['Vpcs'] and snapshot['Vpcs'][key]['Built'] <= when:
+                del snapshot['Vpcs'][key]
+
+    for vpcid, vpc in changes['Vpcs'].items():
+        # a VPC rebuilt before a route change another container saw is stale
+        if vpc['Built'] <= max(invalidated.get(vpcid, 0), invalidated.get('*', 0)):
+            continue
+        current = snapshot['Vpcs'].get(vpcid)
+        if current is None or current['Built'] <= vpc['Built']:
+            snapshot['Vpcs'][vpcid] = vpc
+
+    if changes['Names'] is not None and changes['NamesFilled'] >= snapshot.get('NamesFilled', 0):
+        snapshot['Names'] = changes['Names']
+        snapshot['NamesFilled'] = changes['NamesFilled']
+    return snapshot
+
+
+
+def flush_snapshots():
+
+    # Merge the changes made during this invocation into the stored snapshots
+    #
+    # Input: None
+    # Output: number of snapshots written
+
+    with _snapshots_lock:
+        pending = [(key, json.loads(json.dumps(changes))) for key, changes in _changes.items()]
+        _changes.clear()
+
+    written = 0
+    for (accountid, region), changes in pending:
+        key = get_snapshot_key(accountid, region)
+        try:
+            # read again instead of writing the copy this container loaded, which can be minutes old
+            snapshot = _read(key)
+            if snapshot is None or snapshot.get('Version') != const_snapshot_version:
+                snapshot = _new_snapshot(accountid, region)
+            snapshot = _drop_expired(merge_changes(snapshot, changes))
+            snapshot['Created'] = time.time()
+            _write(key, snapshot)
+            written += 1
+        except Exception as e:
+            logger.warning(f"Unable to write network snapshot of account {accountid}, region {region}: {e}")
+            continue
+        with _snapshots_lock:
+            # later loads in this container see the merged VPCs
+            _snapshots[(accountid, region)] = snapshot
+    if written:
+        logger.info(f"Wrote {written} network snapshots")
+    return written
@@ -0,0 +1,247 @@
+import json
+import logging
+import os
+import time
+import uuid
+
+from huit_public_compliance_utils import get_local_client
+from huit_public_compliance_audit import wait_before_retry
+
+
+# define global logger
+logger = logging.getLogger(__name__)
+
+# DynamoDB table holding short lived state, items expire through the ExpiresAt TTL attribute
+state_table = os.environ.get('StateTable')
+
+# pending remediations are forgotten after this many seconds
+pending_ttl = int(os.environ.get('PendingTTL', 7 * 24 * 3600))
+
+# processed event ids are remembered this many seconds
+event_ttl = int(os.environ.get('EventDedupTTL', 24 * 3600))
+
+# seconds during which only one invocation evaluates or remediates a resource
+lease_seconds = int(os.environ.get('LeaseSeconds', 120))
+
+# key prefixes
+const_prefix_pending = 'PENDING'
+const_prefix_event = 'EVENT'
+const_prefix_lease = 'LEASE'
+
+# keys per BatchGetItem and BatchWriteItem call
+const_batch_get_size = 100
+const_batch_write_size = 25
+
+# identifies the leases taken by this container
+_lease_owner = uuid.uuid4().hex
+
+
+
+def is_state_enabled():
+
+    # Check if a state table is configured
+    #
+    # Input: None
+    # Output: True if the state table can be used
+
+    return bool(state_table)
+
+
+
+def _pending_key(accountid, region, instanceid):
+
+    # Build the key of a pending remediation
+    #
+    # Input: account id, region, instance id
+    # Output: DynamoDB key
+
+    return {'Pk': {'S': f"{const_prefix_pending}#{accountid}#{region}"}, 'Sk': {'S': instanceid}}
+
+
+
+def save_pending_remediation(parameters):
+
+    # Remember a remediation that has to wait until the instance can be stopped
+    #
+    # Input: dict of InstanceParameters, NotificationParameters, TagParameters and DBParameters
+    # Output: True if saved, False if a remediation was already pending for the instance
+
+    instance_params = parameters['InstanceParameters']
+    item = _pending_key(instance_params['AccountId'], instance_params.get('Region'), instance_params['InstanceId'])
+    item['Payload'] = {'S': json.dumps(parameters)}
+    item['ExpiresAt'] = {'N': str(int(time.time()) + pending_ttl)}
+    client = get_local_client('dynamodb')
+    try:
+        client.put_item(TableName=state_table, Item=item, ConditionExpression='attribute_not_exists(Pk)')
+    except client.exceptions.ConditionalCheckFailedException:
+        return False
+    logger.info(f"Saved pending remediation for {instance_params['InstanceId']}")
+    return True
+
+
+
+def get_pending_remediation(accountid, region, instanceid):
+
+    # Get the pending remediation of an instance
+    #
+    # Input: account id, region, instance id
+    # Output: dict of parameters, None if nothing is pending
+
+    response = get_local_client('dynamodb').get_item(TableName=state_table, Key=_pending_key(accountid, region, instanceid), ConsistentRead=True)
+    # expired items can linger until DynamoDB's TTL process removes them
+    if 'Item' not in response or int(response['Item']['ExpiresAt']['N']) < time.time():
+        return None
+    return json.loads(response['Item']['Payload']['S'])
+
+
+
+def delete_pending_remediation(accountid, region, instanceid):
+
+    # Forget the pending remediation of an instance
+    #
+    # Input: account id, region, instance id
+    # Output: None
+
+    get_local_client('dynamodb').delete_item(TableName=state_table, Key=_pending_key(accountid, region, instanceid))
+    logger.info(f"Removed pending remediation for {instanceid}")
+
+
+
+def is_event_processed(eventid):
+
+    # Check if an event was already processed successfully
+    #
+    # Input: event id
+    # Output: True if the event is a duplicate
+
+    if not is_state_enabled() or not eventid:
+        return False
+    key = {'Pk': {'S': const_prefix_event}, 'Sk': {'S': eventid}}
+    response = get_local_client('dynamodb').get_item(TableName=state_table, Key=key, ConsistentRead=True)
+    return 'Item' in response and int(response['Item']['ExpiresAt']['N']) >= time.time()
+
+
+
+def mark_event_processed(eventid):
+
+    # Remember that an event was processed, so redeliveries are skipped
+    #
+    # Input: event id
+    # Output: None
+
+    if not is_state_enabled() or not eventid:
+        return
+    item = {'Pk': {'S': const_prefix_event}, 'Sk': {'S': eventid}, 'ExpiresAt': {'N': str(int(time.time()) + event_ttl)}}
+    get_local_client('dynamodb').put_item(TableName=state_table, Item=item)
+
+
+
+def get_processed_events(eventids):
+
+    # Find the events of a batch that were already processed, with BatchGetItem calls
+    #
+    # Input: event ids
+    # Output: set of the event ids that are duplicates
+
+    eventids = [eventid for eventid in dict.fromkeys(eventids) if eventid]
+    if not is_state_enabled() or not eventids:
+        return set()
+    client = get_local_client('dynamodb')
+    processed = set()
+    now = time.time()
+    for n in range(0, len(eventids), const_batch_get_size):
+        keys = [{'Pk': {'S': const_prefix_event}, 'Sk': {'S': eventid}} for eventid in eventids[n:n + const_batch_get_size]]
+        request = {state_table: {'Keys': keys, 'ConsistentRead': True}}
+        attempt = 0
+        while True:
+            response = client.batch_get_item(RequestItems=request)
+            for item in response['Responses'].get(state_table, []):
+                if int(item['ExpiresAt']['N']) >= now:
+                    processed.add(item['Sk']['S'])
+            request = response.get('UnprocessedKeys')
+            if not request:
+                break
+            attempt += 1
+            wait_before_retry(attempt, len(request[state_table]['Keys']), 'event lookups')
+    return processed
+
+
+
+def mark_events_processed(eventids):
+
+    # Remember that events were processed, with BatchWriteItem calls
+    #
+    # Input: event ids
+    # Output: None
+
+    eventids = [eventid for eventid in dict.fromkeys(eventids) if eventid]
+    if not is_state_enabled() or not eventids:
+        return
+    client = get_local_client('dynamodb')
+    expires = str(int(time.time()) + event_ttl)
+    for n in range(0, len(eventids), const_batch_write_size):
+        requests = [{'PutRequest': {'Item': {'Pk': {'S': const_prefix_event}, 'Sk': {'S': eventid}, 'ExpiresAt': {'N': expires}}}}
+                    for eventid in eventids[n:n + const_batch_write_size]]
+        request = {state_table: requests}
+        attempt = 0
+        while True:
+            request = client.batch_write_item(RequestItems=request).get('UnprocessedItems')
+            if not request:
+                break
+            attempt += 1
+            wait_before_retry(attempt, len(request[state_table]), 'processed events')
+
+
+
+def _lease_key(accountid, region, instanceid):
+
+    # Build the key of a resource lease
+    #
+    # Input: account id, region, instance id
+    # Output: DynamoDB key
+
+    return {'Pk': {'S': f"{const_prefix_lease}#{accountid}#{region}"}, 'Sk': {'S': instanceid}}
+
+
+
+def acquire_lease(accountid, region, instanceid):
+
+    # Take the lease that allows one invocation to evaluate or remediate a resource
+    #
+    # Input: account id, region, instance id
+    # Output: True if the lease was taken, False if another invocation holds it
+
+    if not is_state_enabled():
+        return True
+    now = int(time.time())
+    item = _lease_key(accountid, region, instanceid)
+    item['Owner'] = {'S': _lease_owner}
+    item['ExpiresAt'] = {'N': str(now + lease_seconds)}
+    client = get_local_client('dynamodb')
+    try:
+        client.put_item(TableName=state_table, Item=item,
+            ConditionExpression='attribute_not_exists(Pk) OR ExpiresAt < :now',
+            ExpressionAttributeValues={':now': {'N': str(now)}})
+    except client.exceptions.ConditionalCheckFailedException:
+        logger.info(f"Lease for {instanceid} is held by another invocation")
+        return False
+    return True
+
+
+
+def release_lease(accountid, region, instanceid):
+
+    # Give up a lease held by this container before it expires
+    #
+    # Input: account id, region, instance id
+    # Output: None
+
+    if not is_state_enabled():
+        return
+    client = get_local_client('dynamodb')
+    try:
+        client.delete_item(TableName=state_table, Key=_lease_key(accountid, region, instanceid),
+            ConditionExpression='Owner = :owner',
+            ExpressionAttributeValues={':owner': {'S': _lease_owner}})
+    except client.exceptions.ConditionalCheckFailedException:
+        pass
@@ -0,0 +1,249 @@
+import concurrent.futures
+import datetime
+import json
+import logging
+import os
+import time
+
+from huit_public_compliance_utils import get_handles, get_local_client, enabled_regions
+from huit_public_compliance_names import fill_name_cache
+from huit_public_compliance_audit import flush_audit_records
+from huit_public_compliance_state import mark_events_processed
+
+from huit_public_compliance_utils import const_resource_type_ec2
+from huit_public_compliance_utils import const_resource_type_rds
+
+from huit_public_compliance import get_ec2_details, get_rds_details, evaluate_instance
+from huit_public_compliance import trueval
+
+
+# define global logger
+logger = logging.getLogger(__name__)
+
+# number of accounts swept concurrently
+sweep_concurrency = int(os.environ.get('SweepConcurrency', 16))
+
+# stop starting new accounts when fewer than this many seconds remain, then resume in a new invocation
+sweep_reserve_seconds = int(os.environ.get('SweepReserveSeconds', 60))
+
+# longest time spent on one account and region in an invocation, an account that takes longer is swept again by the next one
+sweep_account_seconds = int(os.environ.get('SweepAccountSeconds', 90))
+
+# seconds kept at the end of an invocation to checkpoint the accounts that did not finish
+const_checkpoint_seconds = 20
+
+# optional comma separated list of accounts to sweep instead of every active organization account
+sweep_accounts = os.environ.get('SweepAccounts', '')
+
+# RDS states in which an instance cannot be reachable
+const_rds_inactive_states = ['stopped', 'stopping', 'deleting', 'failed', 'storage-full', 'inaccessible-encryption-credentials']
+
+
+
+def list_member_accounts():
+
+    # List the accounts to sweep
+    #
+    # Input: None
+    # Output: list of account ids
+
+    if sweep_accounts.strip():
+        return [account.strip() for account in sweep_accounts.split(',') if account.strip()]
+
+    accounts = []
+    paginator = get_local_client('organizations').get_paginator('list_accounts')
+    for page in paginator.paginate():
+        for account in page['Accounts']:
+            if account['Status'] == 'ACTIVE':
+                accounts.append(account['Id'])
+    return accounts
+
+
+
+def pages(paginator, token_key, token, **kwargs):
+
+    # Read the pages of a describe call, starting at a pagination token
+    #
+    # Input: paginator, name of the response token, starting token or None, describe parameters
+    # Output: generator of (token that reads the page again, page)
+
+    config = {'StartingToken': token} if token else {}
+    for page in paginator.paginate(PaginationConfig=config, **kwargs):
+        yield token, page
+        token = page.get(token_key)
+
+
+
+def resume_at(items, key, instanceid):
+
+    # Drop the instances of a page read again that a previous invocation already evaluated
+    #
+    # Input: instances of the page, name of the id attribute, id of the instance the previous invocation stopped at
+    # Output: instances from the checkpointed one, the whole page if that instance is gone
+
+    ids = [item[key] for item in items]
+    if instanceid not in ids:
+        return items
+    return items[ids.index(instanceid):]
+
+
+
+def sweep_account(accountid, region, compliancemode, start_time, deadline=None, checkpoint=None):
+
+    # Evaluate every running EC2 and available RDS instance of an account in one region
+    #
+    # Input: account id, region, compliance mode, sweep start time used as the event time, optional time.monotonic() deadline,
+    #        optional checkpoint of a previous invocation with the resource type, page token and instance id to continue at
+    # Output: dict with the number of instances evaluated, remediated and failed, Checkpoint is set if the deadline was reached
+
+    result = {'Evaluated': 0, 'Remediated': 0, 'Failed': 0}
+    checkpoint = checkpoint or {}
+    # an instance of a public subnet found in audit mode or with an exception tag is reported once a day
+    findings = []
+    ec2_client, ec2 = get_handles(accountid, const_resource_type_ec2, region)
+    rds_client, rds = get_handles(accountid, const_resource_type_rds, region)
+    # one paginated fill gives the names of every VPC and subnet the account's instances use
+    fill_name_cache(ec2_client, accountid)
+
+    def evaluate(resource_type, details):
+        details['EventTime'] = start_time
+        finding = f"SWEEP#{accountid}#{region}#{details['InstanceId']}#{start_time[:10]}"
+        try:
+            result['Evaluated'] += 1
+            if evaluate_instance(accountid, resource_type, details, ec2_client, compliancemode, finding=finding):
+                result['Remediated'] += 1
+                findings.append(finding)
+        except Exception as e:
+            result['Failed'] += 1
+            logger.error(f"Sweep failed evaluating {resource_type.upper()} instance {details['InstanceId']} in account {accountid}, region {region}: {e}")
+
+    def ec2_instances(token, instanceid):
+        paginator = ec2_client.get_paginator('describe_instances')
+        for token, page in pages(paginator, 'NextToken', token, Filters=[{'Name': 'instance-state-name', 'Values': ['running']}]):
+            # EC2-Classic or an instance without a VPC network interface is skipped
+            instances = [instance for reservation in page['Reservations'] for instance in reservation['Instances'] if 'SubnetId' in instance]
+            if instanceid:
+                instances, instanceid = resume_at(instances, 'InstanceId', instanceid), None
+            for instance in instances:
+                details = get_ec2_details(ec2_client, instance)
+                details['InstanceArn'] = f"arn:aws:ec2:{region}:{accountid}:instance/{instance['InstanceId']}"
+                yield const_resource_type_ec2, token, details
+
+    def rds_instances(token, instanceid):
+        paginator = rds_client.get_paginator('describe_db_instances')
+        for token, page in pages(paginator, 'Marker', token):
+            db_instances = [db_instance for db_instance in page['DBInstances']
+                            if db_instance['DBInstanceStatus'] not in const_rds_inactive_states and 'DBSubnetGroup' in db_instance]
+            if instanceid:
+                db_instances, instanceid = resume_at(db_instances, 'DBInstanceIdentifier', instanceid), None
+            for db_instance in db_instances:
+                yield const_resource_type_rds, token, get_rds_details(rds_client, db_instance)
+
+    def instances():
+        # a resumed account reads the page it stopped in again, so instances launched or terminated meanwhile do not shift it
+        if checkpoint.get('ResourceType') == const_resource_type_rds:
+            yield from rds_instances(checkpoint.get('Token'), checkpoint.get('InstanceId'))
+            return
+        yield from ec2_instances(checkpoint.get('Token'), checkpoint.get('InstanceId'))
+        yield from rds_instances(None, None)
+
+    # the pages are read as they are evaluated, so an account stopped at its deadline is not described further
+    for resource_type, token, details in instances():
+        # at least one instance per invocation, so a resumed account always progresses
+        if deadline is not None and result['Evaluated'] and time.monotonic() > deadline:
+            logger.warning(f"Sweep of account {accountid}, region {region} reached its deadline at instance {details['InstanceId']}")
+            result['Checkpoint'] = {'ResourceType': resource_type, 'Token': token, 'InstanceId': details['InstanceId']}
+            break
+        evaluate(resource_type, details)
+
+    # the findings are remembered once their audit records are written, a lost record is reported again by the next sweep
+    if findings and flush_audit_records():
+        try:
+            mark_events_processed(findings)
+        except Exception as e:
+            logger.error(f"Unable to remember {len(findings)} findings of account {accountid}, region {region}, the next sweep reports them again: {e}")
+
+    logger.info(f"Swept account {accountid}, region {region}: {result}")
+    return result
+
+
+
+def resume_sweep(context, sweep):
+
+    # Continue the sweep in a new asynchronous invocation of this function
+    #
+    # Input: context object, sweep state with the account and region pairs still to process
+    # Output: None
+
+    logger.info(f"Checkpointing sweep, {len(sweep['Targets'])} account and region pairs remaining")
+    get_local_client('lambda').invoke(
+        FunctionName= context.invoked_function_arn,
+        InvocationType= 'Event',
+        Payload= json.dumps({'Sweep': sweep})
+    )
+
+
+
+def sweep_handler(event, context):
+
+    # Lambda handler for the scheduled reconciliation sweep
+    #
+    # Input: event with a Sweep entry, optionally holding the targets left by a previous run, [account, region] or
+    #        [account, region, checkpoint] for an account stopped at its deadline
+    # Output: summary of the sweep
+
+    sweep = event['Sweep'] or {}
+    targets = sweep.get('Targets')
+    if targets is None:
+        targets = [[accountid, region] for accountid in list_member_accounts() for region in enabled_regions]
+    run = sweep.get('Run', 0) + 1
+    start_time = sweep.get('StartTime') or datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+    logger.info(f"Starting sweep run {run} for {len(targets)} account and region pairs")
+
+    # re-read compliance mode in case it changes
+    compliancemode = os.environ.get('ComplianceMode') in trueval
+
+    summary = {'Run': run, 'Targets': 0, 'Evaluated': 0, 'Remediated': 0, 'Failed': 0, 'FailedTargets': [], 'Remaining': 0}
+    pending = list(reversed(targets))
+    running = {}
+    incomplete = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=sweep_concurrency) as executor:
+        while pending or running:
+            # keep the pool busy while there is enough time left to finish an account
+            while pending and len(running) < sweep_concurrency and context.get_remaining_time_in_millis() > sweep_reserve_seconds * 1000:
+                target = pending.pop()
+                # an account ends before the invocation does, whatever its size
+                seconds = min(sweep_account_seconds, context.get_remaining_time_in_millis() / 1000 - const_checkpoint_seconds)
+                checkpoint = target[2] if len(target) > 2 else None
+                running[executor.submit(sweep_account, target[0], target[1], compliancemode, start_time, time.monotonic() + seconds, checkpoint)] = target
+            if pending and context.get_remaining_time_in_millis() <= sweep_reserve_seconds * 1000:
+                # hand over the accounts not started yet before waiting for the running ones
+                resume_sweep(context, {'Targets': list(reversed(pending)), 'Run': run, 'StartTime': start_time})
+                summary['Remaining'] += len(pending)
+                pending = []
+            if not running:
+                break
+
+            finished, unfinished = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                target = running.pop(future)
+                try:
+                    result = future.result()
+                    summary['Evaluated'] += result['Evaluated']
+                    summary['Remediated'] += result['Remediated']
+                    summary['Failed'] += result['Failed']
+                    if 'Checkpoint' in result:
+                        incomplete.append([target[0], target[1], result['Checkpoint']])
+                    else:
+                        summary['Targets'] += 1
+                except Exception as e:
+                    logger.error(f"Sweep failed for account {target[0]}, region {target[1]}: {e}")
+                    summary['FailedTargets'].append(target)
+
+    # accounts stopped at their deadline continue where they stopped, in another invocation
+    if incomplete:
+        resume_sweep(context, {'Targets': incomplete, 'Run': run, 'StartTime': start_time})
+        summary['Remaining'] += len(incomplete)
+
+    logger.info(f"Sweep summary: {json.dumps(summary)}")
+    return summary
@@ -0,0 +1,117 @@
+import functools
+import logging
+import os
+import threading
+import time
+
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from huit_public_compliance_metrics import const_throttle_codes
+
+
+# define global logger
+logger = logging.getLogger(__name__)
+
+# calls per second, and burst, one container makes to a service of a member account and region (the EC2 describe
+# bucket of an account refills 20 tokens a second and holds 100), a rate of 0 turns the token buckets off
+api_rate_limit = float(os.environ.get('ApiRateLimit', 20))
+api_burst = int(os.environ.get('ApiBurst', 100))
+
+# longest wait for a token, calls that would wait longer fail as retryable instead
+api_max_wait_seconds = float(os.environ.get('ApiMaxWaitSeconds', 10))
+
+# attempts of a call, adaptive mode also slows a client down once it is throttled
+api_max_attempts = int(os.environ.get('ApiMaxAttempts', 8))
+
+
+# (account, region, service) -> token bucket, shared by the threads of a container and kept between warm invocations
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+
+class RetryableError(Exception):
+
+    # An event could not be evaluated because of throttling, it has to be delivered again instead of being dropped
+
+    pass
+
+
+
+def is_retryable(error):
+
+    # Check if a failure is worth retrying later
+    #
+    # Input: exception
+    # Output: True for throttling that outlasted the retries of the client and the token bucket
+
+    if isinstance(error, RetryableError):
+        return True
+    return isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') in const_throttle_codes
+
+
+
+def get_client_config():
+
+    # Get the botocore configuration of the cross-account clients
+    #
+    # Input: None
+    # Output: botocore Config
+
+    return Config(retries={'mode': 'adaptive', 'total_max_attempts': api_max_attempts})
+
+
+
+def take_token(key):
+
+    # Take a token from the bucket of an account, region and service, waiting for it if the bucket is empty
+    #
+    # Input: (account id, region, service)
+    # Output: seconds waited, raises RetryableError if the wait would exceed ApiMaxWaitSeconds
+
+    with _buckets_lock:
+        now = time.monotonic()
+        bucket = _buckets.get(key)
+        if bucket is None:
+            bucket = {'Tokens': float(api_burst), 'Updated': now}
+            _buckets[key] = bucket
+        bucket['Tokens'] = min(float(api_burst), bucket['Tokens'] + (now - bucket['Updated']) * api_rate_limit)
+        bucket['Updated'] = now
+        # a negative balance is the queue of callers already waiting
+        wait = max(0.0, (1 - bucket['Tokens']) / api_rate_limit)
+        if wait > api_max_wait_seconds:
+            raise RetryableError(f"Rate limit of {key[2]} in account {key[0]}, region {key[1]} exhausted, {wait:.1f}s wait for a token")
+        bucket['Tokens'] -= 1
+
+    if wait:
+        time.sleep(wait)
+    return wait
+
+
+
+def _before_call(key, model, **kwargs):
+
+    # botocore before-call hook, holds the call until the bucket has a token
+    #
+    # Input: (account id, region, service), operation model
+    # Output: None
+
+    wait = take_token(key)
+    if wait >= 1:
+        logger.info(f"Waited {wait:.1f}s for a token to call {model.name} in account {key[0]}, region {key[1]}")
+
+
+
+def rate_limit_client(client, accountid, region):
+
+    # Register the token bucket hook on a cross-account client
+    #
+    # Input: boto3 client, account id, region
+    # Output: the client
+
+    if api_rate_limit <= 0:
+        return client
+    key = (accountid, region, client.meta.service_model.service_name)
+    client.meta.events.register('before-call.*.*', functools.partial(_before_call, key), unique_id='huit-throttle-before-call')
+    return client
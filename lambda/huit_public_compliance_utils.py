@@ -1,49 +1,184 @@
 import boto3
+import datetime
 import os
+import threading
+
+from huit_public_compliance_metrics import instrument_client
+from huit_public_compliance_throttle import get_client_config, rate_limit_client
 
 # resource type constants
 const_resource_type_unknown = 'unknown'
 const_resource_type_ec2 = 'ec2'
 const_resource_type_rds = 'rds'
+const_resource_type_network = 'network'
 
 
 # cross-account role name
 role_name = os.environ.get('RoleName').strip()
 
+# refresh pooled cross-account credentials this many seconds before they expire
+credential_refresh_seconds = int(os.environ.get('CredentialRefreshSeconds', 300))
+
+# region of the Lambda function, used when an event does not carry one
+default_region = os.environ.get('AWS_REGION')
+
+# regions evaluated by the sweep, events are handled from whichever region sent them
+enabled_regions = [region.strip() for region in os.environ.get('Regions', default_region or '').split(',') if region.strip()]
+
+
+# Pools are module level so they survive between warm invocations.
+# Credential pool entries are keyed by (account, role, region) and own the
+# clients and resources created from those credentials, so a refresh drops them.
+_credential_pool = {}
+_local_clients = {}
+_pool_lock = threading.Lock()
+_key_locks = {}
+
+
+
+def _get_key_lock(key):
+
+    # Get the lock that serializes STS and client creation for one pool key
+    #
+    # Input: pool key
+    # Output: threading.Lock
+
+    with _pool_lock:
+        lock = _key_locks.get(key)
+        if lock is None:
+            lock = threading.Lock()
+            _key_locks[key] = lock
+    return lock
+
+
+
+def get_local_client(service_name, config=None):
+
+    # Get a pooled client for the account the Lambda function runs in
+    #
+    # Input: service name, optional botocore Config used when the client is first created
+    # Output: boto3 client
+
+    client = _local_clients.get(service_name)
+    if client is None:
+        with _get_key_lock(service_name):
+            client = _local_clients.get(service_name)
+            if client is None:
+                client = instrument_client(boto3.client(service_name, config=config))
+                _local_clients[service_name] = client
+    return client
+
+
+
+def _is_expiring(expiration):
+
+    # Check if credentials are within the refresh window of their expiration
+    #
+    # Input: expiration datetime returned by STS
+    # Output: True if the credentials must be refreshed
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return expiration - now < datetime.timedelta(seconds=credential_refresh_seconds)
+
+
+
+def _get_pool_entry(accountid, region):
+
+    # Get the pooled session for the cross-account role, assuming it if needed
+    #
+    # Input: Account ID, region
+    # Output: pool entry with Expiration, Session, Clients and Resources
+
+    key = (accountid, role_name, region)
+    entry = _credential_pool.get(key)
+    if entry is not None and not _is_expiring(entry['Expiration']):
+        return entry
+
+    with _get_key_lock(key):
+        # another thread may have refreshed the entry while we waited
+        entry = _credential_pool.get(key)
+        if entry is None or _is_expiring(entry['Expiration']):
+            sts_connection = get_local_client('sts')
+            RoleArn= f"arn:aws:iam::{accountid}:role/{role_name}"
+            acct = sts_connection.assume_role(
+                RoleArn= RoleArn,
+                RoleSessionName= f"huit_public_subnet_compliance"
+            )
+            credentials=acct['Credentials']
+
+            session = boto3.session.Session(
+                aws_access_key_id= credentials['AccessKeyId'],
+                aws_secret_access_key= credentials['SecretAccessKey'],
+                aws_session_token= credentials['SessionToken'],
+                region_name= region
+                )
+            entry = {'Expiration': credentials['Expiration'], 'Session': session, 'Clients': {}, 'Resources': {}}
+            _credential_pool[key] = entry
+
+    return entry
+
+
+
+def utc_timestamp(dt=None):
+
+    # Format a time for stage timestamps
+    #
+    # Input: optional aware datetime, now if not given
+    # Output: ISO 8601 UTC string with microseconds
+
+    dt = dt or datetime.datetime.now(datetime.timezone.utc)
+    return dt.astimezone(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+
+def parse_utc_timestamp(value):
+
+    # Parse an event time or a stage timestamp
+    #
+    # Input: ISO 8601 UTC string, with or without fractional seconds
+    # Output: aware datetime
+
+    fmt = "%Y-%m-%dT%H:%M:%S.%fZ" if '.' in value else "%Y-%m-%dT%H:%M:%SZ"
+    return datetime.datetime.strptime(value, fmt).replace(tzinfo=datetime.timezone.utc)
+
+
+
+def get_event_region(event):
+
+    # Get the region an AWS event was raised in
+    #
+    # Input: AWS event
+    # Output: region name, the Lambda function's region if the event has none
+
+    return event.get('region') or default_region
+
+
+
+def get_handles(accountid, resource_type, region=None):
 
-def get_handles(accountid, resource_type):
-    
     # Get resource and/or client handles
     #
-    # Input: Account ID
+    # Input: Account ID, resource type, region (defaults to the Lambda function's region)
     # Output: boto3 client, resource
 
-    # get credentials for cross-account role
-    sts_connection = boto3.client('sts')
-
-    RoleArn= f"arn:aws:iam::{accountid}:role/{role_name}"
-    acct = sts_connection.assume_role(
-        RoleArn= RoleArn,
-        RoleSessionName= f"huit_public_subnet_compliance" 
-    )
-    credentials=acct['Credentials']
-
-    # get the client and resource
-    client = boto3.client(
-        resource_type,
-        aws_access_key_id= credentials['AccessKeyId'],
-        aws_secret_access_key= credentials['SecretAccessKey'],
-        aws_session_token= credentials['SessionToken']
-        )
-
-    if resource_type == const_resource_type_ec2:
-        resource = boto3.resource(
-        resource_type,
-        aws_access_key_id= credentials['AccessKeyId'],
-        aws_secret_access_key= credentials['SecretAccessKey'],
-        aws_session_token= credentials['SessionToken']
-        )
-    else:
-        resource = None
+    if region is None:
+        region = default_region
+    entry = _get_pool_entry(accountid, region)
+
+    client = entry['Clients'].get(resource_type)
+    resource = entry['Resources'].get(resource_type)
+    if client is None or (resource is None and resource_type == const_resource_type_ec2):
+        with _get_key_lock((accountid, role_name, region)):
+            session = entry['Session']
+            # calls to a member account share its token bucket and back off adaptively once throttled
+            if resource_type not in entry['Clients']:
+                client = session.client(resource_type, config=get_client_config())
+                entry['Clients'][resource_type] = instrument_client(rate_limit_client(client, accountid, region), accountid)
+            if resource_type == const_resource_type_ec2 and resource_type not in entry['Resources']:
+                resource = session.resource(resource_type, config=get_client_config())
+                instrument_client(rate_limit_client(resource.meta.client, accountid, region), accountid)
+                entry['Resources'][resource_type] = resource
+        client = entry['Clients'][resource_type]
+        resource = entry['Resources'].get(resource_type)
 
     return client, resource